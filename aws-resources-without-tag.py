@@ -1,97 +1,151 @@
 #!/usr/bin/python3
-import boto3
-from datetime import datetime, timedelta
+import argparse
+import aws_inventory
+import csv
+import json
+import sys
+from datetime import datetime, timedelta, timezone
 from botocore.exceptions import ClientError
 
 TAG_NAME="FedoraGroup"
+# columns of the jsonl/csv output, size in GiB and age in days
+FIELDS = ('region', 'type', 'id', 'name', 'owner', 'size', 'age', 'instance')
 
-def get_all_regions():
-    client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in client.describe_regions()['Regions']]
+def get_all_regions(inventory):
+    regions = inventory.regions()
     regions.remove('me-south-1')
     return regions
 
-def get_tag(tags, value):
-    for tag in tags or []:
-        if tag['Key'] == value:
-            return tag['Value']
-    return 'N/A'
-
-def get_instance_name(instance_id, region):
-    ec2 = boto3.client('ec2', region_name=region)
-    response = ec2.describe_instances(InstanceIds=[instance_id])
-    instance = response['Reservations'][0]['Instances'][0]
-    instance_name = ''
-    for tag in instance.get('Tags', []):
-        if tag['Key'] == 'Name':
-            instance_name = tag['Value']
-    return instance_name
-
-def older_than_24_hours(timestamp):
-    return timestamp < datetime.now(timestamp.tzinfo) - timedelta(days=1)
-
-def get_untagged_resources(region):
-    ec2 = boto3.resource('ec2', region_name=region)
-    client = boto3.client('ec2', region_name=region)
-    untagged_instances = []
-    untagged_volumes = []
-    untagged_amis = []
-    untagged_snapshots = []
-    for instance in ec2.instances.all():
-        if older_than_24_hours(instance.launch_time) and TAG_NAME not in [tag['Key'] for tag in instance.tags or []]:
-            instance_name = get_tag(instance.tags, "Name")
-            instance_owner = get_tag(instance.tags, "Owner")
-            untagged_instances.append((instance.id, instance_name, instance_owner))
-    for volume in ec2.volumes.all():
-        if older_than_24_hours(volume.create_time) and TAG_NAME not in [tag['Key'] for tag in volume.tags or []]:
-            attachment = volume.attachments[0] if volume.attachments else {}
-            attached_instance_id = attachment.get('InstanceId', 'N/A')
-            attached_instance_name = get_instance_name(attached_instance_id, region) if attached_instance_id != 'N/A' else 'N/A'
-            volume_owner = get_tag(volume.tags, "Owner")
-            volume_name = get_tag(volume.tags, "Name")
-            untagged_volumes.append((volume.id, attached_instance_name, volume_owner, volume_name))
-
-    for ami in client.describe_images(Owners=['self'])['Images']:
-        # Extract the tags for easier processing
-        tags = {tag['Key']: tag['Value'] for tag in ami.get('Tags', [])}
-        # Check if the AMI lacks the desired tag
+def get_instance_names(instances):
+    """
+    Return {instance_id: name} index for the given instances
+    """
+    instance_names = {}
+    for instance in instances:
+        instance_name = ''
+        for tag in instance.get('Tags', []):
+            if tag['Key'] == 'Name':
+                instance_name = tag['Value']
+        instance_names[instance['InstanceId']] = instance_name
+    return instance_names
+
+def untagged(resources, time_key=None, cutoff=None):
+    """
+    Yield (resource, {tag: value}) for the raw RESOURCES dicts without
+    TAG_NAME tag, created (TIME_KEY) before CUTOFF if specified
+    """
+    for resource in resources:
+        # the cheap age check first, most of our resources are short-lived
+        if time_key and resource[time_key] >= cutoff:
+            continue
+        tags = {tag['Key']: tag['Value'] for tag in resource.get('Tags', [])}
         if TAG_NAME not in tags:
-            ami_name = ami.get('Name', '')
-            untagged_amis.append((ami['ImageId'], ami_name))
+            yield resource, tags
+
+def iter_untagged_resources(inventory, region, stream=False):
+    """
+    Yield one record (dict with FIELDS keys) per untagged resource in REGION.
+    With STREAM, the resources are read page by page from AWS instead of the
+    inventory cache, so no whole listing is held in memory.
+    """
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=1)
+
+    def record(rtype, rid, name, tags, size, created, instance=None):
+        return {
+            'region': region,
+            'type': rtype,
+            'id': rid,
+            'name': name,
+            'owner': tags.get('Owner', 'N/A'),
+            'size': size,
+            'age': round((now - created).total_seconds() / 86400, 1),
+            'instance': instance,
+        }
+
+    def resources(kind):
+        return inventory.stream(region, kind) if stream else inventory.get(region, kind)
+
+    # only the names are kept for the volumes, not the instances
+    instance_names = {}
+    def named(reservations):
+        for reservation in reservations:
+            instance_names.update(get_instance_names(reservation['Instances']))
+            yield from reservation['Instances']
 
-    for snapshot in ec2.snapshots.filter(OwnerIds=['self']):
-        if older_than_24_hours(snapshot.start_time) and TAG_NAME not in [tag['Key'] for tag in snapshot.tags or []]:
-            snapshot_name = get_tag(snapshot.tags, 'Name')
-            snapshot_size = snapshot.volume_size
-            untagged_snapshots.append((snapshot.id, snapshot_name, snapshot_size))
+    for instance, tags in untagged(named(resources('instances')), 'LaunchTime', cutoff):
+        yield record('instance', instance['InstanceId'], tags.get('Name', 'N/A'), tags,
+                     None, instance['LaunchTime'])
 
-    return untagged_instances, untagged_volumes, untagged_amis, untagged_snapshots
+    for volume, tags in untagged(resources('volumes'), 'CreateTime', cutoff):
+        attachment = volume['Attachments'][0] if volume.get('Attachments') else {}
+        yield record('volume', volume['VolumeId'], tags.get('Name', 'N/A'), tags,
+                     volume['Size'], volume['CreateTime'],
+                     instance_names.get(attachment.get('InstanceId'), 'N/A'))
 
-for region in get_all_regions():
+    for ami, tags in untagged(resources('images')):
+        size = sum(mapping['Ebs'].get('VolumeSize', 0)
+                   for mapping in ami.get('BlockDeviceMappings', []) if 'Ebs' in mapping)
+        yield record('ami', ami['ImageId'], ami.get('Name', ''), tags,
+                     size, datetime.fromisoformat(ami['CreationDate']))
+
+    for snapshot, tags in untagged(resources('snapshots'), 'StartTime', cutoff):
+        yield record('snapshot', snapshot['SnapshotId'], tags.get('Name', 'N/A'), tags,
+                     snapshot['VolumeSize'], snapshot['StartTime'])
+
+def print_text(region, records):
+    """
+    The human readable report of one region
+    """
     print("\nRegion: {}".format(region))
-    try:
-        (untagged_instances, untagged_volumes, untagged_amis, untagged_snapshots) = get_untagged_resources(region)
-    except ClientError:
-        print("Skipping this region")
-        continue
-    if untagged_instances:
+    by_type = {'instance': [], 'volume': [], 'ami': [], 'snapshot': []}
+    for record in records:
+        by_type[record['type']].append(record)
+    if by_type['instance']:
         print("Instances: (name, id, owner)")
-        for (id, name, owner) in untagged_instances:
-            print("  * {} ({}, {})".format(name, id, owner))
-    if untagged_volumes:
+        for record in by_type['instance']:
+            print("  * {name} ({id}, {owner})".format(**record))
+    if by_type['volume']:
         print("Volumes - [id name (attached to instance, owner)]: ")
-        for (id, instance_name, owner, name) in untagged_volumes:
-            print("  * {} {} ({}, {})".format(id, name, instance_name, owner))
-    if untagged_amis:
+        for record in by_type['volume']:
+            print("  * {id} {name} ({instance}, {owner})".format(**record))
+    if by_type['ami']:
         print("AMIs - [id, name]:")
-        for (id, name) in untagged_amis:
-            print(f"  * {id} {name}")
-    if untagged_snapshots:
+        for record in by_type['ami']:
+            print("  * {id} {name}".format(**record))
+    if by_type['snapshot']:
         print(f"Snapshots: ")
-        total_snap_size = 0
-        for (id, snapshot_name, snapshot_size) in untagged_snapshots:
-#            print(f"  * {id} {snapshot_name} {snapshot_size} GB")
-            total_snap_size += snapshot_size
-        print(f"  * {total_snap_size} GB in {len(untagged_snapshots)} snapshots")
+        total_snap_size = sum(record['size'] for record in by_type['snapshot'])
+        print(f"  * {total_snap_size} GB in {len(by_type['snapshot'])} snapshots")
+
+def main():
+    parser = argparse.ArgumentParser(description='List resources without the FedoraGroup tag.')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'csv'], default='text',
+                        help='text report per region, or one jsonl/csv record per resource'
+                             ' printed as soon as it is found, jsonl/csv read the resources'
+                             ' page by page from AWS and skip the inventory cache')
+    aws_inventory.add_max_age_argument(parser)
+    args = parser.parse_args()
+    inventory = aws_inventory.Inventory(max_age=args.max_age)
+
+    if args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fieldnames=FIELDS)
+        writer.writeheader()
 
+    for region in get_all_regions(inventory):
+        records = iter_untagged_resources(inventory, region, stream=args.format != 'text')
+        try:
+            if args.format == 'text':
+                print_text(region, records)
+                continue
+            for record in records:
+                if args.format == 'jsonl':
+                    print(json.dumps(record))
+                else:
+                    writer.writerow(record)
+                sys.stdout.flush()
+        except ClientError:
+            print(f"Skipping region {region}", file=sys.stderr if args.format != 'text' else sys.stdout)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+"""
+Parallel, rate-limited deletion of EC2 resources.
+
+The delete-*.py scripts only decide what should be removed, this module does
+the removal:
+
+* regions are processed in parallel and so are the deletions in one region,
+* every region has a token bucket keeping us under the EC2 API limits for
+  mutating calls, the rate is halved on RequestLimitExceeded and slowly
+  raised again on success,
+* throttled calls are retried with exponential backoff,
+* with --checkpoint, every deleted resource is recorded, so an interrupted
+  run can be restarted and skips what is already gone,
+* optionally the snapshots of deregistered AMIs are deleted right after
+  them, unless another AMI still uses them (see SnapshotIndex), the
+  checkpoint remembers the snapshots of every AMI before it is deregistered
+  so a resumed run deletes them too,
+* with a plan (see aws_plan.py), nothing is deleted and the resources are
+  recorded into the plan instead.
+
+Usage:
+
+    aws_bulk_delete.add_arguments(parser)
+    args = parser.parse_args()
+    deleter = aws_bulk_delete.BulkDeleter.from_args(args, aws_bulk_delete.delete_snapshot)
+    deleter.run(regions, select)
+
+where select(region) returns [(resource_id, description), ...].
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+# EC2 refills the bucket of mutating actions with 5 tokens per second, we
+# stay a bit under it to leave room for other tools
+DEFAULT_RATE = 4
+DEFAULT_BURST = 20
+REGION_WORKERS = 8
+WORKERS_PER_REGION = 8
+MAX_THROTTLE_RETRIES = 8
+
+THROTTLING_CODES = {'RequestLimitExceeded', 'Throttling', 'ThrottlingException'}
+# the resource is already gone, count it as deleted
+NOT_FOUND_CODES = {'InvalidAMIID.NotFound', 'InvalidAMIID.Unavailable',
+                   'InvalidSnapshot.NotFound', 'InvalidVolume.NotFound'}
+
+
+def deregister_image(client, image_id):
+    """ Action deregistering an AMI """
+    client.deregister_image(ImageId=image_id)
+
+def delete_snapshot(client, snapshot_id):
+    """ Action deleting a snapshot """
+    client.delete_snapshot(SnapshotId=snapshot_id)
+
+def delete_volume(client, volume_id):
+    """ Action deleting a volume """
+    client.delete_volume(VolumeId=volume_id)
+
+
+def _error_code(err):
+    return err.response.get('Error', {}).get('Code')
+
+
+class StillThrottled(Exception):
+    """ The call was throttled MAX_THROTTLE_RETRIES times """
+
+
+class TokenBucket:
+    """
+    Token bucket with additive-increase/multiplicative-decrease rate
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until one token is available and take it
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        """ AWS told us to slow down """
+        with self.lock:
+            self.rate = max(0.5, self.rate / 2)
+            self.tokens = 0
+
+    def succeeded(self):
+        """ The call went through, speed up slowly """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+def rate_limited_call(bucket, function, *args, retry_codes=frozenset(), **kwargs):
+    """
+    Return FUNCTION(*ARGS, **KWARGS) called with a token from BUCKET
+    (TokenBucket).  Throttled calls and errors with RETRY_CODES are retried
+    with exponential backoff, StillThrottled is raised when giving up, other
+    errors are raised right away.
+    """
+    for attempt in range(MAX_THROTTLE_RETRIES):
+        bucket.acquire()
+        try:
+            response = function(*args, **kwargs)
+        except ClientError as err:
+            if _error_code(err) in THROTTLING_CODES or _error_code(err) in retry_codes:
+                bucket.throttled()
+                time.sleep(random.uniform(0, min(60, 2 ** attempt)))
+                continue
+            raise
+        bucket.succeeded()
+        return response
+    raise StillThrottled()
+
+
+class SnapshotIndex:
+    """
+    Which AMIs use which snapshots, built from the describe_images listing
+    the front-end already has, so no other crawl is needed
+    """
+    def __init__(self):
+        self.image_snapshots = {}  # (region, image_id): [snapshot_id, ...]
+        self.snapshot_users = {}  # (region, snapshot_id): {image_id, ...}
+        self.lock = threading.Lock()
+
+    def add_images(self, region, images):
+        """ Index the IMAGES (describe_images dicts) of REGION """
+        with self.lock:
+            for image in images:
+                snapshots = [mapping['Ebs']['SnapshotId']
+                             for mapping in image.get('BlockDeviceMappings', [])
+                             if 'SnapshotId' in mapping.get('Ebs', {})]
+                self.image_snapshots[(region, image['ImageId'])] = snapshots
+                for snapshot_id in snapshots:
+                    self.snapshot_users.setdefault((region, snapshot_id), set()).add(image['ImageId'])
+
+    def listed(self, region, image_id):
+        """ Was IMAGE_ID in REGION indexed """
+        with self.lock:
+            return (region, image_id) in self.image_snapshots
+
+    def snapshots(self, region, image_id):
+        """ Snapshot IDs of IMAGE_ID in REGION """
+        with self.lock:
+            return list(self.image_snapshots.get((region, image_id), []))
+
+    def restore(self, region, image_id, snapshot_ids):
+        """
+        Index IMAGE_ID using SNAPSHOT_IDS, deregistered by an earlier run and
+        not listed anymore
+        """
+        with self.lock:
+            if (region, image_id) in self.image_snapshots:
+                return
+            self.image_snapshots[(region, image_id)] = list(snapshot_ids)
+            for snapshot_id in snapshot_ids:
+                self.snapshot_users.setdefault((region, snapshot_id), set()).add(image_id)
+
+    def orphaned(self, region, deleted_image_ids):
+        """
+        Return [(snapshot_id, description), ...] of snapshots used only by
+        DELETED_IMAGE_IDS in REGION
+        """
+        deleted = set(deleted_image_ids)
+        orphans = {}
+        with self.lock:
+            for image_id in deleted_image_ids:
+                for snapshot_id in self.image_snapshots.get((region, image_id), []):
+                    if self.snapshot_users[(region, snapshot_id)] <= deleted:
+                        orphans.setdefault(snapshot_id, f"of {image_id}")
+        return list(orphans.items())
+
+
+class Checkpoint:
+    """
+    Append-only file of "region resource_id" lines already processed and of
+    "region resource_id uses related_id ..." lines noting the resources
+    related to the processed ones, e.g. the snapshots of an AMI
+    """
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.related = {}  # (region, resource_id): [related_id, ...]
+        self.lock = threading.Lock()
+        self.file = None
+        if path is None:
+            return
+        try:
+            with open(path, "r", encoding="utf8") as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        self.done.add(tuple(fields))
+                    elif len(fields) > 2 and fields[2] == 'uses':
+                        self.related[(fields[0], fields[1])] = fields[3:]
+        except FileNotFoundError:
+            pass
+        self.file = open(path, "a", encoding="utf8")  # pylint: disable=consider-using-with
+
+    def __contains__(self, item):
+        return item in self.done
+
+    def add(self, region, resource_id):
+        """ Record RESOURCE_ID in REGION as processed """
+        with self.lock:
+            self.done.add((region, resource_id))
+            if self.file:
+                self.file.write(f"{region} {resource_id}\n")
+                self.file.flush()
+
+    def note(self, region, resource_id, related_ids):
+        """ Record that RESOURCE_ID in REGION uses RELATED_IDS """
+        with self.lock:
+            self.related[(region, resource_id)] = list(related_ids)
+            if self.file:
+                self.file.write(f"{region} {resource_id} uses {' '.join(related_ids)}\n")
+                self.file.flush()
+
+    def close(self):
+        """ Close the checkpoint file """
+        if self.file:
+            self.file.close()
+
+
+def add_arguments(parser):
+    """
+    Add the options of BulkDeleter to the argparse PARSER
+    """
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='record deleted resources into FILE and skip those already there')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help=f'max API calls per second in one region (default: {DEFAULT_RATE})')
+    parser.add_argument('--workers', type=int, default=WORKERS_PER_REGION,
+                        help=f'parallel deletions in one region (default: {WORKERS_PER_REGION})')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print what would be deleted')
+
+
+def add_cascade_argument(parser):
+    """
+    Add --keep-snapshots to the argparse PARSER of AMI deleting scripts
+    """
+    parser.add_argument('--keep-snapshots', action='store_true',
+                        help='do not delete snapshots of the deregistered AMIs')
+
+
+class BulkDeleter:
+    """
+    Run ACTION(client, resource_id) for all resources selected in all
+    regions.  If CASCADE (SnapshotIndex) is specified, the snapshots only the
+    deleted AMIs used are deleted by CASCADE_ACTION once ACTION is done in
+    the region, including the AMIs deleted by an earlier run with the same
+    checkpoint.  If PLAN (aws_plan.Plan) is specified, the actions are only
+    added into it.
+    """
+    def __init__(self, action, checkpoint=None, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 workers=WORKERS_PER_REGION, region_workers=REGION_WORKERS, dry_run=False,
+                 cascade=None, cascade_action=delete_snapshot, plan=None, verb="Deleted"):
+        self.action = action
+        self.plan = plan
+        self.verb = verb
+        self.cascade = cascade
+        self.cascade_action = cascade_action
+        self.checkpoint = Checkpoint(checkpoint)
+        self.rate = rate
+        self.burst = burst
+        self.workers = workers
+        self.region_workers = region_workers
+        self.dry_run = dry_run
+        self.stats = {'deleted': 0, 'failed': 0, 'skipped': 0}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args, action, cascade=None, plan=None):
+        """ Create the deleter from add_arguments() options """
+        if getattr(args, 'keep_snapshots', False):
+            cascade = None
+        return cls(action, checkpoint=args.checkpoint, rate=args.rate,
+                   workers=args.workers, dry_run=args.dry_run, cascade=cascade,
+                   plan=plan)
+
+    def _count(self, what):
+        with self.lock:
+            self.stats[what] += 1
+
+    def _delete(self, client, bucket, region, action, resource_id, description):
+        """
+        Run ACTION on one resource, return True if it is gone
+        """
+        try:
+            rate_limited_call(bucket, action, client, resource_id)
+        except ClientError as err:
+            if _error_code(err) not in NOT_FOUND_CODES:
+                print(f"  Error deleting {resource_id} in {region}: {err}")
+                self._count('failed')
+                return False
+        except BotoCoreError as err:
+            print(f"  Error deleting {resource_id} in {region}: {err}")
+            self._count('failed')
+            return False
+        except StillThrottled:
+            print(f"  Giving up on {resource_id} in {region}, still throttled")
+            self._count('failed')
+            return False
+        else:
+            print(f"  {self.verb} {resource_id} {description} in {region}")
+        self.checkpoint.add(region, resource_id)
+        self._count('deleted')
+        return True
+
+    def _filter_done(self, region, resources):
+        todo = []
+        for resource_id, description in resources:
+            if (region, resource_id) in self.checkpoint:
+                self._count('skipped')
+                continue
+            todo.append((resource_id, description))
+        return todo
+
+    def _delete_all(self, client, bucket, region, action, todo):
+        """
+        Run ACTION on all TODO resources in parallel, return the deleted IDs
+        """
+        if self.plan is not None:
+            for resource_id, description in todo:
+                self.plan.add(region, action.__name__, resource_id, description=description)
+            return [resource_id for resource_id, _ in todo]
+
+        if self.dry_run:
+            for resource_id, description in todo:
+                print(f"  Would delete {resource_id} {description} in {region}")
+            return [resource_id for resource_id, _ in todo]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self._delete, client, bucket, region, action,
+                                resource_id, description): resource_id
+                for resource_id, description in todo
+            }
+            return [resource_id for future, resource_id in futures.items() if future.result()]
+
+    def _resume_cascade(self, region):
+        """
+        Return the resources of REGION deleted by an earlier run, their
+        snapshots noted in the checkpoint are indexed again
+        """
+        resumed = []
+        for (note_region, resource_id), snapshot_ids in sorted(self.checkpoint.related.items()):
+            if note_region != region:
+                continue
+            # deleted, or deleted but interrupted before it was checkpointed
+            if ((region, resource_id) in self.checkpoint
+                    or not self.cascade.listed(region, resource_id)):
+                self.cascade.restore(region, resource_id, snapshot_ids)
+                resumed.append(resource_id)
+        return resumed
+
+    def process_region(self, region, select):
+        """
+        Delete everything SELECT(region) returns in REGION
+        """
+        try:
+            resources = select(region)
+        except (BotoCoreError, ClientError) as err:
+            print(f"Skipping region {region}: {err}")
+            return
+
+        todo = self._filter_done(region, resources)
+        print(f"Region {region}: {len(todo)} to delete")
+        resumed = []
+        if self.cascade and self.plan is None:
+            resumed = self._resume_cascade(region)
+            if not self.dry_run:
+                for resource_id, _ in todo:
+                    self.checkpoint.note(region, resource_id, self.cascade.snapshots(region, resource_id))
+        client = boto3.session.Session().client('ec2', region_name=region)
+        bucket = TokenBucket(self.rate, self.burst)
+        deleted = self._delete_all(client, bucket, region, self.action, todo)
+        if not self.cascade or not deleted + resumed:
+            return
+
+        todo = self._filter_done(region, self.cascade.orphaned(region, deleted + resumed))
+        print(f"Region {region}: {len(todo)} orphaned snapshots to delete")
+        self._delete_all(client, bucket, region, self.cascade_action, todo)
+
+    def run(self, regions, select):
+        """
+        Process all REGIONS in parallel, return the statistics
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=self.region_workers) as executor:
+                futures = [executor.submit(self.process_region, region, select)
+                           for region in regions]
+                for future in futures:
+                    future.result()
+        finally:
+            self.checkpoint.close()
+        if self.plan is not None:
+            return self.stats
+        print(f"{self.verb}: {self.stats['deleted']}, failed: {self.stats['failed']},"
+              f" skipped (checkpoint): {self.stats['skipped']}")
+        return self.stats
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+"""
+Migrate EC2 volumes from gp2 to gp3.
+
+Used by gp2-to-gp3.py and by aws_plan.py to apply the modify_volume actions:
+
+    volumes = {region: [(volume_id, gp3_parameters(size), description), ...]}
+    stats = Migration(checkpoint='gp3.done').run(volumes)
+
+Regions are migrated in parallel.  In one region the modify_volume calls are
+sent by several workers, rate-limited by a token bucket, while at most
+IN_FLIGHT modifications are running at once.  The running modifications are
+polled with one describe_volumes_modifications call per POLL_BATCH volumes.
+A volume is done once its modification reaches the 'optimizing' state, it is
+already gp3 then.  The run stops submitting new modifications after TIMEOUT
+seconds and reports what is left for the next run.
+
+The gp3 volume gets at least the performance of the gp2 one, see
+gp3_parameters().
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_bulk_delete
+from aws_paginate import chunks, paginate
+
+# gp2 baseline is 3 IOPS per GiB, at least 100 and at most 16000 IOPS
+GP2_IOPS_PER_GIB = 3
+GP2_MIN_IOPS = 100
+GP2_MAX_IOPS = 16000
+# gp2 volumes larger than 170 GiB deliver up to 250 MiB/s, the smaller
+# ones 128 MiB/s which the gp3 baseline covers (almost)
+GP2_SMALL_VOLUME = 170
+GP2_MAX_THROUGHPUT = 250
+# gp3 gives these for free, regardless of the size
+GP3_BASELINE_IOPS = 3000
+GP3_BASELINE_THROUGHPUT = 125
+# USD per provisioned MiB/s and month in us-east-1, the price table does
+# not know throughput prices
+GP3_THROUGHPUT_MONTHLY = 0.04
+
+DEFAULT_IN_FLIGHT = 100
+DEFAULT_TIMEOUT = 3600
+POLL_BATCH = 200
+POLL_INTERVAL = 15
+REGION_WORKERS = 8
+
+# the volume is being modified or was modified in the last 6 hours
+SKIP_CODES = {'IncorrectModificationState', 'VolumeModificationRateExceeded'}
+DONE_STATES = {'optimizing', 'completed'}
+
+
+def gp3_parameters(size):
+    """
+    Return modify_volume arguments giving the gp3 volume at least the
+    performance of a SIZE GiB gp2 volume
+    """
+    params = {'VolumeType': 'gp3'}
+    iops = min(GP2_MAX_IOPS, max(GP2_MIN_IOPS, GP2_IOPS_PER_GIB * size))
+    if iops > GP3_BASELINE_IOPS:
+        params['Iops'] = iops
+    if size > GP2_SMALL_VOLUME:
+        params['Throughput'] = GP2_MAX_THROUGHPUT
+    return params
+
+
+def gp3_savings(plan, region, size, params):
+    """
+    Monthly savings of migrating a SIZE GiB volume with PARAMS
+    """
+    gp3_price = plan.volume_monthly(region, 'gp3', size)
+    gp3_price += plan.iops_monthly(region, 'gp3', params.get('Iops', GP3_BASELINE_IOPS) - GP3_BASELINE_IOPS)
+    gp3_price += GP3_THROUGHPUT_MONTHLY * (params.get('Throughput', GP3_BASELINE_THROUGHPUT)
+                                           - GP3_BASELINE_THROUGHPUT)
+    return plan.volume_monthly(region, 'gp2', size) - gp3_price
+
+
+class Migration:
+    """
+    Concurrent gp2 to gp3 migration of all regions
+    """
+    def __init__(self, workers=aws_bulk_delete.WORKERS_PER_REGION, in_flight=DEFAULT_IN_FLIGHT,
+                 rate=aws_bulk_delete.DEFAULT_RATE, timeout=DEFAULT_TIMEOUT, checkpoint=None,
+                 dry_run=False):
+        self.workers = workers
+        self.in_flight = in_flight
+        self.rate = rate
+        self.deadline = time.monotonic() + timeout
+        self.checkpoint = aws_bulk_delete.Checkpoint(checkpoint)
+        self.dry_run = dry_run
+        self.stats = {'migrated': 0, 'failed': 0, 'skipped': 0, 'unfinished': 0}
+        self.lock = threading.Lock()
+
+    def _count(self, what, count=1):
+        with self.lock:
+            self.stats[what] += count
+
+    def _modify(self, client, bucket, region, volume):
+        """
+        Start the modification of VOLUME, return True if it is running
+        """
+        volume_id, params, description = volume
+        try:
+            aws_bulk_delete.rate_limited_call(bucket, client.modify_volume, VolumeId=volume_id, **params)
+        except ClientError as err:
+            code = err.response.get('Error', {}).get('Code')
+            if code in SKIP_CODES:
+                print(f'  Skipping volume {volume_id} in {region}: {code}')
+                self._count('skipped')
+                return False
+            print(f'  Error migrating volume {volume_id} in {region}: {err}')
+            self._count('failed')
+            return False
+        except BotoCoreError as err:
+            print(f'  Error migrating volume {volume_id} in {region}: {err}')
+            self._count('failed')
+            return False
+        except aws_bulk_delete.StillThrottled:
+            print(f'  Giving up on volume {volume_id} in {region}, still throttled')
+            self._count('failed')
+            return False
+        print(f'  Migrating volume {volume_id} in region {region} ({description},'
+              f' {params.get("Iops", GP3_BASELINE_IOPS)} IOPS,'
+              f' {params.get("Throughput", GP3_BASELINE_THROUGHPUT)} MiB/s)')
+        return True
+
+    def _poll(self, client, region, volume_ids):
+        """
+        Return the VOLUME_IDS whose modification is not running anymore,
+        including the volumes deleted meanwhile
+        """
+        finished = set()
+        for chunk in chunks(volume_ids, POLL_BATCH):
+            # with VolumeIds, one deleted volume fails the whole call
+            try:
+                modifications = list(paginate(client, 'describe_volumes_modifications',
+                                              'VolumesModifications',
+                                              Filters=[{'Name': 'volume-id', 'Values': chunk}]))
+            except (BotoCoreError, ClientError) as err:
+                print(f'  Can not poll modifications in {region}: {err}')
+                continue
+            for volume_id in sorted(set(chunk) - {modification['VolumeId'] for modification in modifications}):
+                print(f'  Volume {volume_id} in {region} does not exist anymore')
+                self._count('failed')
+                finished.add(volume_id)
+            for modification in modifications:
+                volume_id = modification['VolumeId']
+                state = modification['ModificationState']
+                if state in DONE_STATES:
+                    print(f'  Volume {volume_id} in region {region} migrated to gp3')
+                    self.checkpoint.add(region, volume_id)
+                    self._count('migrated')
+                    finished.add(volume_id)
+                elif state == 'failed':
+                    print(f'  Migration of volume {volume_id} in {region} failed:'
+                          f' {modification.get("StatusMessage", "")}')
+                    self._count('failed')
+                    finished.add(volume_id)
+        return finished
+
+    def process_region(self, region, volumes):
+        """
+        Migrate VOLUMES ([(volume_id, modify_volume arguments, description)])
+        in REGION
+        """
+        todo = [volume for volume in volumes if (region, volume[0]) not in self.checkpoint]
+        self._count('skipped', len(volumes) - len(todo))
+        print(f'Region {region}: {len(todo)} gp2 volumes')
+        if self.dry_run:
+            for volume_id, _, description in todo:
+                print(f'  Would migrate volume {volume_id} in region {region} ({description})')
+            return
+
+        client = boto3.session.Session().client('ec2', region_name=region)
+        pending = deque(todo)
+        in_flight = set()
+        bucket = aws_bulk_delete.TokenBucket(self.rate)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while (pending or in_flight) and time.monotonic() < self.deadline:
+                batch = []
+                while pending and len(in_flight) + len(batch) < self.in_flight:
+                    batch.append(pending.popleft())
+                started = executor.map(lambda volume: self._modify(client, bucket, region, volume),
+                                       batch)
+                for volume, running in zip(batch, started):
+                    if running:
+                        in_flight.add(volume[0])
+                if not in_flight:
+                    continue
+                time.sleep(POLL_INTERVAL)
+                in_flight -= self._poll(client, region, sorted(in_flight))
+
+        if pending or in_flight:
+            print(f'Region {region}: timeout, {len(pending)} volumes not started,'
+                  f' {len(in_flight)} still modifying')
+            self._count('unfinished', len(pending) + len(in_flight))
+
+    def run(self, volumes):
+        """
+        Migrate VOLUMES ({region: [(volume_id, modify_volume arguments,
+        description)]}) in parallel, return the statistics
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=REGION_WORKERS) as executor:
+                futures = [executor.submit(self.process_region, region, region_volumes)
+                           for region, region_volumes in volumes.items()]
+                for future in futures:
+                    future.result()
+        finally:
+            self.checkpoint.close()
+        print(f"Migrated: {self.stats['migrated']}, failed: {self.stats['failed']},"
+              f" skipped: {self.stats['skipped']}, unfinished: {self.stats['unfinished']}")
+        return self.stats
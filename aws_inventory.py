@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""
+Shared inventory of EC2 resources in all regions.
+
+The raw describe_* results are stored per (region, kind) in a small SQLite
+file so that several scripts run one after another pay for just one crawl.
+Every entry older than max_age seconds is fetched again from AWS.
+
+Usage:
+
+    import aws_inventory
+    aws_inventory.add_max_age_argument(parser)
+    ...
+    inventory = aws_inventory.Inventory(max_age=args.max_age)
+    for region in inventory.regions():
+        for volume in inventory.volumes(region):
+            ...
+
+Running this file directly refreshes the whole cache.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import boto3
+
+from aws_paginate import paginate
+
+CACHE_DIR = os.path.expanduser("~/.cache/fedora-infra-scripts")
+CACHE_PATH = os.path.join(CACHE_DIR, "inventory.sqlite")
+DEFAULT_MAX_AGE = 3600
+
+# kind: (paginated client method, key in the response, arguments)
+KINDS = {
+    'instances': ('describe_instances', 'Reservations', {}),
+    'volumes': ('describe_volumes', 'Volumes', {}),
+    'images': ('describe_images', 'Images', {'Owners': ['self']}),
+    'snapshots': ('describe_snapshots', 'Snapshots', {'OwnerIds': ['self']}),
+}
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Can not serialize {value!r}")
+
+def _json_object_hook(value):
+    if '__datetime__' in value:
+        return datetime.datetime.fromisoformat(value['__datetime__'])
+    return value
+
+def _dump(data):
+    return zlib.compress(json.dumps(data, default=_json_default, separators=(',', ':')).encode())
+
+def _load(blob):
+    return json.loads(zlib.decompress(blob), object_hook=_json_object_hook)
+
+
+def add_max_age_argument(parser, default=DEFAULT_MAX_AGE):
+    """
+    Add the --max-age option to the argparse PARSER
+    """
+    parser.add_argument('--max-age', type=int, default=default,
+                        help='use cached inventory younger than this many seconds,'
+                             f' 0 forces a new crawl (default: {default})')
+
+
+class Inventory:
+    """
+    Cached access to EC2 resources, all methods return the plain
+    dictionaries as returned by boto3 client.  The api_calls attribute
+    counts requests really sent to AWS.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, path=CACHE_PATH):
+        self.max_age = max_age
+        self.path = path
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        # clients are thread-safe, the session is not: the clients are
+        # created from one session under a lock and then shared, so the
+        # service model is loaded once and not per region and kind
+        self._session = boto3.session.Session()
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS crawl (
+                    region TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    data BLOB NOT NULL,
+                    PRIMARY KEY (region, kind)
+                )""")
+
+    def _connect(self):
+        # one connection per call, so the inventory can be used from threads
+        return sqlite3.connect(self.path, timeout=60)
+
+    def _cached(self, region, kind):
+        with self._connect() as conn:
+            row = conn.execute("SELECT fetched, data FROM crawl WHERE region = ? AND kind = ?",
+                               (region, kind)).fetchone()
+        if row is None or time.time() - row[0] > self.max_age:
+            return None
+        return _load(row[1])
+
+    def _count_call(self):
+        with self._lock:
+            self.api_calls += 1
+
+    def _client(self, region):
+        with self._clients_lock:
+            if region not in self._clients:
+                client = self._session.client('ec2', region_name=region)
+                client.meta.events.register('before-call.ec2', lambda **_: self._count_call())
+                self._clients[region] = client
+            return self._clients[region]
+
+    def _store(self, region, kind, data):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO crawl (region, kind, fetched, data) VALUES (?, ?, ?, ?)",
+                         (region, kind, time.time(), _dump(data)))
+
+    def regions(self):
+        """
+        Names of all regions enabled for the account
+        """
+        regions = self._cached('', 'regions')
+        if regions is None:
+            client = self._client('us-east-1')
+            regions = [region['RegionName'] for region in client.describe_regions()['Regions']]
+            self._store('', 'regions', regions)
+        return regions
+
+    def get(self, region, kind):
+        """
+        All resources of KIND (see KINDS) in REGION, from cache if fresh enough
+        """
+        data = self._cached(region, kind)
+        if data is not None:
+            return data
+        method, key, kwargs = KINDS[kind]
+        data = list(paginate(self._client(region), method, key, **kwargs))
+        self._store(region, kind, data)
+        return data
+
+    def stream(self, region, kind):
+        """
+        Yield the resources of KIND in REGION page by page straight from AWS,
+        the cache is neither read nor written, so only one page is in memory
+        """
+        method, key, kwargs = KINDS[kind]
+        yield from paginate(self._client(region), method, key, **kwargs)
+
+    def instances(self, region):
+        """ Instances in REGION, reservations flattened """
+        return [instance
+                for reservation in self.get(region, 'instances')
+                for instance in reservation['Instances']]
+
+    def volumes(self, region):
+        """ Volumes in REGION """
+        return self.get(region, 'volumes')
+
+    def images(self, region):
+        """ AMIs owned by us in REGION """
+        return self.get(region, 'images')
+
+    def snapshots(self, region):
+        """ Snapshots owned by us in REGION """
+        return self.get(region, 'snapshots')
+
+    def invalidate(self, region, kind):
+        """
+        Drop cached KIND in REGION, e.g. after the script modified it
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM crawl WHERE region = ? AND kind = ?", (region, kind))
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Refresh the cached EC2 inventory of all regions.')
+    add_max_age_argument(parser, default=0)
+    args = parser.parse_args()
+    inventory = Inventory(max_age=args.max_age)
+    for region in inventory.regions():
+        print(f"Region: {region}")
+        for kind in KINDS:
+            try:
+                print(f"  {kind}: {len(inventory.get(region, kind))}")
+            except Exception as e:
+                print(f"  {kind}: skipped ({e})")
+
+
+if __name__ == "__main__":
+    _main()
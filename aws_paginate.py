@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""
+Streaming pagination of EC2 describe_* calls.
+
+Every page is requested separately and retried on AWS errors, the items are
+yielded lazily so the callers do not need to hold the whole inventory of the
+region in memory:
+
+    client = boto3.client('ec2', region_name=region)
+    for volume in paginate(client, 'describe_volumes', 'Volumes'):
+        ...
+"""
+
+import backoff
+from botocore.exceptions import BotoCoreError, ClientError
+
+# MaxResults used for the methods where AWS otherwise may return one
+# (possibly truncated) page
+PAGE_SIZES = {
+    'describe_images': 1000,
+    'describe_instances': 1000,
+    'describe_snapshots': 1000,
+    'describe_spot_instance_requests': 1000,
+    'describe_spot_price_history': 1000,
+    'describe_volumes': 500,
+    'describe_volumes_modifications': 500,
+}
+
+# MaxResults can not be combined with these arguments
+_ID_ARGUMENTS = ('ImageIds', 'InstanceIds', 'SnapshotIds', 'VolumeIds')
+
+# errors which never go away by retrying, e.g. disabled regions
+FATAL_ERROR_CODES = {'AuthFailure', 'OptInRequired', 'UnauthorizedOperation'}
+
+
+def _is_fatal(err):
+    return isinstance(err, ClientError) and \
+        err.response.get('Error', {}).get('Code') in FATAL_ERROR_CODES
+
+
+def retry_decorator(max_retries=60, max_time=60):
+    """
+    Retry AWS API query
+    """
+    return backoff.on_exception(
+        backoff.expo,
+        (BotoCoreError, ClientError),
+        max_tries=max_retries,
+        max_time=max_time,
+        jitter=backoff.full_jitter,
+        giveup=_is_fatal,
+    )
+
+
+def chunks(items, size):
+    """
+    Split the ITEMS list into lists of at most SIZE items, e.g. the resource
+    IDs of one create_tags call or of one describe_* filter
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def paginate(client, method, key, **kwargs):
+    """
+    Yield items stored under KEY from all pages of client METHOD called
+    with KWARGS.  Each page request is retried with retry_decorator().
+    """
+    call = retry_decorator()(getattr(client, method))
+    if method in PAGE_SIZES and not any(arg in kwargs for arg in _ID_ARGUMENTS):
+        kwargs.setdefault('MaxResults', PAGE_SIZES[method])
+    while True:
+        page = call(**kwargs)
+        yield from page.get(key, [])
+        token = page.get('NextToken')
+        if not token:
+            return
+        kwargs['NextToken'] = token
@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+"""
+Plan/apply split for the scripts modifying EC2 resources.
+
+With --plan FILE the scripts only scan the account and write what they would
+do into FILE, nothing is changed.  The plan can be reviewed, diffed against an
+older one and applied later without scanning again:
+
+    $ ./delete-old-amis.py --plan old-amis.plan
+    $ ./aws_plan.py show old-amis.plan
+    $ ./aws_plan.py apply old-amis.plan --checkpoint old-amis.done
+
+The plan file is JSON lines, the first line is a header with the totals, then
+one action per line sorted by region, phase, action and resource:
+
+    {"region": "us-east-1", "action": "delete_snapshot", "id": "snap-...",
+     "args": {}, "description": "...", "savings": 0.25}
+
+savings is the estimated monthly price in USD the action saves.  The apply
+phase runs the actions through aws_bulk_delete.BulkDeleter (and
+aws_snapshot_delete.SnapshotAndDelete for snapshot_and_delete_volume,
+aws_gp3_migration.Migration for modify_volume), so regions and actions run in
+parallel, rate-limited and resumable with --checkpoint.
+create_tags actions with the same tags are batched into one call per 1000
+resources, the resources which do not exist anymore are left out of the
+batch and the rest is tagged.  The actions are applied in PHASES, every phase waits until the
+previous one is finished in all regions, so e.g. the snapshots of AMIs are
+deleted only after the AMIs are deregistered.
+"""
+
+import argparse
+import json
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_bulk_delete
+import aws_gp3_migration
+import aws_snapshot_delete
+from aws_paginate import chunks
+
+FORMAT_VERSION = 1
+# create_tags accepts at most this many resource IDs
+CREATE_TAGS_CHUNK = 1000
+# create_tags fails as a whole when one of the resources does not exist
+TAG_NOT_FOUND_CODES = {'InvalidAMIID.NotFound', 'InvalidInstanceID.NotFound',
+                       'InvalidSnapshot.NotFound', 'InvalidVolume.NotFound'}
+RESOURCE_ID = re.compile(r'\b[a-z]+-[0-9a-f]+\b')
+
+
+def create_tags(client, bucket, resource_ids, tags):
+    """
+    Add TAGS to all RESOURCE_IDS with calls rate-limited by BUCKET
+    (aws_bulk_delete.TokenBucket), return the IDs which do not exist.  The
+    missing resources named in the error are dropped and the rest is tagged
+    again, when the error names none the IDs are split in halves.
+    """
+    try:
+        aws_bulk_delete.rate_limited_call(bucket, client.create_tags, Resources=resource_ids, Tags=tags)
+        return []
+    except ClientError as err:
+        if err.response.get('Error', {}).get('Code') not in TAG_NOT_FOUND_CODES:
+            raise
+        named = set(RESOURCE_ID.findall(err.response.get('Error', {}).get('Message') or ''))
+    if len(resource_ids) == 1:
+        return list(resource_ids)
+    gone = [resource_id for resource_id in resource_ids if resource_id in named]
+    if gone:
+        rest = [resource_id for resource_id in resource_ids if resource_id not in named]
+        return gone + (create_tags(client, bucket, rest, tags) if rest else [])
+    half = len(resource_ids) // 2
+    return (create_tags(client, bucket, resource_ids[:half], tags)
+            + create_tags(client, bucket, resource_ids[half:], tags))
+
+
+# action name: function(client, resource_id, **args), create_tags is batched,
+# modify_volume is run by aws_gp3_migration and snapshot_and_delete_volume
+# by aws_snapshot_delete
+ACTIONS = {
+    'deregister_image': aws_bulk_delete.deregister_image,
+    'delete_snapshot': aws_bulk_delete.delete_snapshot,
+    'delete_volume': aws_bulk_delete.delete_volume,
+}
+# run by their own engines instead of BulkDeleter
+ENGINE_ACTIONS = {'create_tags', 'modify_volume', 'snapshot_and_delete_volume'}
+
+# the actions of a later phase start once the earlier phases are done,
+# snapshots can not be deleted while a registered AMI still uses them
+PHASES = {
+    'deregister_image': 0,
+    'delete_snapshot': 1,
+    'snapshot_and_delete_volume': 2,
+}
+
+
+def _phase(item):
+    return PHASES.get(item['action'], 0)
+
+
+def add_plan_argument(parser):
+    """
+    Add the --plan option to the argparse PARSER
+    """
+    parser.add_argument('--plan', metavar='FILE',
+                        help='do not change anything, write the planned actions into FILE'
+                             ' to be executed later by "aws_plan.py apply FILE"')
+
+
+class Plan:
+    """
+    Actions collected by the read-only phase of a script.  With INVENTORY
+    (aws_inventory.Inventory), the savings of deletions are estimated from
+    the cached resource sizes.
+    """
+
+    def __init__(self, path, script=None, inventory=None):
+        self.path = path
+        self.script = script or sys.argv[0]
+        self.inventory = inventory
+        self.actions = []
+        self._prices = None
+        self._prices_lock = threading.Lock()
+        self._sizes = {}  # (region, kind): {resource_id: size}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args, inventory=None):
+        """ The plan requested by --plan, None when the script should act """
+        if not args.plan:
+            return None
+        return cls(args.plan, inventory=inventory)
+
+    @property
+    def prices(self):
+        """ aws_prices.PriceTable, loaded on first use """
+        if self._prices is None:
+            # pylint: disable=import-outside-toplevel
+            import aws_prices
+            self._prices = aws_prices.PriceTable()
+        return self._prices
+
+    def _price(self, method, *args):
+        # the regions are planned from threads, load the offer file just once
+        with self._prices_lock:
+            try:
+                return getattr(self.prices, method)(*args)
+            except ValueError:
+                return 0
+
+    def _size(self, region, kind, resource_id):
+        if self.inventory is None:
+            return None
+        key = (region, kind)
+        if key not in self._sizes:
+            if kind == 'volumes':
+                sizes = {volume['VolumeId']: (volume['Size'], volume['VolumeType'])
+                         for volume in self.inventory.volumes(region)}
+            else:
+                sizes = {snapshot['SnapshotId']: (snapshot['VolumeSize'], None)
+                         for snapshot in self.inventory.snapshots(region)}
+            self._sizes[key] = sizes
+        return self._sizes[key].get(resource_id)
+
+    def volume_monthly(self, region, volume_type, size):
+        """ Monthly price of a SIZE GiB volume """
+        return self._price('ebs_volume_monthly', volume_type, region) * size
+
+    def iops_monthly(self, region, volume_type, iops):
+        """ Monthly price of IOPS provisioned IOPS """
+        return self._price('ebs_iops_monthly', volume_type, region) * iops
+
+    def snapshot_monthly(self, region, size):
+        """ Monthly price of a SIZE GB snapshot (upper bound, snapshots are incremental) """
+        return self._price('ebs_snapshot_monthly', region) * size
+
+    def estimate(self, region, action, resource_id):
+        """
+        Estimated monthly savings of ACTION, 0 when unknown
+        """
+        if action == 'delete_snapshot':
+            size = self._size(region, 'snapshots', resource_id)
+            return self.snapshot_monthly(region, size[0]) if size else 0
+        if action in ('delete_volume', 'snapshot_and_delete_volume'):
+            size = self._size(region, 'volumes', resource_id)
+            if not size:
+                return 0
+            savings = self.volume_monthly(region, size[1], size[0])
+            if action == 'snapshot_and_delete_volume':
+                savings -= self.snapshot_monthly(region, size[0])
+            return savings
+        return 0
+
+    def add(self, region, action, resource_id, args=None, description='', savings=None):
+        """
+        Plan ACTION(client, RESOURCE_ID, **ARGS) in REGION, SAVINGS are
+        estimated when not specified
+        """
+        if savings is None:
+            savings = self.estimate(region, action, resource_id)
+        with self.lock:
+            self.actions.append({'region': region, 'action': action, 'id': resource_id,
+                                 'args': args or {}, 'description': description,
+                                 'savings': round(savings, 4)})
+
+    def summary(self):
+        """ Return ({action: count}, total monthly savings) """
+        counts = {}
+        for item in self.actions:
+            counts[item['action']] = counts.get(item['action'], 0) + 1
+        return counts, round(sum(item['savings'] for item in self.actions), 2)
+
+    def write(self):
+        """
+        Store the plan into its file and print the summary
+        """
+        self.actions.sort(key=lambda item: (item['region'], _phase(item), item['action'], item['id']))
+        counts, savings = self.summary()
+        header = {'version': FORMAT_VERSION, 'script': self.script,
+                  'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                  'counts': counts, 'savings': savings}
+        with open(self.path, "w", encoding="utf8") as file:
+            file.write(json.dumps(header) + "\n")
+            for item in self.actions:
+                file.write(json.dumps(item) + "\n")
+        if self._prices is not None:
+            self._prices.save()
+        print(f"Plan with {len(self.actions)} actions written to {self.path}")
+        print_summary(counts, savings)
+
+    @classmethod
+    def load(cls, path):
+        """ Read the plan file written by write() """
+        with open(path, "r", encoding="utf8") as file:
+            header = json.loads(file.readline())
+            if header.get('version') != FORMAT_VERSION:
+                raise ValueError(f"Unsupported plan version {header.get('version')} in {path}")
+            plan = cls(path, script=header['script'])
+            plan.actions = [json.loads(line) for line in file if line.strip()]
+        return plan
+
+
+def print_summary(counts, savings):
+    """ Print the counts of actions and the savings """
+    for action, count in sorted(counts.items()):
+        print(f"  {action}: {count}")
+    print(f"  Estimated savings: ${savings:.2f} per month")
+
+
+def _units(actions):
+    """
+    Turn the plan ACTIONS (of ACTIONS) into {region: [(unit_id, description)]}
+    and {unit_id: function(client)}
+    """
+    regions = {}
+    functions = {}
+    for item in actions:
+        unit_id = f"{item['action']}:{item['id']}"
+        action, resource_id, kwargs = ACTIONS[item['action']], item['id'], item['args']
+        functions[unit_id] = (lambda client, action=action, resource_id=resource_id, kwargs=kwargs:
+                              action(client, resource_id, **kwargs))
+        regions.setdefault(item['region'], []).append((unit_id, item['description']))
+    return regions, functions
+
+
+def _tag_units(actions):
+    """
+    Batch the create_tags ACTIONS with the same tags, return
+    {region: [(unit_id, description)]} and {unit_id: (resource_ids, tags)}
+    """
+    tag_batches = {}
+    for item in actions:
+        key = (item['region'], json.dumps(item['args']['Tags'], sort_keys=True))
+        tag_batches.setdefault(key, []).append(item['id'])
+
+    regions = {}
+    batches = {}
+    for (region, tags), resource_ids in tag_batches.items():
+        tags = json.loads(tags)
+        for chunk in chunks(resource_ids, CREATE_TAGS_CHUNK):
+            unit_id = f"create_tags:{chunk[0]}+{len(chunk) - 1}"
+            batches[unit_id] = (chunk, tags)
+            description = ", ".join(f"{tag['Key']}={tag['Value']}" for tag in tags)
+            regions.setdefault(region, []).append((unit_id, f"({description})"))
+    return regions, batches
+
+
+class Tagger(aws_bulk_delete.BulkDeleter):
+    """
+    BulkDeleter applying the create_tags BATCHES ({unit_id: (resource_ids,
+    tags)}), a batch is done once all its existing resources are tagged
+    """
+    def __init__(self, batches, **kwargs):
+        super().__init__(create_tags, verb="Applied", **kwargs)
+        self.batches = batches
+
+    def _delete(self, client, bucket, region, action, resource_id, description):
+        resource_ids, tags = self.batches[resource_id]
+        try:
+            gone = action(client, bucket, resource_ids, tags)
+        except (BotoCoreError, ClientError) as err:
+            print(f"  Error applying {resource_id} in {region}: {err}")
+            self._count('failed')
+            return False
+        except aws_bulk_delete.StillThrottled:
+            print(f"  Giving up on {resource_id} in {region}, still throttled")
+            self._count('failed')
+            return False
+        print(f"  {self.verb} {resource_id} {description} in {region}")
+        if gone:
+            print(f"  Not tagged, do not exist anymore: {' '.join(gone)}")
+        self.checkpoint.add(region, resource_id)
+        self._count('deleted')
+        return True
+
+
+def apply(plan, args):
+    """
+    Execute PLAN concurrently with the aws_bulk_delete options in ARGS, one
+    phase after another
+    """
+    stats = {'deleted': 0, 'failed': 0, 'skipped': 0, 'unfinished': 0}
+    for phase in sorted({_phase(item) for item in plan.actions}):
+        items = [item for item in plan.actions if _phase(item) == phase]
+        print(f"Phase {phase}:")
+        if phase == PHASES['snapshot_and_delete_volume']:
+            # polls all snapshots of a region at once instead of blocking
+            # one worker per volume until its snapshot is completed
+            volumes = {}
+            for item in items:
+                volumes.setdefault(item['region'], []).append(item['id'])
+            runner = aws_snapshot_delete.SnapshotAndDelete(
+                workers=args.workers, rate=args.rate, checkpoint=args.checkpoint,
+                dry_run=args.dry_run)
+            _add(stats, runner.run(volumes))
+            continue
+
+        tags = [item for item in items if item['action'] == 'create_tags']
+        if tags:
+            regions, batches = _tag_units(tags)
+            tagger = Tagger(batches, checkpoint=args.checkpoint, rate=args.rate,
+                            workers=args.workers, dry_run=args.dry_run)
+            _add(stats, tagger.run(sorted(regions), regions.get))
+        modifications = {}
+        for item in items:
+            if item['action'] == 'modify_volume':
+                modifications.setdefault(item['region'], []).append(
+                    (item['id'], item['args'], item['description']))
+        if modifications:
+            # polls the modifications and caps the running ones like gp2-to-gp3.py
+            migration = aws_gp3_migration.Migration(
+                workers=args.workers, rate=args.rate, checkpoint=args.checkpoint,
+                dry_run=args.dry_run)
+            _add(stats, migration.run(modifications))
+        others = [item for item in items if item['action'] not in ENGINE_ACTIONS]
+        if others:
+            regions, functions = _units(others)
+            deleter = aws_bulk_delete.BulkDeleter(
+                lambda client, unit_id, functions=functions: functions[unit_id](client),
+                checkpoint=args.checkpoint, rate=args.rate, workers=args.workers,
+                dry_run=args.dry_run, verb="Applied")
+            _add(stats, deleter.run(sorted(regions), regions.get))
+    return stats
+
+
+def _add(stats, phase_stats):
+    for what, count in phase_stats.items():
+        stats[what] = stats.get(what, 0) + count
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Show or apply a plan written with --plan.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    show = subparsers.add_parser("show", help="print the summary of the plan")
+    show.add_argument("plan")
+    applier = subparsers.add_parser("apply", help="execute the plan")
+    applier.add_argument("plan")
+    aws_bulk_delete.add_arguments(applier)
+    args = parser.parse_args()
+
+    plan = Plan.load(args.plan)
+    counts, savings = plan.summary()
+    print(f"Plan {args.plan} by {plan.script}:")
+    print_summary(counts, savings)
+    if args.command == "show":
+        return 0
+    stats = apply(plan, args)
+    return 1 if stats['failed'] or stats['unfinished'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
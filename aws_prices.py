@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+"""
+On-disk table of EC2 prices.
+
+Loading the AmazonEC2 offer file with awspricing takes minutes, while
+get_current_usage.py needs just a few hundred (region, type) prices.  Those
+are stored in a small JSON file and the offer file is only loaded when the
+table misses a price.  The table is dropped when it gets older than
+MAX_AGE or when FORMAT_VERSION changes.
+
+Spot prices change all the time, SpotPrices therefore keeps them only in
+memory for one run.
+"""
+
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import awspricing
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+from aws_inventory import CACHE_DIR
+from aws_paginate import paginate
+
+PRICE_TABLE_PATH = os.path.join(CACHE_DIR, "prices.json")
+FORMAT_VERSION = 1
+# AWS changes prices rarely
+MAX_AGE = 30 * 24 * 3600
+
+
+class PriceTable:
+    """
+    Drop-in replacement for the awspricing EC2 offer methods used by our
+    scripts.  A failed lookup is remembered too and raises ValueError.
+    """
+
+    def __init__(self, path=PRICE_TABLE_PATH, max_age=MAX_AGE):
+        self.path = path
+        self.created = time.time()
+        self.prices = {}
+        self._offer = None
+        self._dirty = False
+        try:
+            with open(path, "r", encoding="utf8") as file:
+                data = json.load(file)
+            if data["version"] == FORMAT_VERSION and self.created - data["created"] < max_age:
+                self.created = data["created"]
+                self.prices = data["prices"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @property
+    def offer(self):
+        """ The awspricing EC2 offer, loaded on first use """
+        if self._offer is None:
+            print("Loading AmazonEC2 offer file...")
+            self._offer = awspricing.offer('AmazonEC2')
+        return self._offer
+
+    def _lookup(self, key, compute):
+        if key not in self.prices:
+            try:
+                self.prices[key] = compute()
+            except (ValueError, AttributeError):
+                self.prices[key] = None
+            self._dirty = True
+        price = self.prices[key]
+        if price is None:
+            raise ValueError(f"No price for {key}")
+        return price
+
+    def ondemand_hourly(self, instance_type, region, operating_system='Linux'):
+        """ Hourly on-demand price of the instance type """
+        return self._lookup(
+            f"ondemand|{region}|{instance_type}|{operating_system}",
+            lambda: self.offer.ondemand_hourly(instance_type=instance_type, region=region,
+                                               operating_system=operating_system))
+
+    def ebs_volume_monthly(self, volume_type, region):
+        """ Monthly price of one GiB of the volume type """
+        return self._lookup(
+            f"volume|{region}|{volume_type}",
+            lambda: self.offer.ebs_volume_monthly(volume_type=volume_type, region=region))
+
+    def ebs_iops_monthly(self, volume_type, region):
+        """ Monthly price of one provisioned IOPS of the volume type """
+        return self._lookup(
+            f"iops|{region}|{volume_type}",
+            lambda: self.offer.ebs_iops_monthly(volume_type=volume_type, region=region))
+
+    def ebs_snapshot_monthly(self, region, archive=False):
+        """ Monthly price of one GB of snapshot """
+        return self._lookup(
+            f"snapshot|{region}|{archive}",
+            lambda: self.offer.ebs_snapshot_monthly(region=region, archive=archive))
+
+    def save(self):
+        """
+        Store the table if new prices were looked up
+        """
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as file:
+            json.dump({"version": FORMAT_VERSION, "created": self.created,
+                       "prices": self.prices}, file)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def _average(prices):
+    return sum(prices) / len(prices)
+
+
+class SpotPrices:
+    """
+    Hourly spot prices per region.  The price of an instance type is the
+    average SpotPrice of our active spot requests, or the current average
+    across availability zones from the spot price history when we have no
+    active request of that type.
+    """
+
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self.requests = {}  # region: {instance_type: price}
+        self.history = {}  # (region, instance_type): price or None
+        # one session and one client per region, like aws_inventory.Inventory,
+        # every new session loads the EC2 service model again
+        self._session = boto3.session.Session()
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _client(self, region):
+        with self._clients_lock:
+            if region not in self._clients:
+                self._clients[region] = self._session.client('ec2', region_name=region)
+            return self._clients[region]
+
+    def _fetch_requests(self, region):
+        client = self._client(region)
+        prices = {}
+        try:
+            for request in paginate(client, 'describe_spot_instance_requests', 'SpotInstanceRequests',
+                                    Filters=[{'Name': 'state', 'Values': ['active']}]):
+                instance_type = request['LaunchSpecification']['InstanceType']
+                prices.setdefault(instance_type, []).append(float(request['SpotPrice']))
+        except (BotoCoreError, ClientError) as err:
+            print(f"Can not get spot requests in {region}: {err}")
+        return {instance_type: _average(values) for instance_type, values in prices.items()}
+
+    def _fetch_history(self, region, instance_type):
+        client = self._client(region)
+        try:
+            prices = [float(item['SpotPrice']) for item in paginate(
+                client, 'describe_spot_price_history', 'SpotPriceHistory',
+                InstanceTypes=[instance_type],
+                ProductDescriptions=['Linux/UNIX'],
+                StartTime=datetime.now(timezone.utc))]
+        except (BotoCoreError, ClientError) as err:
+            print(f"Can not get spot price history of {instance_type} in {region}: {err}")
+            return None
+        return _average(prices) if prices else None
+
+    def prefetch(self, regions):
+        """
+        Load the active spot requests of all REGIONS in parallel
+        """
+        regions = [region for region in regions if region not in self.requests]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for region, prices in zip(regions, executor.map(self._fetch_requests, regions)):
+                self.requests[region] = prices
+
+    def hourly(self, region, instance_type):
+        """
+        Hourly spot price of INSTANCE_TYPE in REGION, ValueError if unknown
+        """
+        if region not in self.requests:
+            self.requests[region] = self._fetch_requests(region)
+        if instance_type in self.requests[region]:
+            return self.requests[region][instance_type]
+        key = (region, instance_type)
+        if key not in self.history:
+            self.history[key] = self._fetch_history(region, instance_type)
+        if self.history[key] is None:
+            raise ValueError(f"No spot price for {instance_type} in {region}")
+        return self.history[key]
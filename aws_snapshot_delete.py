@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+"""
+Back EC2 volumes up into snapshots and delete them.
+
+Used by snapshot-and-delete-volume.py and by aws_plan.py to apply the
+snapshot_and_delete_volume actions:
+
+    stats = SnapshotAndDelete(checkpoint='volumes.done').run({region: [volume_id, ...]})
+
+The regions are processed in parallel.  In one region the snapshots are
+created by a pool of workers, then all pending snapshots are polled with one
+describe_snapshots call per POLL_BATCH snapshots and every volume is deleted
+only once its snapshot is 'completed'.
+
+Running it again for the same volumes is safe: a garbage-collector snapshot
+of the volume started in the last REUSE_AGE is used instead of creating a
+new one, volumes which are gone already count as deleted and with a
+checkpoint the deleted volumes are skipped.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_bulk_delete
+from aws_paginate import chunks, paginate
+
+SNAPSHOT_TAGS = [{'Key': 'FedoraGroup', 'Value': 'garbage-collector'}]
+DEFAULT_TIMEOUT = 4 * 3600
+POLL_BATCH = 200
+POLL_INTERVAL = 30
+REGION_WORKERS = 8
+# a snapshot of the volume taken by an earlier, interrupted run
+REUSE_AGE = timedelta(days=1)
+
+# too many snapshots are being created, wait like for throttling
+RETRY_CODES = {'SnapshotCreationPerVolumeRateExceeded', 'ConcurrentSnapshotLimitExceeded'}
+
+
+def snapshot_description(volume_id):
+    """ Description of the snapshot of VOLUME_ID """
+    return f'GC - Snapshot of {volume_id}'
+
+
+class SnapshotAndDelete:
+    """
+    Snapshot volumes and delete them once their snapshots are completed
+    """
+    def __init__(self, workers=aws_bulk_delete.WORKERS_PER_REGION, rate=aws_bulk_delete.DEFAULT_RATE,
+                 timeout=DEFAULT_TIMEOUT, checkpoint=None, dry_run=False):
+        self.workers = workers
+        self.rate = rate
+        self.deadline = time.monotonic() + timeout
+        self.checkpoint = aws_bulk_delete.Checkpoint(checkpoint)
+        self.dry_run = dry_run
+        self.stats = {'deleted': 0, 'failed': 0, 'skipped': 0, 'unfinished': 0}
+        self.lock = threading.Lock()
+
+    def _count(self, what, count=1):
+        with self.lock:
+            self.stats[what] += count
+
+    def _call(self, bucket, region, volume_id, method, **kwargs):
+        """
+        Rate-limited METHOD call for VOLUME_ID, None on failure
+        """
+        try:
+            response = aws_bulk_delete.rate_limited_call(bucket, method, retry_codes=RETRY_CODES, **kwargs)
+        except (BotoCoreError, ClientError) as err:
+            print(f"  Error processing volume {volume_id} in {region}: {err}")
+            return None
+        except aws_bulk_delete.StillThrottled:
+            print(f"  Giving up on volume {volume_id} in {region}, still throttled")
+            return None
+        return response or {}
+
+    def _existing(self, client, region, volume_ids):
+        """
+        Return {volume_id: snapshot_id} of the recent, not failed snapshots
+        an earlier run created for VOLUME_IDS
+        """
+        since = datetime.now(timezone.utc) - REUSE_AGE
+        existing = {}
+        for chunk in chunks(volume_ids, POLL_BATCH):
+            filters = [{'Name': 'volume-id', 'Values': chunk},
+                       {'Name': f"tag:{SNAPSHOT_TAGS[0]['Key']}", 'Values': [SNAPSHOT_TAGS[0]['Value']]},
+                       {'Name': 'status', 'Values': ['pending', 'completed']}]
+            try:
+                snapshots = list(paginate(client, 'describe_snapshots', 'Snapshots',
+                                          OwnerIds=['self'], Filters=filters))
+            except (BotoCoreError, ClientError) as err:
+                print(f"  Can not look existing snapshots up in {region}: {err}")
+                continue
+            for snapshot in sorted(snapshots, key=lambda snapshot: snapshot['StartTime']):
+                if (snapshot['StartTime'] >= since
+                        and snapshot.get('Description') == snapshot_description(snapshot['VolumeId'])):
+                    existing[snapshot['VolumeId']] = snapshot['SnapshotId']
+        return existing
+
+    def _snapshot(self, client, bucket, region, volume_id):
+        response = self._call(
+            bucket, region, volume_id, client.create_snapshot,
+            VolumeId=volume_id,
+            Description=snapshot_description(volume_id),
+            TagSpecifications=[{'ResourceType': 'snapshot', 'Tags': SNAPSHOT_TAGS}])
+        if response is None:
+            self._count('failed')
+            return None
+        print(f"  Created snapshot {response['SnapshotId']} of {volume_id} in {region}")
+        return response['SnapshotId']
+
+    def _delete(self, client, bucket, region, volume_id):
+        try:
+            aws_bulk_delete.rate_limited_call(bucket, client.delete_volume, VolumeId=volume_id)
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') not in aws_bulk_delete.NOT_FOUND_CODES:
+                print(f"  Error processing volume {volume_id} in {region}: {err}")
+                self._count('failed')
+                return
+        except BotoCoreError as err:
+            print(f"  Error processing volume {volume_id} in {region}: {err}")
+            self._count('failed')
+            return
+        except aws_bulk_delete.StillThrottled:
+            print(f"  Giving up on volume {volume_id} in {region}, still throttled")
+            self._count('failed')
+            return
+        else:
+            print(f"  Deleted the original volume {volume_id} in {region}")
+        self.checkpoint.add(region, volume_id)
+        self._count('deleted')
+
+    def _poll(self, client, region, snapshot_ids):
+        """
+        Return {snapshot_id: state} of the SNAPSHOT_IDS which are not pending,
+        the state of the snapshots deleted meanwhile is 'missing'
+        """
+        finished = {}
+        for chunk in chunks(snapshot_ids, POLL_BATCH):
+            # with SnapshotIds, one deleted snapshot fails the whole call
+            try:
+                snapshots = list(paginate(client, 'describe_snapshots', 'Snapshots', OwnerIds=['self'],
+                                          Filters=[{'Name': 'snapshot-id', 'Values': chunk}]))
+            except (BotoCoreError, ClientError) as err:
+                print(f"  Can not poll snapshots in {region}: {err}")
+                continue
+            for snapshot_id in set(chunk) - {snapshot['SnapshotId'] for snapshot in snapshots}:
+                finished[snapshot_id] = 'missing'
+            for snapshot in snapshots:
+                if snapshot['State'] != 'pending':
+                    finished[snapshot['SnapshotId']] = snapshot['State']
+        return finished
+
+    def process_region(self, region, volume_ids):
+        """
+        Snapshot and delete VOLUME_IDS in REGION
+        """
+        todo = [volume_id for volume_id in volume_ids if (region, volume_id) not in self.checkpoint]
+        self._count('skipped', len(volume_ids) - len(todo))
+        print(f"Region {region}: {len(todo)} volumes")
+        if self.dry_run:
+            for volume_id in todo:
+                print(f"  Would snapshot and delete {volume_id} in {region}")
+            return
+
+        client = boto3.session.Session().client('ec2', region_name=region)
+        bucket = aws_bulk_delete.TokenBucket(self.rate)
+        existing = self._existing(client, region, todo)
+        for volume_id, snapshot_id in sorted(existing.items()):
+            print(f"  Using snapshot {snapshot_id} of {volume_id} in {region} from an earlier run")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            new = [volume_id for volume_id in todo if volume_id not in existing]
+            created = executor.map(lambda volume_id: self._snapshot(client, bucket, region, volume_id),
+                                   new)
+            pending = {snapshot_id: volume_id for volume_id, snapshot_id in existing.items()}
+            pending.update({snapshot_id: volume_id
+                            for volume_id, snapshot_id in zip(new, created) if snapshot_id})
+            deletions = []
+            while pending and time.monotonic() < self.deadline:
+                time.sleep(POLL_INTERVAL)
+                for snapshot_id, state in self._poll(client, region, sorted(pending)).items():
+                    volume_id = pending.pop(snapshot_id)
+                    if state == 'completed':
+                        deletions.append(executor.submit(self._delete, client, bucket, region, volume_id))
+                    else:
+                        print(f"  Snapshot {snapshot_id} of {volume_id} in {region} is {state},"
+                              " keeping the volume")
+                        self._count('failed')
+            for future in deletions:
+                future.result()
+
+        if pending:
+            print(f"Region {region}: timeout, {len(pending)} snapshots still pending,"
+                  " their volumes were kept")
+            self._count('unfinished', len(pending))
+
+    def run(self, volumes):
+        """
+        Process VOLUMES ({region: [volume_id, ...]}) in parallel, return the statistics
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=REGION_WORKERS) as executor:
+                futures = [executor.submit(self.process_region, region, volume_ids)
+                           for region, volume_ids in volumes.items()]
+                for future in futures:
+                    future.result()
+        finally:
+            self.checkpoint.close()
+        print(f"Deleted: {self.stats['deleted']}, failed: {self.stats['failed']},"
+              f" unfinished: {self.stats['unfinished']},"
+              f" skipped (checkpoint): {self.stats['skipped']}")
+        return self.stats
@@ -0,0 +1,421 @@
+#!/usr/bin/python3
+"""
+Fix tags of newly created resources from EC2 API events.
+
+fix-testing-farm-tags.py and copy-tags-from-instance-to-volume.py sweep whole
+regions, this reads the RunInstances, CreateVolume and AttachVolume events
+instead and only looks at the resources they mention, so the work grows with
+the event rate and not with the size of the fleet:
+
+    $ aws_tag_events.py cloudtrail/2026/10/17/           # directory of *.json files
+    $ aws_tag_events.py events.jsonl --dry-run
+    $ some-eventbridge-consumer | aws_tag_events.py
+
+The events are CloudTrail records, either alone, in a JSON list, in a
+CloudTrail log file ({"Records": [...]}) or wrapped in an EventBridge "AWS API
+Call via CloudTrail" event, one JSON document per file or per line.
+
+The same rules as in the sweeping scripts apply:
+
+* an autoscaler instance (k8s.io/cluster-autoscaler/enabled=true) without
+  FedoraGroup gets FedoraGroup=CI,
+* a volume without FedoraGroup attached to an instance with FedoraGroup gets
+  the value of the instance.
+
+The events come within seconds of RunInstances, when the instance is often
+still pending and AWS does not list its root volume yet.  Pending instances
+are not tagged, their events are processed again every PENDING_RETRY
+seconds until the instances run (or PENDING_TIMEOUT passes), because once
+the instance has its tag the sweeping scripts skip it and its root volume
+would stay untagged.
+
+The current tags and attachments of the mentioned resources are looked up
+with one describe call per region and 200 resources.  The events are
+processed in batches of --batch events, a batch is processed sooner when its
+first event waits for --flush seconds, so the tags of new resources are
+fixed within seconds also from a slow stream.  With --offline only the
+data in the events is used and AWS is not contacted at all, that is how
+recorded events can be replayed for testing.
+"""
+
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws_plan
+from aws_paginate import chunks, paginate
+
+AUTOSCALER_TAG_KEY = "k8s.io/cluster-autoscaler/enabled"
+AUTOSCALER_TAG_VALUE = "true"
+GROUP_TAG_KEY = "FedoraGroup"
+AUTOSCALER_GROUP = "CI"
+
+EVENT_NAMES = {"RunInstances", "CreateVolume", "AttachVolume"}
+DEFAULT_BATCH = 100
+# a batch is processed at the latest this many seconds after its first event
+DEFAULT_FLUSH = 2
+# EC2 filters accept at most 200 values
+LOOKUP_BATCH = 200
+# the events of pending instances are processed again after this many seconds
+PENDING_RETRY = 15
+# ... unless the instance is pending for longer than this
+PENDING_TIMEOUT = timedelta(minutes=10)
+
+
+def _records(document):
+    """
+    Yield the CloudTrail records from one parsed JSON DOCUMENT
+    """
+    if isinstance(document, list):
+        for item in document:
+            yield from _records(item)
+    elif "Records" in document:
+        yield from document["Records"]
+    elif "detail" in document:
+        yield document["detail"]
+    else:
+        yield document
+
+
+def _read_file(file):
+    text = file.read()
+    try:
+        yield from _records(json.loads(text))
+        return
+    except ValueError:
+        pass
+    # JSON lines
+    for line in text.splitlines():
+        if line.strip():
+            yield from _records(json.loads(line))
+
+
+def read_events(source):
+    """
+    Yield CloudTrail records from SOURCE, a file, a directory of *.json
+    and *.jsonl files or - for stdin (read line by line)
+    """
+    if source == "-":
+        for line in sys.stdin:
+            if line.strip():
+                yield from _records(json.loads(line))
+    elif os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith((".json", ".jsonl")):
+                with open(os.path.join(source, name), "r", encoding="utf8") as file:
+                    yield from _read_file(file)
+    else:
+        with open(source, "r", encoding="utf8") as file:
+            yield from _read_file(file)
+
+
+def _items(value):
+    """ CloudTrail wraps lists as {"items": [...]} """
+    if isinstance(value, dict):
+        return value.get("items", [])
+    return value or []
+
+
+def _event_tags(items):
+    return {tag["key"]: tag.get("value", "") for tag in _items(items)}
+
+
+def _requested_tags(record, resource_type):
+    tags = {}
+    for spec in _items((record.get("requestParameters") or {}).get("tagSpecificationSet")):
+        if spec.get("resourceType") == resource_type:
+            tags.update(_event_tags(spec.get("tags")))
+    return tags
+
+
+class RegionEvents:
+    """
+    Resources mentioned by the events of one region, with what the events
+    tell about them
+    """
+    def __init__(self):
+        self.instances = {}  # instance_id: (tags, {volume_id, ...})
+        self.volumes = {}  # volume_id: (tags, {instance_id, ...})
+        self.pending = {}  # instance_id: launch time, known only from AWS
+
+    def instance(self, instance_id):
+        """ The (tags, volumes) entry of INSTANCE_ID """
+        return self.instances.setdefault(instance_id, ({}, set()))
+
+    def volume(self, volume_id):
+        """ The (tags, instances) entry of VOLUME_ID """
+        return self.volumes.setdefault(volume_id, ({}, set()))
+
+    def attach(self, volume_id, instance_id):
+        """ Record VOLUME_ID is attached to INSTANCE_ID """
+        self.instance(instance_id)[1].add(volume_id)
+        self.volume(volume_id)[1].add(instance_id)
+
+
+def collect(records):
+    """
+    Return {region: RegionEvents} of the interesting, successful RECORDS
+    """
+    regions = {}
+    for record in records:
+        if record.get("eventName") not in EVENT_NAMES or record.get("errorCode"):
+            continue
+        events = regions.setdefault(record["awsRegion"], RegionEvents())
+        response = record.get("responseElements") or {}
+        if record["eventName"] == "RunInstances":
+            requested = _requested_tags(record, "instance")
+            for item in _items(response.get("instancesSet")):
+                tags, _ = events.instance(item["instanceId"])
+                tags.update(requested)
+                tags.update(_event_tags(item.get("tagSet")))
+                for mapping in _items(item.get("blockDeviceMapping")):
+                    if "ebs" in mapping and "volumeId" in mapping["ebs"]:
+                        events.attach(mapping["ebs"]["volumeId"], item["instanceId"])
+        elif record["eventName"] == "CreateVolume":
+            tags, _ = events.volume(response["volumeId"])
+            tags.update(_requested_tags(record, "volume"))
+            tags.update(_event_tags(response.get("tagSet")))
+        else:
+            params = record.get("requestParameters") or {}
+            events.attach(params["volumeId"], params["instanceId"])
+    return regions
+
+
+def _aws_tags(tags):
+    return {tag["Key"]: tag["Value"] for tag in tags}
+
+
+def lookup(client, events):
+    """
+    Replace the data from EVENTS (RegionEvents) by the current state of the
+    resources in AWS, resources which do not exist anymore are dropped
+    """
+    current = RegionEvents()
+    instance_ids = sorted(events.instances)
+    for chunk in chunks(instance_ids, LOOKUP_BATCH):
+        filters = [{"Name": "instance-id", "Values": chunk}]
+        for reservation in paginate(client, "describe_instances", "Reservations", Filters=filters):
+            for instance in reservation["Instances"]:
+                current.instance(instance["InstanceId"])[0].update(_aws_tags(instance.get("Tags", [])))
+                if instance["State"]["Name"] == "pending":
+                    current.pending[instance["InstanceId"]] = instance["LaunchTime"]
+                for mapping in instance.get("BlockDeviceMappings", []):
+                    if "Ebs" in mapping:
+                        current.attach(mapping["Ebs"]["VolumeId"], instance["InstanceId"])
+
+    volume_ids = sorted(set(events.volumes) | set(current.volumes))
+    for chunk in chunks(volume_ids, LOOKUP_BATCH):
+        filters = [{"Name": "volume-id", "Values": chunk}]
+        for volume in paginate(client, "describe_volumes", "Volumes", Filters=filters):
+            current.volume(volume["VolumeId"])[0].update(_aws_tags(volume.get("Tags", [])))
+            for attachment in volume.get("Attachments", []):
+                current.attach(volume["VolumeId"], attachment["InstanceId"])
+
+    # instances of the volumes attached before the events, with their tags
+    missing = sorted({instance_id for _, instances in current.volumes.values()
+                      for instance_id in instances} - set(events.instances))
+    for chunk in chunks(missing, LOOKUP_BATCH):
+        filters = [{"Name": "instance-id", "Values": chunk}]
+        for reservation in paginate(client, "describe_instances", "Reservations", Filters=filters):
+            for instance in reservation["Instances"]:
+                current.instance(instance["InstanceId"])[0].update(_aws_tags(instance.get("Tags", [])))
+    return current
+
+
+def decide(events):
+    """
+    Return {tag_value: [resource_id, ...]} of FedoraGroup tags to add to the
+    resources in EVENTS (RegionEvents), pending instances and their volumes
+    are left for later
+    """
+    groups = {}  # instance_id: FedoraGroup value, after the fix
+    to_tag = {}
+    for instance_id, (tags, _) in sorted(events.instances.items()):
+        if instance_id in events.pending:
+            continue
+        if GROUP_TAG_KEY in tags:
+            groups[instance_id] = tags[GROUP_TAG_KEY]
+        elif tags.get(AUTOSCALER_TAG_KEY) == AUTOSCALER_TAG_VALUE:
+            groups[instance_id] = AUTOSCALER_GROUP
+            to_tag.setdefault(AUTOSCALER_GROUP, []).append(instance_id)
+
+    for volume_id, (tags, instances) in sorted(events.volumes.items()):
+        if GROUP_TAG_KEY in tags:
+            continue
+        for instance_id in sorted(instances):
+            if instance_id in groups:
+                to_tag.setdefault(groups[instance_id], []).append(volume_id)
+                break
+    return to_tag
+
+
+def tag(client, region, to_tag, dry_run=False, plan=None):
+    """
+    Apply TO_TAG ({tag_value: [resource_id, ...]}), return the number of
+    tagged resources
+    """
+    tagged = 0
+    for value, resource_ids in to_tag.items():
+        tags = [{"Key": GROUP_TAG_KEY, "Value": value}]
+        for chunk in chunks(resource_ids, aws_plan.CREATE_TAGS_CHUNK):
+            if plan:
+                for resource_id in chunk:
+                    plan.add(region, "create_tags", resource_id, args={"Tags": tags})
+                continue
+            print(f"{'Would tag' if dry_run else 'Tagging'} {' '.join(chunk)} in {region}"
+                  f" with {GROUP_TAG_KEY}={value}")
+            if dry_run:
+                continue
+            try:
+                client.create_tags(Resources=chunk, Tags=tags)
+                tagged += len(chunk)
+            except (BotoCoreError, ClientError) as err:
+                print(f"Error tagging {' '.join(chunk)} in {region}: {err}")
+    return tagged
+
+
+def _mentions(record, region, instance_ids):
+    """ Is the RECORD about one of INSTANCE_IDS in REGION """
+    if record.get("awsRegion") != region:
+        return False
+    if record.get("eventName") == "RunInstances":
+        response = record.get("responseElements") or {}
+        return any(item["instanceId"] in instance_ids for item in _items(response.get("instancesSet")))
+    if record.get("eventName") == "AttachVolume":
+        return (record.get("requestParameters") or {}).get("instanceId") in instance_ids
+    return False
+
+
+def process(records, offline=False, dry_run=False, plan=None, deferred=None):
+    """
+    Fix the tags of the resources mentioned in RECORDS, return the number of
+    tagged resources.  The records of pending instances are appended to
+    DEFERRED (list) to be processed again later.
+    """
+    records = list(records)
+    tagged = 0
+    for region, events in sorted(collect(records).items()):
+        client = None
+        if not offline:
+            client = boto3.session.Session().client("ec2", region_name=region)
+            try:
+                events = lookup(client, events)
+            except (BotoCoreError, ClientError) as err:
+                print(f"Can not look resources up in {region}: {err}")
+                continue
+        tagged += tag(client, region, decide(events), dry_run=dry_run or offline, plan=plan)
+
+        since = datetime.now(timezone.utc) - PENDING_TIMEOUT
+        waiting = {instance_id for instance_id, launched in events.pending.items() if launched > since}
+        for instance_id in sorted(events.pending):
+            if instance_id not in waiting or deferred is None:
+                print(f"Instance {instance_id} in {region} is still pending, not tagged")
+        if waiting and deferred is not None:
+            deferred.extend(record for record in records if _mentions(record, region, waiting))
+    return tagged
+
+
+_END = object()
+
+
+def _batches(records, size, flush=DEFAULT_FLUSH, deferred=None):
+    """
+    Yield lists of at most SIZE RECORDS, a shorter batch is yielded when
+    FLUSH seconds passed since its first record, so a slow stream of events
+    is not held back.  The records the consumer appends to DEFERRED (list)
+    are yielded again PENDING_RETRY seconds later, also after the end of
+    RECORDS.
+    """
+    if deferred is None:
+        deferred = []
+    records_queue = queue.Queue(maxsize=2 * size)
+
+    def feed():
+        try:
+            for record in records:
+                records_queue.put(record)
+        except Exception as err:  # pylint: disable=broad-except
+            records_queue.put(err)
+        records_queue.put(_END)
+    threading.Thread(target=feed, daemon=True).start()
+
+    batch = []
+    deadline = None
+    retry_at = None
+    while True:
+        if deferred and retry_at is None:
+            retry_at = time.monotonic() + PENDING_RETRY
+        wakeups = ([deadline] if batch else []) + ([retry_at] if retry_at else [])
+        timeout = max(0, min(wakeups) - time.monotonic()) if wakeups else None
+        try:
+            record = records_queue.get(timeout=timeout)
+        except queue.Empty:
+            record = None
+        if record is _END:
+            break
+        if isinstance(record, Exception):
+            raise record
+        if record is not None:
+            if not batch:
+                deadline = time.monotonic() + flush
+            batch.append(record)
+        if retry_at and time.monotonic() >= retry_at:
+            batch = deferred + batch
+            deferred.clear()
+            retry_at = None
+        elif not batch or (len(batch) < size and time.monotonic() < deadline):
+            continue
+        yield batch
+        batch = []
+
+    if batch:
+        yield batch
+    while deferred:
+        time.sleep(max(0, (retry_at or time.monotonic() + PENDING_RETRY) - time.monotonic()))
+        batch = list(deferred)
+        deferred.clear()
+        retry_at = None
+        yield batch
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Fix FedoraGroup tags from EC2 CloudTrail events.")
+    parser.add_argument("sources", nargs="*", default=["-"], metavar="SOURCE",
+                        help="event file, directory or - for stdin (default: -)")
+    parser.add_argument("--batch", type=int, default=DEFAULT_BATCH,
+                        help=f"process events in batches of this size (default: {DEFAULT_BATCH})")
+    parser.add_argument("--flush", type=float, default=DEFAULT_FLUSH, metavar="SECONDS",
+                        help="process a smaller batch when its first event is this old"
+                             f" (default: {DEFAULT_FLUSH})")
+    parser.add_argument("--offline", action="store_true",
+                        help="use only the data in the events, do not contact AWS (implies --dry-run)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print what would be tagged")
+    aws_plan.add_plan_argument(parser)
+    args = parser.parse_args()
+    plan = aws_plan.Plan.from_args(args)
+
+    records = (record for source in args.sources for record in read_events(source))
+    tagged = 0
+    deferred = [] if not args.offline else None
+    for batch in _batches(records, args.batch, args.flush, deferred):
+        tagged += process(batch, offline=args.offline, dry_run=args.dry_run, plan=plan,
+                          deferred=deferred)
+        sys.stdout.flush()
+    if plan:
+        plan.write()
+    elif not (args.offline or args.dry_run):
+        print(f"Tagged {tagged} resources")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
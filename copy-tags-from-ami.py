@@ -8,88 +8,121 @@ associated snapshot does not have this tag, then it will add the tag
 "FedoraGroup" to the snapshot with the value that has the AMI?
 """
 
+import argparse
+import aws_inventory
+import aws_plan
 import boto3
-import progressbar
 import sys
 
-def tag_snapshot_if_missing(ec2_client, snapshot_id, tag_key, tag_value):
+from aws_paginate import chunks
+
+def find_missing_tags(images, snapshots, tag_key):
     """
-    Check if a snapshot has a given tag, and if not, tag it with the provided key and value.
+    Diff the AMI tag_key values against the SNAPSHOTS tags.  Return
+    ({tag_value: [snapshot_id, ...]}, number of AMI snapshots checked).
     """
-    try:
-        # Retrieve the snapshot details
-        response = ec2_client.describe_snapshots(SnapshotIds=[snapshot_id])
-        snapshot = response['Snapshots'][0]
-        existing_tags = {tag['Key']: tag['Value'] for tag in snapshot.get('Tags', [])}
-        
-        if tag_key not in existing_tags:
-            print(f"Tagging snapshot {snapshot_id} with {tag_key}: {tag_value}")
-            ec2_client.create_tags(
-                Resources=[snapshot_id],
-                Tags=[{'Key': tag_key, 'Value': tag_value}]
-            )
-        else:
-            pass
-            #print(f"Snapshot {snapshot_id} already has tag {tag_key} with value {existing_tags[tag_key]}")
-    except Exception as e:
-        print(f"Error processing snapshot {snapshot_id}: {e}")
+    snapshot_tags = {snapshot['SnapshotId']: {tag['Key'] for tag in snapshot.get('Tags', [])}
+                     for snapshot in snapshots}
+    to_tag = {}
+    checked = 0
+    for image in images:
+        image_id = image.get('ImageId')
+        # Extract the FedoraGroup tag value from the AMI
+        tag_value = None
+        for tag in image.get('Tags', []):
+            if tag['Key'] == tag_key:
+                tag_value = tag['Value']
+                break
+
+        if not tag_value:
+            continue  # Skip AMIs without the tag
+
+        # Iterate over the block device mappings to check for associated snapshots
+        for mapping in image.get('BlockDeviceMappings', []):
+            ebs = mapping.get('Ebs')
+            if not ebs or 'SnapshotId' not in ebs:
+                continue
+            snapshot_id = ebs['SnapshotId']
+            checked += 1
+            if snapshot_id not in snapshot_tags:
+                print(f"Snapshot {snapshot_id} of {image_id} is not owned by us, skipping")
+                continue
+            if tag_key in snapshot_tags[snapshot_id] or snapshot_id in to_tag:
+                continue
+            to_tag[snapshot_id] = tag_value
+
+    missing = {}
+    for snapshot_id, tag_value in to_tag.items():
+        missing.setdefault(tag_value, []).append(snapshot_id)
+    return missing, checked
 
-def process_region(region):
+def process_region(inventory, region, plan=None):
     """
     For a given region, find AMIs with the tag 'FedoraGroup' and ensure that any associated
     EBS snapshot has the same tag.
     """
     print(f"\nProcessing region: {region}")
     ec2_client = boto3.client('ec2', region_name=region)
+    api_calls_before = inventory.api_calls
 
     try:
-        # List AMIs owned by the account that have the FedoraGroup tag
-        images_response = ec2_client.describe_images(
-            Owners=['self'],
-            Filters=[
-                {
-                    'Name': 'tag:FedoraGroup',
-                    'Values': ['*']
-                }
-            ]
-        )
+        # All AMIs and snapshots owned by the account, AMIs without FedoraGroup tag are skipped
+        images = inventory.images(region)
+        snapshots = inventory.snapshots(region)
     except Exception as e:
         print(f"Error describing images in region {region}: {e}")
         return
 
-    for image in progressbar.progressbar(images_response.get('Images', [])):
-        image_id = image.get('ImageId')
-        # Extract the FedoraGroup tag value from the AMI
-        tag_value = None
-        for tag in image.get('Tags', []):
-            if tag['Key'] == 'FedoraGroup':
-                tag_value = tag['Value']
-                break
+    missing, checked = find_missing_tags(images, snapshots, 'FedoraGroup')
 
-        if not tag_value:
-            continue  # Skip if somehow the tag is missing
+    if plan:
+        for tag_value, snapshot_ids in missing.items():
+            for snapshot_id in snapshot_ids:
+                plan.add(region, 'create_tags', snapshot_id,
+                         args={'Tags': [{'Key': 'FedoraGroup', 'Value': tag_value}]})
+        print(f"Planned tagging of {sum(len(ids) for ids in missing.values())} snapshots")
+        return
 
-        #print(f"Processing AMI {image_id} with FedoraGroup tag value: {tag_value}")
+    api_calls = inventory.api_calls - api_calls_before
+    tagged = 0
+    for tag_value, snapshot_ids in missing.items():
+        for chunk in chunks(snapshot_ids, aws_plan.CREATE_TAGS_CHUNK):
+            print(f"Tagging {len(chunk)} snapshots with FedoraGroup: {tag_value}")
+            api_calls += 1
+            try:
+                ec2_client.create_tags(
+                    Resources=chunk,
+                    Tags=[{'Key': 'FedoraGroup', 'Value': tag_value}]
+                )
+                tagged += len(chunk)
+            except Exception as e:
+                print(f"Error tagging snapshots {', '.join(chunk)}: {e}")
+    if tagged:
+        inventory.invalidate(region, 'snapshots')
 
-        # Iterate over the block device mappings to check for associated snapshots
-        for mapping in image.get('BlockDeviceMappings', []):
-            ebs = mapping.get('Ebs')
-            if ebs and 'SnapshotId' in ebs:
-                snapshot_id = ebs['SnapshotId']
-                tag_snapshot_if_missing(ec2_client, snapshot_id, 'FedoraGroup', tag_value)
+    # describe_images, one describe_snapshots per AMI snapshot and one
+    # create_tags per tagged snapshot
+    per_snapshot_calls = 1 + checked + sum(len(ids) for ids in missing.values())
+    print(f"Tagged {tagged} snapshots using {api_calls} API calls"
+          f" (per-snapshot path: {per_snapshot_calls})")
 
-# Create a session and get all available regions for EC2
-session = boto3.session.Session()
-ec2_client = session.client('ec2')
+parser = argparse.ArgumentParser(description='Copy FedoraGroup tag from AMIs to their snapshots.')
+aws_inventory.add_max_age_argument(parser, default=0)
+aws_plan.add_plan_argument(parser)
+args = parser.parse_args()
+inventory = aws_inventory.Inventory(max_age=args.max_age)
+plan = aws_plan.Plan.from_args(args, inventory)
 
 try:
-    regions_response = ec2_client.describe_regions()
+    regions = inventory.regions()
 except Exception as e:
     print(f"Error retrieving regions: {e}")
     sys.exit(1)
 
-regions = [region['RegionName'] for region in regions_response['Regions']]
 regions.remove('me-south-1')
 
 for region in regions:
-    process_region(region)
+    process_region(inventory, region, plan)
+
+if plan:
+    plan.write()
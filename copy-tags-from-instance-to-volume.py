@@ -3,104 +3,136 @@
 You are Python and AWS expert. Write a script that for every region of AWS find
 all volumes that does not have tag FedoraGroup and if the instance where the
 volume is attached has the tag FedoraGroup, then add this tag to volume too.
+
+aws_tag_events.py applies the same rule to the volumes mentioned by CloudTrail
+events, without sweeping the regions.
 """
 
+import argparse
+import aws_plan
 import boto3
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_paginate import chunks, paginate
 
 # Configure logging for clear output
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-def sync_volume_tags():
+TARGET_TAG_KEY = 'FedoraGroup'
+REGION_WORKERS = 8
+
+
+def find_missing_tags(instance_tag_map, volumes, target_tag_key=TARGET_TAG_KEY):
+    """
+    Return {tag_value: [volume_id, ...]} of the VOLUMES without the tag
+    attached to an instance from INSTANCE_TAG_MAP ({instance_id: tag_value})
+    """
+    missing = {}
+    for volume in volumes:
+        if any(tag['Key'] == target_tag_key for tag in volume.get('Tags', [])):
+            continue
+        # Tagging once is sufficient (handles multi-attach corner cases gracefully)
+        for attachment in volume.get('Attachments', []):
+            tag_value = instance_tag_map.get(attachment.get('InstanceId'))
+            if tag_value is not None:
+                missing.setdefault(tag_value, []).append(volume['VolumeId'])
+                break
+    return missing
+
+
+def sync_region(region, plan=None, target_tag_key=TARGET_TAG_KEY):
+    """
+    Tag the volumes of one region, return (api calls, volumes tagged, seconds)
+    """
+    start = time.monotonic()
+    ec2 = boto3.session.Session().client('ec2', region_name=region)
+    api_calls = 0
+
+    def count_call(**_):
+        nonlocal api_calls
+        api_calls += 1
+    ec2.meta.events.register('before-call.ec2', count_call)
+
+    # Step 1: Pre-fetch all instances in this region that have the 'FedoraGroup' tag
+    # This prevents us from doing an API call per volume/instance later.
+    instance_tag_map = {}
+    try:
+        for reservation in paginate(ec2, 'describe_instances', 'Reservations',
+                                    Filters=[{'Name': 'tag-key', 'Values': [target_tag_key]}]):
+            for instance in reservation['Instances']:
+                for tag in instance.get('Tags', []):
+                    if tag['Key'] == target_tag_key:
+                        instance_tag_map[instance['InstanceId']] = tag['Value']
+                        break
+    except Exception as e:
+        logging.error(f"Error describing instances in {region}: {e}")
+        return api_calls, 0, time.monotonic() - start
+
+    # If no instances have the tag in this region, we can safely skip volume checks
+    if not instance_tag_map:
+        logging.info(f"No instances with '{target_tag_key}' tag found in {region}. Skipping.")
+        return api_calls, 0, time.monotonic() - start
+
+    # Step 2: Find all attached volumes missing the tag, grouped by the value to apply
+    try:
+        volumes = paginate(ec2, 'describe_volumes', 'Volumes',
+                           Filters=[{'Name': 'attachment.status', 'Values': ['attached']}])
+        missing = find_missing_tags(instance_tag_map, volumes, target_tag_key)
+    except Exception as e:
+        logging.error(f"Error processing volumes in {region}: {e}")
+        return api_calls, 0, time.monotonic() - start
+
+    # Step 3: One create_tags call per tag value and 1000 volumes
+    tagged = 0
+    for tag_value, volume_ids in missing.items():
+        tags = [{'Key': target_tag_key, 'Value': tag_value}]
+        if plan:
+            for volume_id in volume_ids:
+                plan.add(region, 'create_tags', volume_id, args={'Tags': tags})
+            continue
+        for chunk in chunks(volume_ids, aws_plan.CREATE_TAGS_CHUNK):
+            logging.info(f"Tagging {len(chunk)} volumes in {region} with {target_tag_key}={tag_value}")
+            try:
+                ec2.create_tags(Resources=chunk, Tags=tags)
+                tagged += len(chunk)
+            except Exception as e:
+                logging.error(f"Error tagging volumes {', '.join(chunk)} in {region}: {e}")
+
+    elapsed = time.monotonic() - start
+    logging.info(f"{region}: tagged {tagged} volumes using {api_calls} API calls in {elapsed:.1f}s")
+    return api_calls, tagged, elapsed
+
+
+def sync_volume_tags(plan=None, max_workers=REGION_WORKERS):
     # Initialize base EC2 client to dynamically fetch all available regions
     ec2_base = boto3.client('ec2')
-    
+
     try:
         regions_resp = ec2_base.describe_regions()
         regions = [region['RegionName'] for region in regions_resp['Regions']]
-        regions.remove('me-south-1') 
+        regions.remove('me-south-1')
     except Exception as e:
         logging.error(f"Failed to retrieve AWS regions: {e}")
         return
 
-    target_tag_key = 'FedoraGroup'
-
-    for region in regions:
-        logging.info(f"--- Checking region: {region} ---")
-        ec2 = boto3.client('ec2', region_name=region)
-
-        # Step 1: Pre-fetch all instances in this region that have the 'FedoraGroup' tag
-        # This prevents us from doing an API call per volume/instance later.
-        instance_tag_map = {}
-        try:
-            instance_paginator = ec2.get_paginator('describe_instances')
-            instance_iterator = instance_paginator.paginate(
-                Filters=[{'Name': 'tag-key', 'Values': [target_tag_key]}]
-            )
-
-            for page in instance_iterator:
-                for reservation in page['Reservations']:
-                    for instance in reservation['Instances']:
-                        instance_id = instance['InstanceId']
-                        
-                        # Extract the specific value of the target tag
-                        for tag in instance.get('Tags', []):
-                            if tag['Key'] == target_tag_key:
-                                instance_tag_map[instance_id] = tag['Value']
-                                break
-
-        except Exception as e:
-            logging.error(f"Error describing instances in {region}: {e}")
-            continue
-
-        # If no instances have the tag in this region, we can safely skip volume checks
-        if not instance_tag_map:
-            logging.info(f"No instances with '{target_tag_key}' tag found in {region}. Skipping.")
-            continue
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda region: sync_region(region, plan), regions))
 
-        # Step 2: Find all attached volumes and check their tags
-        try:
-            vol_paginator = ec2.get_paginator('describe_volumes')
-            # Filter specifically for volumes currently attached to an instance
-            vol_iterator = vol_paginator.paginate(
-                Filters=[{'Name': 'attachment.status', 'Values': ['attached']}]
-            )
-
-            for page in vol_iterator:
-                for volume in page['Volumes']:
-                    vol_id = volume['VolumeId']
-
-                    # Check if the volume ALREADY has the target tag
-                    vol_has_tag = any(tag['Key'] == target_tag_key for tag in volume.get('Tags', []))
-                    if vol_has_tag:
-                        continue
-
-                    # If missing the tag, check the instance(s) it is attached to
-                    for attachment in volume.get('Attachments', []):
-                        attached_instance_id = attachment.get('InstanceId')
-
-                        # If the attached instance is in our map, it has the tag
-                        if attached_instance_id in instance_tag_map:
-                            tag_value_to_apply = instance_tag_map[attached_instance_id]
-
-                            logging.info(f"Tagging Volume: {vol_id} (Attached to {attached_instance_id}) "
-                                         f"with {target_tag_key}={tag_value_to_apply}")
-
-                            # Apply the tag to the volume
-                            ec2.create_tags(
-                                Resources=[vol_id],
-                                Tags=[
-                                    {
-                                        'Key': target_tag_key,
-                                        'Value': tag_value_to_apply
-                                    }
-                                ]
-                            )
-                            # Tagging once is sufficient (handles multi-attach corner cases gracefully)
-                            break
-
-        except Exception as e:
-            logging.error(f"Error processing volumes in {region}: {e}")
+    logging.info("Region            API calls  Tagged  Seconds")
+    for region, (api_calls, tagged, elapsed) in zip(regions, results):
+        logging.info(f"{region:<16} {api_calls:>10} {tagged:>7} {elapsed:>8.1f}")
+    logging.info(f"Total: tagged {sum(result[1] for result in results)} volumes using"
+                 f" {1 + sum(result[0] for result in results)} API calls")
 
 if __name__ == "__main__":
-    sync_volume_tags()
+    parser = argparse.ArgumentParser(description='Copy FedoraGroup tag from instances to their volumes.')
+    parser.add_argument('--workers', type=int, default=REGION_WORKERS,
+                        help=f'number of regions processed in parallel (default: {REGION_WORKERS})')
+    aws_plan.add_plan_argument(parser)
+    args = parser.parse_args()
+    plan = aws_plan.Plan.from_args(args)
+    sync_volume_tags(plan, max_workers=args.workers)
+    if plan:
+        plan.write()
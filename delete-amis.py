@@ -1,35 +1,39 @@
 #!/usr/bin/python3
-import boto3
+import argparse
+import aws_bulk_delete
+import aws_inventory
+import aws_plan
 import re
-import sys
 
 # Regular expression to match AMI names that should be deleted
 ami_name_pattern = "^Fedora-AtomicHost-.*"
 
-def get_regions():
-    """Get a list of all AWS regions."""
-    ec2 = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
-    return regions
+def select_matching_amis(inventory, snapshot_index, region):
+    """Select AMIs matching the regex in the specified region."""
+    amis = inventory.images(region)
+    snapshot_index.add_images(region, amis)
+    return [(ami['ImageId'], ami.get('Name', ''))
+            for ami in amis
+            if re.match(ami_name_pattern, ami.get('Name', ''))]
 
-def delete_matching_amis(region):
-    """Delete AMIs matching the regex in the specified region."""
-    ec2 = boto3.client('ec2', region_name=region)
-    amis = ec2.describe_images(Owners=['self'])['Images']
-    
-    for ami in amis:
-        ami_name = ami.get('Name', '')
-        if re.match(ami_name_pattern, ami_name):
-            try:
-                print(f"  Deleting AMI {ami['ImageId']}({ami_name})...")
-                ec2.deregister_image(ImageId=ami['ImageId'])
-                print(f"    AMI {ami['ImageId']} deleted successfully.")
-            except Exception as e:
-                print(f"Error deleting AMI {ami['ImageId']}: {e}")
+parser = argparse.ArgumentParser(description=f'Deregister AMIs matching {ami_name_pattern}.')
+aws_inventory.add_max_age_argument(parser, default=0)
+aws_bulk_delete.add_arguments(parser)
+aws_bulk_delete.add_cascade_argument(parser)
+aws_plan.add_plan_argument(parser)
+args = parser.parse_args()
+inventory = aws_inventory.Inventory(max_age=args.max_age)
 
-regions = get_regions()
-for region in regions:
-    print(f"Processing region {region}...")
-    delete_matching_amis(region)
+regions = inventory.regions()
+plan = aws_plan.Plan.from_args(args, inventory)
+snapshot_index = aws_bulk_delete.SnapshotIndex()
+deleter = aws_bulk_delete.BulkDeleter.from_args(args, aws_bulk_delete.deregister_image,
+                                                cascade=snapshot_index, plan=plan)
+deleter.run(regions, lambda region: select_matching_amis(inventory, snapshot_index, region))
+if plan:
+    plan.write()
+else:
+    for region in regions:
+        inventory.invalidate(region, 'images')
+        inventory.invalidate(region, 'snapshots')
 print("Completed processing all regions.")
-
@@ -1,54 +1,57 @@
 #!/usr/bin/python3
 # a script that goes over all regions and deletes all AMIs older than the specified date
 
-import boto3
+import argparse
+import aws_bulk_delete
+import aws_inventory
+import aws_plan
 from datetime import datetime, timezone
-from botocore.exceptions import ClientError
 
-def delete_old_amis(older_than_date):
+def select_old_amis(inventory, snapshot_index, region, older_than_date):
     """
-    Deletes all AMIs older than the specified date across all regions, excluding those with a 'FedoraGroup' tag.
+    Select AMIs in the region older than the specified date, excluding those with a 'FedoraGroup' tag.
 
     Parameters:
     older_than_date (datetime): The threshold date. AMIs created before this date will be deleted, unless they have a 'FedoraGroup' tag.
     """
-    # Get a list of all regions
-    ec2 = boto3.client('ec2', region_name='us-east-1')
-    regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
-    regions.remove('me-south-1')
-    
-    for region in regions:
-        print(f"Checking AMIs in region: {region}")
-        ec2_region_client = boto3.client('ec2', region_name=region)
-        
-        # List all AMIs owned by the user
-        try:
-            my_amis = ec2_region_client.describe_images(Owners=['self'])['Images']
-        except ClientError:
-            print("Skipping this region")
-            continue
-            
-        
-        # Filter AMIs created before the specified date
-        old_amis = [ami for ami in my_amis if datetime.strptime(ami['CreationDate'], "%Y-%m-%dT%H:%M:%S.%f%z") < older_than_date]
-        
-        for ami in old_amis:
-            ami_id = ami['ImageId']
-            ami_name = ami.get('Name', '')
-            # Check for 'FedoraGroup' tag
-            has_fedora_group_tag = any(tag['Key'] == 'FedoraGroup' for tag in ami.get('Tags', []))
-            
-            if not has_fedora_group_tag:
-                print(f"Deregistering AMI {ami_id} {ami_name} in region {region} as it does not have a 'FedoraGroup' tag")
-                # Deregister the AMI
-                ec2_region_client.deregister_image(ImageId=ami_id)
-            else:
-                pass
-                #print(f"Skipping AMI {ami_id} in region {region} because it has a 'FedoraGroup' tag")
-            
-        print(f"Finished checking region: {region}")
+    # List all AMIs owned by the user
+    my_amis = inventory.images(region)
+    snapshot_index.add_images(region, my_amis)
+
+    # Filter AMIs created before the specified date
+    old_amis = [ami for ami in my_amis if datetime.strptime(ami['CreationDate'], "%Y-%m-%dT%H:%M:%S.%f%z") < older_than_date]
+
+    selected = []
+    for ami in old_amis:
+        # Check for 'FedoraGroup' tag
+        has_fedora_group_tag = any(tag['Key'] == 'FedoraGroup' for tag in ami.get('Tags', []))
+        if not has_fedora_group_tag:
+            selected.append((ami['ImageId'], ami.get('Name', '')))
+    return selected
 
 
 # Specify the cutoff date in YYYY, MM, DD format
 cutoff_date = datetime(2026, 4, 1, tzinfo=timezone.utc)
-delete_old_amis(cutoff_date)
+
+parser = argparse.ArgumentParser(description='Deregister untagged AMIs older than the cutoff date.')
+aws_inventory.add_max_age_argument(parser, default=0)
+aws_bulk_delete.add_arguments(parser)
+aws_bulk_delete.add_cascade_argument(parser)
+aws_plan.add_plan_argument(parser)
+args = parser.parse_args()
+
+inventory = aws_inventory.Inventory(max_age=args.max_age)
+regions = inventory.regions()
+regions.remove('me-south-1')
+
+plan = aws_plan.Plan.from_args(args, inventory)
+snapshot_index = aws_bulk_delete.SnapshotIndex()
+deleter = aws_bulk_delete.BulkDeleter.from_args(args, aws_bulk_delete.deregister_image,
+                                                cascade=snapshot_index, plan=plan)
+deleter.run(regions, lambda region: select_old_amis(inventory, snapshot_index, region, cutoff_date))
+if plan:
+    plan.write()
+else:
+    for region in regions:
+        inventory.invalidate(region, 'images')
+        inventory.invalidate(region, 'snapshots')
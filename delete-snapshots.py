@@ -1,41 +1,39 @@
 #!/usr/bin/python3
 
-import boto3
-from botocore.exceptions import ClientError
+import argparse
+import aws_bulk_delete
+import aws_inventory
+import aws_plan
 import datetime
-import sys
-
-def delete_snapshots():
-    # Get a list of all regions
-    ec2 = boto3.client('ec2')
-    regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
-    regions.remove('me-south-1')
-
-    # Define the cutoff date
-    cutoff_date = datetime.datetime(2026, 4, 1)
 
+# Define the cutoff date
+cutoff_date = datetime.datetime(2026, 4, 1)
+
+def select_snapshots(inventory, region):
+    selected = []
+    for snapshot in inventory.snapshots(region):
+        creation_date = datetime.datetime.strptime(snapshot['StartTime'].strftime("%Y-%m-%d"), "%Y-%m-%d")
+
+        # Check if the snapshot has the required tag and is older than the cutoff date
+        if creation_date < cutoff_date and not any(tag['Key'] == 'FedoraGroup' for tag in snapshot.get('Tags', [])):
+            selected.append((snapshot['SnapshotId'], f"started at {creation_date}"))
+    return selected
+
+parser = argparse.ArgumentParser(description='Delete untagged snapshots older than the cutoff date.')
+aws_inventory.add_max_age_argument(parser, default=0)
+aws_bulk_delete.add_arguments(parser)
+aws_plan.add_plan_argument(parser)
+args = parser.parse_args()
+
+inventory = aws_inventory.Inventory(max_age=args.max_age)
+regions = inventory.regions()
+regions.remove('me-south-1')
+
+plan = aws_plan.Plan.from_args(args, inventory)
+deleter = aws_bulk_delete.BulkDeleter.from_args(args, aws_bulk_delete.delete_snapshot, plan=plan)
+deleter.run(regions, lambda region: select_snapshots(inventory, region))
+if plan:
+    plan.write()
+else:
     for region in regions:
-        print(f"Checking region: {region}")
-        ec2 = boto3.client('ec2', region_name=region)
-
-        # Get all snapshots
-        try:
-            snapshots = ec2.describe_snapshots(OwnerIds=['self'])['Snapshots']
-        except ClientError:
-            print("Skipping this region")
-            continue
-
-
-        for snapshot in snapshots:
-            creation_date = datetime.datetime.strptime(snapshot['StartTime'].strftime("%Y-%m-%d"), "%Y-%m-%d")
-            
-            # Check if the snapshot has the required tag and is older than the cutoff date
-            if creation_date < cutoff_date and not any(tag['Key'] == 'FedoraGroup' for tag in snapshot.get('Tags', [])):
-                try:
-                    ec2.delete_snapshot(SnapshotId=snapshot['SnapshotId'])
-                    print(f"Deleted snapshot {snapshot['SnapshotId']} started at {creation_date}")
-                except ClientError as e:
-                    #pass
-                    print(f"Error: {e}")
-
-delete_snapshots()
+        inventory.invalidate(region, 'snapshots')
@@ -18,6 +18,13 @@ This script performs the following actions for every AWS region:
 2.  For these matching instances, it adds the tag: "FedoraGroup" = "CI".
 3.  For the volumes attached to these same instances, it also adds the tag:
     "FedoraGroup" = "CI".
+Instances and volumes of one region are tagged by a single create_tags call.
+
+The regions, and with several --profile options also the AWS accounts, are
+swept in parallel.  With --watch SECONDS the sweep is repeated forever and
+every pass after the first one only looks at instances launched since the
+previous pass.  aws_tag_events.py fixes the tags from the CloudTrail
+events of new instances instead of sweeping.
 
 PREREQUISITES:
 1.  Boto3 library: `pip install boto3`
@@ -30,19 +37,33 @@ IAM PERMISSIONS REQUIRED:
 * ec2:CreateTags (on instances and volumes)
 """
 
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError, ProfileNotFound
+
+import aws_plan
+from aws_paginate import chunks, paginate
 
 # --- CONFIGURATION ---
-# Set to False to apply tags.
-# Set to True to only print what would be tagged.
+# Set from the command line in main():
+# True only prints what would be tagged.
 DRY_RUN = False
+# aws_plan.Plan collecting the tags instead of applying them.
+PLAN = None
 
 TAG_TO_FIND_KEY = "k8s.io/cluster-autoscaler/enabled"
 TAG_TO_FIND_VALUE = "true"
 TAG_TO_EXCLUDE_KEY = "FedoraGroup"
 TAG_TO_SET_KEY = "FedoraGroup"
 TAG_TO_SET_VALUE = "CI"
+REGION_WORKERS = 16
+# instances launched this long before the previous pass are checked again,
+# it covers clock skew and the delay before AWS lists new instances
+WATCH_OVERLAP = timedelta(minutes=5)
 # ---------------------
 
 
@@ -60,122 +81,145 @@ def get_all_regions(ec2_client):
         return []
 
 
-def process_region(region_name):
+def launch_time_filter(since, now):
     """
-    Finds and tags resources in a specific region.
+    EC2 filters match launch-time only as a string with wildcards, return
+    the filter matching every day from SINCE to NOW, the exact time is
+    compared by the caller
     """
-    print(f"\n--- Processing Region: {region_name} ---")
-    try:
-        client = boto3.client("ec2", region_name=region_name)
-        paginator = client.get_paginator("describe_instances")
-
-        # Filter for instances that have the autoscaler tag
-        instances_to_check = paginator.paginate(
-            Filters=[
-                {
-                    "Name": f"tag:{TAG_TO_FIND_KEY}",
-                    "Values": [TAG_TO_FIND_VALUE],
-                },
-                {"Name": "instance-state-name", "Values": ["running", "stopped"]},
-            ]
-        )
-
-        instances_to_tag = []
-        volumes_to_tag = set()  # Use a set to avoid duplicate volume IDs
-
-        for page in instances_to_check:
-            for reservation in page["Reservations"]:
-                for instance in reservation["Instances"]:
-                    instance_id = instance["InstanceId"]
-                    tags = instance.get("Tags", [])
-                    tag_keys = [tag["Key"] for tag in tags]
-
-                    # Check if the exclude tag is NOT present
-                    if TAG_TO_EXCLUDE_KEY not in tag_keys:
-                        print(
-                            f"  [MATCH] Instance {instance_id} matches criteria."
-                        )
-                        instances_to_tag.append(instance_id)
-
-                        # Find its attached volumes
-                        for mapping in instance.get("BlockDeviceMappings", []):
-                            if "Ebs" in mapping:
-                                volume_id = mapping["Ebs"]["VolumeId"]
-                                print(
-                                    f"    -> Found attached volume: {volume_id}"
-                                )
-                                volumes_to_tag.add(volume_id)
-                    else:
-                        print(
-                            f"  [SKIP] Instance {instance_id} already has"
-                            f" '{TAG_TO_EXCLUDE_KEY}' tag."
-                        )
-
-        # Convert set to list for Boto3
-        volume_list_to_tag = list(volumes_to_tag)
-
-        # Apply tags to instances
-        if instances_to_tag:
-            tag_resources(
-                client,
-                region_name,
-                "Instances",
-                instances_to_tag,
-                TAG_TO_SET_KEY,
-                TAG_TO_SET_VALUE,
-            )
-        else:
-            print(f"  No instances to tag in {region_name}.")
-
-        # Apply tags to volumes
-        if volume_list_to_tag:
-            tag_resources(
-                client,
-                region_name,
-                "Volumes",
-                volume_list_to_tag,
-                TAG_TO_SET_KEY,
-                TAG_TO_SET_VALUE,
-            )
-        else:
-            print(f"  No new volumes to tag in {region_name}.")
+    days = []
+    day = since.date()
+    while day <= now.date():
+        days.append(f"{day.isoformat()}*")
+        day += timedelta(days=1)
+    return {"Name": "launch-time", "Values": days}
+
 
+def select_untagged(instances, since=None):
+    """
+    Return (instance IDs, volume IDs) of the autoscaler INSTANCES without
+    the FedoraGroup tag, launched after SINCE if specified
+    """
+    instances_to_tag = []
+    volumes_to_tag = set()  # Use a set to avoid duplicate volume IDs
+    for instance in instances:
+        if since and instance["LaunchTime"] < since:
+            continue
+        tag_keys = {tag["Key"] for tag in instance.get("Tags", [])}
+        if TAG_TO_EXCLUDE_KEY in tag_keys:
+            continue
+        instances_to_tag.append(instance["InstanceId"])
+        # Find its attached volumes
+        for mapping in instance.get("BlockDeviceMappings", []):
+            if "Ebs" in mapping:
+                volumes_to_tag.add(mapping["Ebs"]["VolumeId"])
+    return instances_to_tag, sorted(volumes_to_tag)
+
+
+def process_region(client, label, region_name, since=None):
+    """
+    Finds and tags resources in a specific region, return the number of
+    tagged resources.
+    """
+    try:
+        filters = [
+            {"Name": f"tag:{TAG_TO_FIND_KEY}", "Values": [TAG_TO_FIND_VALUE]},
+            # pending instances may not list all their volumes yet, once
+            # tagged they would be skipped forever, --watch overlaps the passes
+            {"Name": "instance-state-name", "Values": ["running", "stopped"]},
+        ]
+        if since:
+            filters.append(launch_time_filter(since, datetime.now(timezone.utc)))
+        instances = (instance
+                     for reservation in paginate(client, "describe_instances", "Reservations",
+                                                 Filters=filters)
+                     for instance in reservation["Instances"])
+        instances_to_tag, volumes_to_tag = select_untagged(instances, since)
     except ClientError as e:
         # Handle regions that might be disabled or inaccessible
         if e.response["Error"]["Code"] == "AuthFailure":
-            print(f"  [WARN] Could not access region {region_name}. Skipping.")
+            print(f"  [WARN] {label}: Could not access region {region_name}. Skipping.")
         else:
-            print(f"  [ERROR] An error occurred in {region_name}: {e}")
+            print(f"  [ERROR] {label}: An error occurred in {region_name}: {e}")
+        return 0
+    except BotoCoreError as e:
+        print(f"  [ERROR] {label}: An error occurred in {region_name}: {e}")
+        return 0
+
+    if not instances_to_tag:
+        return 0
+    for instance_id in instances_to_tag:
+        print(f"  [MATCH] {label}: Instance {instance_id} in {region_name} matches criteria.")
+    return tag_resources(client, label, region_name, instances_to_tag, volumes_to_tag,
+                         TAG_TO_SET_KEY, TAG_TO_SET_VALUE)
 
 
-def tag_resources(client, region, res_type, res_ids, key, value):
+def tag_resources(client, label, region, instance_ids, volume_ids, key, value):
     """
-    Applies a tag to a list of resources.
+    Applies a tag to the instances and volumes with one create_tags call
+    (per 1000 resources), return the number of tagged resources.
     """
+    res_ids = instance_ids + volume_ids
+    res_type = f"{len(instance_ids)} instances and {len(volume_ids)} volumes"
+    if PLAN:
+        for res_id in res_ids:
+            PLAN.add(region, "create_tags", res_id,
+                     args={"Tags": [{"Key": key, "Value": value}]},
+                     description="instance" if res_id.startswith("i-") else "volume")
+        print(f"  [Planned] {label}: {res_type} in {region} with {key}={value}.")
+        return len(res_ids)
+
     action = "Would tag" if DRY_RUN else "Tagging"
-    print(
-        f"  [{action}] {len(res_ids)} {res_type} in {region}"
-        f" with {key}={value}."
-    )
+    print(f"  [{action}] {label}: {res_type} in {region} with {key}={value}.")
 
-    if not DRY_RUN:
-        try:
-            # Boto3 create_tags can tag many resources at once
-            client.create_tags(
-                Resources=res_ids, Tags=[{"Key": key, "Value": value}]
-            )
-            print(f"  [SUCCESS] Tagged {len(res_ids)} {res_type}.")
-        except ClientError as e:
-            print(f"  [ERROR] Failed to tag {res_type}: {e}")
-    else:
+    if DRY_RUN:
         # In dry run, just print the first few IDs as a sample
         for res_id in res_ids[:5]:
             print(f"    - {res_id}")
         if len(res_ids) > 5:
             print(f"    - ... and {len(res_ids) - 5} more.")
+        return 0
+
+    tagged = 0
+    for chunk in chunks(res_ids, aws_plan.CREATE_TAGS_CHUNK):
+        try:
+            client.create_tags(Resources=chunk, Tags=[{"Key": key, "Value": value}])
+            tagged += len(chunk)
+        except (BotoCoreError, ClientError) as e:
+            print(f"  [ERROR] {label}: Failed to tag resources in {region}: {e}")
+    print(f"  [SUCCESS] {label}: Tagged {tagged} resources in {region}.")
+    return tagged
+
+
+def sweep(accounts, since=None):
+    """
+    Process all regions of all ACCOUNTS ([(label, {region: client})]) in
+    parallel, return the number of tagged resources
+    """
+    with ThreadPoolExecutor(max_workers=REGION_WORKERS) as executor:
+        futures = [executor.submit(process_region, client, label, region, since)
+                   for label, clients in accounts
+                   for region, client in clients.items()]
+        return sum(future.result() for future in futures)
 
 
 def main():
+    global DRY_RUN, PLAN  # pylint: disable=global-statement
+    parser = argparse.ArgumentParser(
+        description="Tag k8s autoscaler instances and their volumes with FedoraGroup=CI.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print what would be tagged")
+    parser.add_argument("--profile", action="append", dest="profiles",
+                        help="AWS profile to sweep, can be repeated (default: the default credentials)")
+    parser.add_argument("--watch", type=int, metavar="SECONDS",
+                        help="repeat the sweep every SECONDS, checking only newly launched instances")
+    aws_plan.add_plan_argument(parser)
+    args = parser.parse_args()
+    if args.plan and (args.watch or len(args.profiles or []) > 1):
+        parser.error("--plan works with one account and without --watch")
+    DRY_RUN = args.dry_run
+    PLAN = aws_plan.Plan.from_args(args)
+
     print("Starting script to tag k8s instances and volumes...")
     if DRY_RUN:
         print("=" * 30)
@@ -183,24 +227,46 @@ def main():
         print("  No changes will be made.")
         print("=" * 30)
 
-    # Use a base client in a common region to get the list of all regions
-    base_client = boto3.client("ec2", region_name="us-east-1")
-    all_regions = get_all_regions(base_client)
-
-    if not all_regions:
+    accounts = []
+    for profile in args.profiles or [None]:
+        try:
+            session = boto3.session.Session(profile_name=profile)
+        except ProfileNotFound as e:
+            print(f"{e}. Skipping.")
+            continue
+        # Use a base client in a common region to get the list of all regions
+        base_client = session.client("ec2", region_name="us-east-1")
+        all_regions = get_all_regions(base_client)
+        if not all_regions:
+            print(f"Could not retrieve AWS regions of {profile or 'default'} profile. Skipping.")
+            continue
+        print(f"Found {len(all_regions)} regions to check in {profile or 'default'} profile.")
+        # boto3 sessions are not thread-safe, create the clients here and
+        # share only them with the workers
+        clients = {region: session.client("ec2", region_name=region) for region in all_regions}
+        accounts.append((profile or "default", clients))
+
+    if not accounts:
         print("Could not retrieve AWS regions. Exiting.")
         return
 
-    print(f"Found {len(all_regions)} regions to check.")
+    since = None
+    while True:
+        started = datetime.now(timezone.utc)
+        tagged = sweep(accounts, since)
+        print(f"Pass started at {started.isoformat(timespec='seconds')} tagged {tagged} resources.")
+        if not args.watch:
+            break
+        since = started - WATCH_OVERLAP
+        time.sleep(args.watch)
 
-    for region in all_regions:
-        process_region(region)
+    if PLAN:
+        PLAN.write()
 
     print("\nScript finished.")
     if DRY_RUN:
-        print("To apply changes, set DRY_RUN = False in the script.")
+        print("To apply changes, run the script without --dry-run.")
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,14 +1,20 @@
 #!/usr/bin/python3
-import awspricing
-import boto3
+import argparse
+import aws_inventory
+import aws_prices
 import json
 import progressbar
+from array import array
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
 
 NOT_TAGGED = "Not tagged"
 FEDORA_GROUP = "FedoraGroup"
 SERVICE_NAME = "ServiceName"
 HOURS_PER_MONTH = 730
+# how many (region, resource kind) pairs are fetched in parallel
+MAX_WORKERS = 16
 
 RESERVED_INSTANCES = {
     # see https://docs.google.com/spreadsheets/d/1-5EyRjMSC2_LgHOpdG6_HwBjcSIY36rhYOLVYBcwAKY/edit?gid=0#gid=0
@@ -26,290 +32,267 @@ RESERVED_INSTANCES = {
         "r7a.xlarge": 1,
         "c7a.8xlarge": 1,
 }}}
-# Initialize a session using Amazon EC2
-session = boto3.Session()
-ec2_resource = session.resource('ec2')
-
-def get_all_regions():
-    client = boto3.client('ec2')
-    regions = [region['RegionName'] for region in client.describe_regions()['Regions']]
-    return regions
-
-REGIONS = get_all_regions()
-REGIONS.remove('me-south-1')
-print(REGIONS)
-#REGIONS = ['us-east-1']
-GROUPS = {NOT_TAGGED}
-SERVICE = {NOT_TAGGED}
+
+# set by main(), aws_inventory.Inventory and the names of the regions to report
+INVENTORY = None
+REGIONS = []
+
+# resource kinds in the order they are reported
+KINDS = ('instance', 'volume', 'ami', 'snapshot')
+
+
+class UsageTable:
+    """
+    Flat usage records keyed by (group, region, service, kind, type), the
+    count, size and iops columns are summed per key.  Only the combinations
+    which really exist are stored.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.count = array('q')
+        self.size = array('q')
+        self.iops = array('q')
+
+    def add(self, key, count=1, size=0, iops=0):
+        """ Add one record, KEY is (group, region, service, kind, type) """
+        row = self.index.get(key)
+        if row is None:
+            row = self.index[key] = len(self.count)
+            self.count.append(0)
+            self.size.append(0)
+            self.iops.append(0)
+        self.count[row] += count
+        self.size[row] += size
+        self.iops[row] += iops
+
+    def merge(self, other):
+        """ Add all records from the OTHER table """
+        for key, row in other.index.items():
+            self.add(key, other.count[row], other.size[row], other.iops[row])
+
+    def rows(self, sort_key=None):
+        """ Yield (key, count, size, iops) ordered by SORT_KEY(key) """
+        for key in sorted(self.index, key=sort_key):
+            row = self.index[key]
+            yield key, self.count[row], self.size[row], self.iops[row]
+
 
 def parse_tags(tags):
-    global SERVICE
-    global GROUPS
     tags = {tag['Key']: tag['Value'] for tag in tags}
     # Check if the volume has the "FedoraGroup" tag
-    fedora_group = NOT_TAGGED
-    if FEDORA_GROUP in tags:
-        fedora_group = tags[FEDORA_GROUP]
-        if fedora_group not in GROUPS:
-            GROUPS.add(fedora_group)
-
-    service_name = NOT_TAGGED
-    if SERVICE_NAME in tags:
-        service_name = tags[SERVICE_NAME]
-        if service_name not in SERVICE:
-            SERVICE.add(service_name)
-
+    fedora_group = tags.get(FEDORA_GROUP, NOT_TAGGED)
+    service_name = tags.get(SERVICE_NAME, NOT_TAGGED)
     return (fedora_group, service_name)
 
-def get_volumes_by_group():
-    volume_data = {}
-    global REGIONS
-    global GROUPS
-    global SERVICE
-    print("Gathering volumes:")
-    for region in progressbar.progressbar(REGIONS):
-        ec2_resource = boto3.resource('ec2', region_name=region)
-        volumes = ec2_resource.volumes.all()
-
-        try:
-            for volume in volumes:
-                size = volume.size  # size of the volume in GiB
-                volume_type = volume.volume_type  # type of the volume
-                iops = volume.iops or 0
-                tags = volume.tags or []
-                
-                (fedora_group, service_name) = parse_tags(tags)
-                
-                if fedora_group not in volume_data:
-                    volume_data[fedora_group] = {}
-                
-                if region not in volume_data[fedora_group]:
-                    volume_data[fedora_group][region] = {}
-                if service_name not in volume_data[fedora_group][region]:
-                    volume_data[fedora_group][region][service_name] = {}
-
-                if volume_type not in volume_data[fedora_group][region][service_name]:
-                    volume_data[fedora_group][region][service_name][volume_type] = [0, 0]
-                
-                volume_data[fedora_group][region][service_name][volume_type][0] += size
-                volume_data[fedora_group][region][service_name][volume_type][1] += iops
-        except:
-            print("Skipping this region")
-            continue        
-    
-    return volume_data
-
-
-def get_amis_by_group():
-    amis_data = {}
-    global REGIONS
-    global GROUPS
-    global SERVICE
-    print("Gathering AMIs:")
-    for region in progressbar.progressbar(REGIONS):
-        ec2 = boto3.client('ec2', region_name=region)
-        try:
-            amis = ec2.describe_images(Owners=['self'])['Images']
-        except:
-            print("Skipping this region")
-            REGIONS.remove(region)
-            continue            
-
-        for ami in amis:
-            (fedora_group, service_name) = parse_tags(ami.get('Tags', [])) 
-
-            if fedora_group not in amis_data:
-                amis_data[fedora_group] = {}
-
-            if region not in amis_data[fedora_group]:
-                amis_data[fedora_group][region] = {}
-
-            if service_name not in amis_data[fedora_group][region]:
-                amis_data[fedora_group][region][service_name] = 0
-
-            amis_data[fedora_group][region][service_name] += 1
-
-    return amis_data
-
-def get_snapshots_by_group():
-    snapshots_data = {}
-    global REGIONS
-    global GROUPS
-    global SERVICE
-    print("Gathering Snapshots:")
-    for region in progressbar.progressbar(REGIONS):
-        ec2 = boto3.resource('ec2', region_name=region)
-        snapshots = ec2.snapshots.filter(OwnerIds=['self'])
-        for snap in snapshots:
-            (fedora_group, service_name) = parse_tags(snap.tags or [])
-
-            if fedora_group not in snapshots_data:
-                snapshots_data[fedora_group] = {}
-
-            if region not in snapshots_data[fedora_group]:
-                snapshots_data[fedora_group][region] = {}
-
-            if service_name not in snapshots_data[fedora_group][region]:
-                snapshots_data[fedora_group][region][service_name] = {'count': 0, 'size': 0}
-
-            snapshots_data[fedora_group][region][service_name]['count'] += 1
-            snapshots_data[fedora_group][region][service_name]['size'] += snap.volume_size
-
-    return snapshots_data
-
-def get_instances_by_group_and_region():
+def get_region_volumes(region):
+    """
+    Return UsageTable with volume sizes and iops of one region
+    """
+    usage = UsageTable()
+    try:
+        for volume in INVENTORY.volumes(region):
+            size = volume['Size']  # size of the volume in GiB
+            volume_type = volume['VolumeType']  # type of the volume
+            iops = volume.get('Iops') or 0
+            (fedora_group, service_name) = parse_tags(volume.get('Tags', []))
+            usage.add((fedora_group, region, service_name, 'volume', volume_type),
+                      size=size, iops=iops)
+    except:
+        print(f"Skipping region {region} for volumes")
+
+    return usage
+
+
+def get_region_amis(region):
+    """
+    Return UsageTable with AMI counts of one region, None if the region
+    is not accessible
+    """
+    usage = UsageTable()
+    try:
+        amis = INVENTORY.images(region)
+    except:
+        print(f"Skipping region {region}")
+        return None
+
+    for ami in amis:
+        (fedora_group, service_name) = parse_tags(ami.get('Tags', []))
+        usage.add((fedora_group, region, service_name, 'ami', ''))
+
+    return usage
+
+def get_region_snapshots(region):
+    """
+    Return UsageTable with snapshot counts and sizes of one region
+    """
+    usage = UsageTable()
+    for snap in INVENTORY.snapshots(region):
+        (fedora_group, service_name) = parse_tags(snap.get('Tags', []))
+        usage.add((fedora_group, region, service_name, 'snapshot', ''),
+                  size=snap['VolumeSize'])
+
+    return usage
+
+def get_region_instances(region):
+    """
+    Return UsageTable with running instance counts of one region
+    """
+    usage = UsageTable()
+    for instance in INVENTORY.instances(region):
+        if instance['State']['Name'] in ['terminated', 'stopped']:
+            continue
+        instance_type = instance['InstanceType']  # type of the instance
+        if instance.get('SpotInstanceRequestId'):
+            instance_type = f"{instance_type}_spot"
+        (fedora_group, service_name) = parse_tags(instance.get('Tags', []))
+        usage.add((fedora_group, region, service_name, 'instance', instance_type))
+
+    return usage
+
+
+COLLECTORS = {
+    'volumes': get_region_volumes,
+    'instances': get_region_instances,
+    'amis': get_region_amis,
+    'snapshots': get_region_snapshots,
+}
+
+def gather_data(max_workers=MAX_WORKERS):
+    """
+    Fetch all resource kinds for all regions concurrently into one
+    UsageTable.
+    """
     global REGIONS
-    global GROUPS
-    global SERVICE
-    instances_data = {}
-    print("Gathering instances:")
-    for region in progressbar.progressbar(REGIONS):
-        ec2_resource = session.resource('ec2', region_name=region)
-        instances = ec2_resource.instances.all()
-        
-        for instance in instances:
-            if instance.state['Name'] in ['terminated', 'stopped']:
+    usage = UsageTable()
+    skipped_regions = set()
+    print(f"Gathering {', '.join(COLLECTORS)} ({max_workers} workers):")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(collector, region): (kind, region)
+            for region in REGIONS
+            for kind, collector in COLLECTORS.items()
+        }
+        for future in progressbar.progressbar(as_completed(futures), max_value=len(futures)):
+            kind, region = futures[future]
+            try:
+                region_usage = future.result()
+            except Exception as e:
+                print(f"Skipping {kind} in region {region}: {e}")
                 continue
-            instance_type = instance.instance_type  # type of the instance
-            if instance.spot_instance_request_id:
-                instance_type = f"{instance_type}_spot"
-            # Check if the instance has the "FedoraGroup" tag
-            tags = instance.tags or []
-            (fedora_group, service_name) = parse_tags(tags)
-
-            if fedora_group not in instances_data:
-                instances_data[fedora_group] = {}
-            
-            # Update the instances_data dictionary
-            if region not in instances_data[fedora_group]:
-                instances_data[fedora_group][region] = {}
-
-            if service_name not in instances_data[fedora_group][region]:
-                instances_data[fedora_group][region][service_name] = {}
-
-            if instance_type not in instances_data[fedora_group][region][service_name]:
-                instances_data[fedora_group][region][service_name][instance_type] = 0
-            
-            instances_data[fedora_group][region][service_name][instance_type] += 1
-
-    return instances_data
-
-
-def get_current_spot_pricing(region):
-    ec2_client = boto3.client('ec2')
-    ec2_resource = boto3.resource('ec2', region_name=region)
-    response = ec2_client.describe_spot_instance_requests()
-    spot_instance_requests = response['SpotInstanceRequests']
-
-    pricing = {}
-    for instance_request in spot_instance_requests:
-        if instance_request['State'] == 'active':
-            instance = ec2_resource.Instance(instance_request['InstanceId'])
-
-            pricing[instance_request['LaunchSpecification']['InstanceType']] = float(instance_request['SpotPrice'])
-
-    return pricing
-
-def print_volume_instance_data(volume_data, instances_data, amis_data, snapshots_data):
-    global REGIONS
-    global GROUPS
-    global SERVICE
+            if region_usage is None:
+                skipped_regions.add(region)
+                continue
+            usage.merge(region_usage)
+
+    REGIONS = [region for region in REGIONS if region not in skipped_regions]
+    return usage
+
+
+def price_instances(ec2_offer, spot_prices, group, region, instance_type, count):
+    """
+    Return (monthly price, output lines) for COUNT instances of one type
+    """
+    output = []
+    reserved = RESERVED_INSTANCES.get(group, {}).get(region, {}).get(instance_type, 0)
+    if reserved > 0:
+        count_remaining = count - reserved
+        if count_remaining <= 0:
+            # do not count price of this instance
+            return 0, [f"        Instance Type: {instance_type} - Count: {count} - Price: 0 (reserved)"]
+        output += [f"        Instance Type: {instance_type} - Count: {reserved} - Price: 0 (reserved)"]
+        count = count_remaining
+    try:
+        if instance_type.endswith("_spot"):
+            price = spot_prices.hourly(region, instance_type[:-5])
+        else:
+            price = ec2_offer.ondemand_hourly(instance_type=instance_type,
+                                              region=region,
+                                              operating_system='Linux',
+                                             )
+    except (ValueError, AttributeError):
+        price = 0
+    price = round(price * HOURS_PER_MONTH * count)
+    output += [f"        Instance Type: {instance_type} - Count: {count} - Price: ${price}"]
+    return price, output
+
+def price_volumes(ec2_offer, region, volume_type, size, iops):
+    """
+    Return (monthly price, output line) for volumes of one type
+    """
+    try:
+        price = ec2_offer.ebs_volume_monthly(volume_type=volume_type,
+                                             region=region
+                                            )
+    except ValueError:
+        price = 0
+    iops_price = ec2_offer.ebs_iops_monthly(volume_type=volume_type,
+                                            region=region
+                                            )
+    price = round(price * size + iops_price*iops)
+    return price, f"        Volume Type: {volume_type} - Total Size: {size} GiB - Price: ${price}"
+
+def price_snapshots(ec2_offer, region, count, size):
+    """
+    Return (monthly price, output line) for archived snapshots
+    """
+    price = ec2_offer.ebs_snapshot_monthly(region=region, archive=True)
+    price = round(price * size)
+    return price, f"        Snapshots: {size} GB in {count} snapshots - Price ${price}"
+
+def print_volume_instance_data(usage, max_workers=MAX_WORKERS):
     print("Getting price data:")
-    ec2_offer = awspricing.offer('AmazonEC2')
+    ec2_offer = aws_prices.PriceTable()
     output_per_group = {}
     price_per_group = {}
-    spot_pricing = {}
-    for group in GROUPS:
-        #import pdb; pdb.set_trace()
+    spot_prices = aws_prices.SpotPrices(max_workers=max_workers)
+    spot_prices.prefetch({key[1] for key in usage.index
+                          if key[3] == 'instance' and key[4].endswith('_spot')})
+    region_order = {region: i for i, region in enumerate(REGIONS)}
+    kind_order = {kind: i for i, kind in enumerate(KINDS)}
+
+    def sort_key(key):
+        group, region, service, kind, rtype = key
+        return (group, region_order.get(region, -1), service, kind_order[kind], rtype)
+
+    for group, group_rows in groupby(usage.rows(sort_key), key=lambda row: row[0][0]):
         output = ""
         price_group_total = 0
-        for region in REGIONS:
+        for region, region_rows in groupby(group_rows, key=lambda row: row[0][1]):
+            if region not in region_order:
+                continue
             service_output = ""
-            if region not in spot_pricing:
-                spot_pricing[region] = get_current_spot_pricing(region)
-                print(spot_pricing)
-            for service in SERVICE:
+            for service, service_rows in groupby(region_rows, key=lambda row: row[0][2]):
                 price_total = 0
-                output_instance = []
-                try:
-                    for instance_type, count in instances_data[group][region][service].items():
-                        try:
-                            if RESERVED_INSTANCES[group][region][instance_type] > 0:
-                                count_remaining = count - RESERVED_INSTANCES[group][region][instance_type]
-                                if count_remaining <= 0:
-                                    # do not count price of this instance
-                                    output_instance += [f"        Instance Type: {instance_type} - Count: {count} - Price: 0 (reserved)"]
-                                    continue
-                                else:
-                                    output_instance += [f"        Instance Type: {instance_type} - Count: {RESERVED_INSTANCES[group][region][instance_type]} - Price: 0 (reserved)"]
-                                count = count_remaining
-                        except KeyError:
-                            pass
-                        try:
-                            if instance_type.endswith("_spot"):
-                                price = spot_pricing[region][instance_type[:-5]]
-                            else:
-                                price = ec2_offer.ondemand_hourly(instance_type=instance_type,
-                                                              region=region,
-                                                              operating_system='Linux',
-                                                             )
-                        except (ValueError, AttributeError):
-                            price = 0
-                        price = round(price * HOURS_PER_MONTH * count)
-                        price_total += price
-                        output_instance += [f"        Instance Type: {instance_type} - Count: {count} - Price: ${price}"]
-                except KeyError:
-                    pass
-                output_volume = []
-                try:
-                    for volume_type, size_iops in volume_data[group][region][service].items():
-                        (size, iops) = size_iops
-                        try:
-                            price = ec2_offer.ebs_volume_monthly(volume_type=volume_type,
-                                                                 region=region
-                                                                )
-                        except ValueError:
-                            price = 0
-                        iops_price = ec2_offer.ebs_iops_monthly(volume_type=volume_type,
-                                                                region=region
-                                                                )
-                        price = round(price * size + iops_price*iops)
-                        price_total += price
-                        output_volume += [f"        Volume Type: {volume_type} - Total Size: {size} GiB - Price: ${price}"]
-                except KeyError:
-                    pass
-                output_amis = ""
-                try:
-                    output_amis = f"        # of AMIs: {amis_data[group][region][service]}"
-                except KeyError:
-                    pass
-                output_snapshots = ""
-                if group in snapshots_data and region in snapshots_data[group] and service in snapshots_data[group][region]:
-                    price = ec2_offer.ebs_snapshot_monthly(region=region, archive=True)
-                    size = snapshots_data[group][region][service]['size']
-                    price = round(price * size)
+                lines = []
+                for (_, _, _, kind, rtype), count, size, iops in service_rows:
+                    if kind == 'instance':
+                        price, output_instance = price_instances(ec2_offer, spot_prices, group,
+                                                                 region, rtype, count)
+                        lines += output_instance
+                    elif kind == 'volume':
+                        price, line = price_volumes(ec2_offer, region, rtype, size, iops)
+                        lines.append(line)
+                    elif kind == 'ami':
+                        price = 0
+                        lines.append(f"        # of AMIs: {count}")
+                    else:
+                        price, line = price_snapshots(ec2_offer, region, count, size)
+                        lines.append(line)
                     price_total += price
-                    output_snapshots = f"        Snapshots: {size} GB in {snapshots_data[group][region][service]['count']} snapshots - Price ${price}"
 
-                if output_instance or output_volume or output_amis or output_snapshots:
-                    if service != NOT_TAGGED:
-                        service_output += f"    Service Name: {service} - PriceSum: ${price_total}\n"
-                    else:
-                        service_output += f"    Service Name: N/A - PriceSum: ${price_total}\n"
-                    if output_instance:
-                        service_output += '\n'.join(output_instance) + "\n"
-                    if output_volume:
-                        service_output += '\n'.join(output_volume) + "\n"
-                    if output_amis:
-                        service_output += output_amis + "\n"
-                    if output_snapshots:
-                        service_output += output_snapshots + "\n"
+                if service != NOT_TAGGED:
+                    service_output += f"    Service Name: {service} - PriceSum: ${price_total}\n"
+                else:
+                    service_output += f"    Service Name: N/A - PriceSum: ${price_total}\n"
+                service_output += '\n'.join(lines) + "\n"
                 price_group_total += price_total
             if service_output:
                 output += f"  Region: {region}\n"
                 output += service_output.rstrip() + "\n"
         output_per_group[group] = f"{FEDORA_GROUP}: {group} - PriceSum: ${price_group_total}\n{output}\n"
         price_per_group[group] = price_group_total
+    ec2_offer.save()
     sorted_groups = sorted(output_per_group, key=lambda group: price_per_group[group], reverse=True)
     print("Summary:")
     for i in sorted_groups:
@@ -320,12 +303,23 @@ def print_volume_instance_data(volume_data, instances_data, amis_data, snapshots
         print()
 
 
-volume_data = get_volumes_by_group()
-#volume_data = {}
-instances_data = get_instances_by_group_and_region()
-#instances_data = {}
-amis_data = get_amis_by_group()
-#amis_data = {}
-snapshots_data = get_snapshots_by_group()
-#snapshots_data = {}
-print_volume_instance_data(volume_data, instances_data, amis_data, snapshots_data)
+def main():
+    global INVENTORY, REGIONS
+    parser = argparse.ArgumentParser(description='Print current AWS usage and price per FedoraGroup.')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help=f'number of parallel API workers (default: {MAX_WORKERS})')
+    aws_inventory.add_max_age_argument(parser)
+    args = parser.parse_args()
+
+    INVENTORY = aws_inventory.Inventory(max_age=args.max_age)
+    REGIONS = INVENTORY.regions()
+    REGIONS.remove('me-south-1')
+    print(REGIONS)
+    #REGIONS = ['us-east-1']
+
+    usage = gather_data(max_workers=args.workers)
+    print_volume_instance_data(usage, max_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
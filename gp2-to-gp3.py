@@ -1,8 +1,54 @@
 #!/usr/bin/python3
+"""
+Migrate all gp2 volumes to gp3.
 
+The gp2 volumes of all regions are listed in parallel, then migrated by
+aws_gp3_migration.Migration: at most --in-flight modifications run at once
+in one region, the modify_volume calls are rate-limited and the run stops
+starting new modifications after --timeout seconds.  With --plan, the
+modifications are only written into the plan, see aws_plan.py.
+"""
+
+import argparse
+import aws_bulk_delete
+import aws_gp3_migration
+import aws_plan
 import boto3
-import sys
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from aws_paginate import paginate
+
+
+def find_gp2_volumes(region):
+    """
+    Return the gp2 volumes (describe_volumes dicts) in REGION
+    """
+    client = boto3.session.Session().client('ec2', region_name=region)
+    try:
+        volumes = list(paginate(client, 'describe_volumes', 'Volumes',
+                                Filters=[{'Name': 'volume-type', 'Values': ['gp2']}]))
+    except (BotoCoreError, ClientError) as err:
+        print(f'Skipping region {region}: {err}')
+        return []
+    return volumes
+
+
+parser = argparse.ArgumentParser(description='Migrate all gp2 volumes to gp3.')
+parser.add_argument('--workers', type=int, default=aws_bulk_delete.WORKERS_PER_REGION,
+                    help='parallel modify_volume calls in one region'
+                         f' (default: {aws_bulk_delete.WORKERS_PER_REGION})')
+parser.add_argument('--in-flight', type=int, default=aws_gp3_migration.DEFAULT_IN_FLIGHT,
+                    help='max running modifications in one region'
+                         f' (default: {aws_gp3_migration.DEFAULT_IN_FLIGHT})')
+parser.add_argument('--rate', type=float, default=aws_bulk_delete.DEFAULT_RATE,
+                    help='max modify_volume calls per second in one region'
+                         f' (default: {aws_bulk_delete.DEFAULT_RATE})')
+parser.add_argument('--timeout', type=int, default=aws_gp3_migration.DEFAULT_TIMEOUT,
+                    help='stop starting new modifications after this many seconds'
+                         f' (default: {aws_gp3_migration.DEFAULT_TIMEOUT})')
+aws_plan.add_plan_argument(parser)
+args = parser.parse_args()
 
 # Create an EC2 client
 ec2 = boto3.client('ec2')
@@ -10,32 +56,24 @@ ec2 = boto3.client('ec2')
 # Get list of all available regions
 regions = [region['RegionName'] for region in ec2.describe_regions()['Regions']]
 
-for region in regions:
-    print(region)
-    ec2 = boto3.client('ec2', region_name=region)
-    
-    # Get list of all volumes in the region
-    try:
-        response = ec2.describe_volumes()
-    except:
-        print("Skipping this region")
-        continue
-
-    # Filter volumes that are of type 'gp2'
-    gp2_volumes = [volume for volume in response['Volumes'] if volume['VolumeType'] == 'gp2']
-
-    if not gp2_volumes:
-        continue
-
-    #import pdb; pdb.set_trace()
-    for volume in gp2_volumes:
-        volume_id = volume['VolumeId']
-        print(f'Migrating volume {volume_id} in region {region} from gp2 to gp3...')
-        
-        # Modify the volume type to 'gp3'
-        try:
-            ec2.modify_volume(VolumeId=volume_id, VolumeType='gp3')
-            print(f'Volume {volume_id} in region {region} migrated to gp3')
-        except ClientError as e:
-            print(e)
-    #sys.exit(1)    
+with ThreadPoolExecutor(max_workers=aws_gp3_migration.REGION_WORKERS) as executor:
+    found = dict(zip(regions, executor.map(find_gp2_volumes, regions)))
+
+plan = aws_plan.Plan.from_args(args)
+volumes = {}
+for region, region_volumes in found.items():
+    for volume in region_volumes:
+        size = volume['Size']
+        params = aws_gp3_migration.gp3_parameters(size)
+        description = f'{size} GiB gp2 -> gp3'
+        if plan:
+            plan.add(region, 'modify_volume', volume['VolumeId'], args=params, description=description,
+                     savings=aws_gp3_migration.gp3_savings(plan, region, size, params))
+        volumes.setdefault(region, []).append((volume['VolumeId'], params, description))
+
+if plan:
+    plan.write()
+else:
+    migration = aws_gp3_migration.Migration(workers=args.workers, in_flight=args.in_flight,
+                                            rate=args.rate, timeout=args.timeout)
+    migration.run(volumes)
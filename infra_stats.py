@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+"""
+Time-series store for the periodic-checker.py statistics.
+
+Every run of the checker appends one sample per (metric, key) into an SQLite
+database in the infra-stats result directory, the primary key
+(metric, key, ts) lets us read one series without scanning the history:
+
+    $ infra_stats.py query /var/lib/copr/public_html/infra-stats/ vcpus copr \
+          --since 2025-01-01 --until 2025-02-01
+
+The *-in-time.log files written before this store existed can be loaded with:
+
+    $ infra_stats.py import /var/lib/copr/public_html/infra-stats/
+"""
+
+import argparse
+import os
+import shlex
+import sqlite3
+import sys
+from datetime import datetime
+
+DB_FILE = "infra-stats.sqlite"
+
+# log file written by periodic-checker.py: metric (Stats.name)
+LOG_METRICS = {
+    "owners-in-time.log": "owners",
+    "vcpu-usage-in-time.log": "vcpus",
+    "memory-usage-in-time.log": "memory",
+    "instance-types-in-time.log": "type",
+    "instance-types-per-owner-in-time.log": "type-per-owner",
+}
+
+# logging.Formatter default asctime
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S,%f"
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return int(value.timestamp())
+
+
+class TimeSeries:
+    """
+    Append-only store of (metric, key, timestamp, value) samples
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS samples (
+                    metric TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (metric, key, ts)
+                ) WITHOUT ROWID""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def append(self, metric, timestamp, values):
+        """
+        Store VALUES ({key: value}) of METRIC sampled at TIMESTAMP
+        (datetime or unix time)
+        """
+        timestamp = _timestamp(timestamp)
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO samples (metric, key, ts, value) VALUES (?, ?, ?, ?)",
+                [(metric, key, timestamp, value) for key, value in values.items()])
+
+    def query(self, metric, key, since=None, until=None):
+        """
+        Return [(datetime, value), ...] of one series, optionally limited
+        to the [SINCE, UNTIL) interval
+        """
+        sql = "SELECT ts, value FROM samples WHERE metric = ? AND key = ?"
+        params = [metric, key]
+        if since is not None:
+            sql += " AND ts >= ?"
+            params.append(_timestamp(since))
+        if until is not None:
+            sql += " AND ts < ?"
+            params.append(_timestamp(until))
+        sql += " ORDER BY ts"
+        with self._connect() as conn:
+            return [(datetime.fromtimestamp(ts), value)
+                    for ts, value in conn.execute(sql, params)]
+
+    def import_log(self, metric, path):
+        """
+        Load an old *-in-time.log file, return the number of imported runs
+        """
+        runs = 0
+        with open(path, "r", encoding="utf8") as file:
+            for line in file:
+                try:
+                    asctime, _name, _level, message = line.rstrip("\n").split(" - ", 3)
+                    timestamp = datetime.strptime(asctime, LOG_TIME_FORMAT)
+                    values = {}
+                    for item in shlex.split(message):
+                        key, _, value = item.rpartition("=")
+                        values[key] = float(value)
+                except ValueError:
+                    print(f"Skipping malformed line in {path}: {line.strip()}")
+                    continue
+                self.append(metric, timestamp, values)
+                runs += 1
+        return runs
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Query or import infra-stats time series.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    importer = subparsers.add_parser("import", help="import the old *-in-time.log files")
+    importer.add_argument("resultdir")
+    query = subparsers.add_parser("query", help="print one series")
+    query.add_argument("resultdir")
+    query.add_argument("metric", choices=sorted(LOG_METRICS.values()))
+    query.add_argument("key", help="e.g. FedoraGroup for owners, vcpus and memory")
+    query.add_argument("--since", type=datetime.fromisoformat)
+    query.add_argument("--until", type=datetime.fromisoformat)
+    args = parser.parse_args()
+
+    timeseries = TimeSeries(os.path.join(args.resultdir, DB_FILE))
+    if args.command == "import":
+        for filename, metric in LOG_METRICS.items():
+            path = os.path.join(args.resultdir, filename)
+            if os.path.exists(path):
+                print(f"{filename}: {timeseries.import_log(metric, path)} runs imported")
+        return 0
+
+    for timestamp, value in timeseries.query(args.metric, args.key, args.since, args.until):
+        print(f"{timestamp.isoformat()} {value:g}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main())
@@ -6,6 +6,8 @@
 import argparse
 import boto3
 
+from aws_paginate import paginate
+
 def tag_resource(resource_id, region, resource_type='ami', tags={'Key': 'ExampleKey', 'Value': 'ExampleValue'}):
     ec2 = boto3.client('ec2', region_name=region)
     response = ec2.create_tags(
@@ -20,9 +22,10 @@ def find_and_tag_ami_and_snapshots(ami_id, tags):
 
     for region in regions:
         ec2 = boto3.client('ec2', region_name=region)
-        amis = ec2.describe_images(Filters=[{'Name': 'image-id', 'Values': [ami_id]}])
-        
-        for ami in amis['Images']:
+        amis = paginate(ec2, 'describe_images', 'Images',
+                        Filters=[{'Name': 'image-id', 'Values': [ami_id]}])
+
+        for ami in amis:
             print(f"Found AMI {ami_id} in {region}")
             tag_resource(ami_id, region, 'ami', tags)
             
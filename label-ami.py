@@ -9,6 +9,8 @@ import argparse
 import boto3
 import sys
 
+from aws_paginate import paginate
+
 def get_regions():
     """Get a list of all regions."""
     ec2 = boto3.client('ec2', region_name='us-east-1')  # 'us-east-1' can list all regions
@@ -34,7 +36,8 @@ def find_and_tag_amis(ami_name, tag_key, tag_value):
         
         # Find AMIs by name containing the searched string
         ami_search_pattern = f"{ami_name}*"
-        amis = ec2.describe_images(Filters=[{'Name': 'name', 'Values': [ami_search_pattern]}])['Images']
+        amis = paginate(ec2, 'describe_images', 'Images',
+                        Filters=[{'Name': 'name', 'Values': [ami_search_pattern]}])
         for ami in amis:
             ami_id = ami['ImageId']
             if not tag_exists(ami.get('Tags', []), tag_key, tag_value):
@@ -2,59 +2,365 @@
 """
 Can you write a Python script that read CSV file? Ignore first 3 lines. Fourth line is a header of a columns. If the column with name "appcode" is equal to "copr-001" or column "Resource Group Name" is equal to "copr" then calculate sum of values from column "Cost" of such rows that match the condition.
 The name of the file will be passed as command line argument.
+
+Without options the script prints the copr total as it always did.  With
+--group-by it sums the Cost of all rows per value of the given columns
+instead, e.g. for every appcode and resource group:
+
+    $ parse-ibm-cloud-bill.py --group-by appcode --group-by "Resource Group Name" \\
+          --format csv bills/2026-*.csv
+
+--where COLUMN=VALUE limits the rows, several values of one column match any
+of them, different columns must all match.
+
+Every bill is converted once into a columnar copy in CACHE_DIR, keyed by the
+SHA-256 of the bill: one file of dictionary codes per column, one string table
+shared by all columns and one file of costs.  Later runs memory-map just the
+columns they need.  --no-cache streams the CSV instead.  Several bills are
+processed in parallel processes.
 """
 
+import argparse
 import csv
+import hashlib
+import json
+import mmap
+import os
+import shutil
 import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import compress, repeat
 
 APPCODE = "copr-001"
 RESOURCE_GROUP_NAME = "copr"
+COST_COLUMN = "Cost"
+# pseudo column with the name of the bill file
+FILE_COLUMN = "file"
 
-def not_none(value, default):
-    if value is None:
-        return default
-    else:
-        return value
+CACHE_DIR = os.path.expanduser("~/.cache/fedora-infra-scripts/ibm-bills")
+CACHE_VERSION = 2
+HASH_CHUNK = 1024 * 1024
 
-def calculate_cost_sum(file_path):
+def column_indexes(header, columns):
+    """
+    Return the indexes of COLUMNS in the HEADER row, ValueError if some is missing
+    """
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"CSV file must contain the following columns: {', '.join(columns)}")
+    return [header.index(column) for column in columns]
+
+def read_rows(file_path, columns=None):
+    """
+    Yield lists with the values of COLUMNS (all when None) from every row of
+    the bill, the header row is yielded first
+    """
+    with open(file_path, 'r', newline='') as csvfile:
+        # Skip the first three lines
+        for _ in range(3):
+            next(csvfile)
+
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        columns = header if columns is None else columns
+        indexes = column_indexes(header, columns)
+        yield columns
+        for row in reader:
+            yield [row[index].strip() if index < len(row) else "" for index in indexes]
+
+def file_hash(file_path, cache_dir):
+    """
+    SHA-256 of the bill, remembered for its path, mtime and size so an
+    unchanged bill is not read again
+    """
+    stat = os.stat(file_path)
+    path = os.path.abspath(file_path)
+    index_path = os.path.join(cache_dir, "index",
+                              hashlib.sha256(path.encode()).hexdigest() + ".json")
     try:
-        with open(file_path, 'r') as csvfile:
-            # Skip the first three lines
-            for _ in range(3):
-                next(csvfile)
-
-            # Read the header row
-            reader = csv.DictReader(csvfile)
-            
-            # Validate the required columns
-            required_columns = ["appcode", "Resource Group Name", "Cost"]
-            if not all(col in reader.fieldnames for col in required_columns):
-                raise ValueError(f"CSV file must contain the following columns: {', '.join(required_columns)}")
-
-            # Calculate the sum of the "Cost" column based on the conditions
-            total_cost = 0.0
-            for row in reader:
-                try:
-                    appcode = not_none(row["appcode"], "").strip()
-                    resource_group_name = not_none(row["Resource Group Name"], "").strip()
-                    cost = float(not_none(row["Cost"], "0").strip())
-
-                    if appcode == APPCODE or resource_group_name == RESOURCE_GROUP_NAME:
-                        total_cost += cost
-                except ValueError:
-                    # Handle cases where the "Cost" column cannot be converted to float
-                    print(f"Skipping row with invalid cost value: {row}")
-
-            return total_cost
+        with open(index_path, "r", encoding="utf8") as file:
+            entry = json.load(file)
+        if entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return entry["sha256"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    entry = {"path": path, "mtime": stat.st_mtime, "size": stat.st_size,
+             "sha256": digest.hexdigest()}
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.tmp{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf8") as file:
+        json.dump(entry, file)
+    os.replace(tmp_path, index_path)
+    return entry["sha256"]
+
+def convert(file_path, directory):
+    """
+    Store the bill in columnar form into DIRECTORY
+    """
+    rows = read_rows(file_path)
+    header = next(rows)
+    columns = [column for column in header if column != COST_COLUMN]
+    cost_index = header.index(COST_COLUMN) if COST_COLUMN in header else None
+    value_indexes = [header.index(column) for column in columns]
+    strings = {}
+    codes = [array('I') for _ in columns]
+    costs = array('d')
+    skipped = 0
+    for values in rows:
+        try:
+            cost = float((values[cost_index] if cost_index is not None else "") or "0")
+        except ValueError:
+            # Handle cases where the "Cost" column cannot be converted to float
+            print(f"Skipping row with invalid cost value in {file_path}: {values}")
+            skipped += 1
+            continue
+        costs.append(cost)
+        for column_codes, index in zip(codes, value_indexes):
+            value = values[index]
+            code = strings.get(value)
+            if code is None:
+                code = strings[value] = len(strings)
+            column_codes.append(code)
+
+    tmp_directory = f"{directory}.tmp{os.getpid()}"
+    os.makedirs(tmp_directory)
+    for i, column_codes in enumerate(codes):
+        with open(os.path.join(tmp_directory, f"{i}.col"), "wb") as file:
+            column_codes.tofile(file)
+    with open(os.path.join(tmp_directory, "cost.col"), "wb") as file:
+        costs.tofile(file)
+    with open(os.path.join(tmp_directory, "strings.json"), "w", encoding="utf8") as file:
+        json.dump(list(strings), file)
+    with open(os.path.join(tmp_directory, "meta.json"), "w", encoding="utf8") as file:
+        json.dump({"version": CACHE_VERSION, "columns": columns, "cost": cost_index is not None,
+                   "rows": len(costs), "skipped": skipped}, file)
+    try:
+        os.rename(tmp_directory, directory)
+    except OSError:
+        # converted by another process meanwhile
+        shutil.rmtree(tmp_directory)
+
+class ColumnarBill:
+    """
+    Bill converted by convert(), the columns are memory-mapped on demand
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf8") as file:
+            meta = json.load(file)
+        if meta["version"] != CACHE_VERSION:
+            raise ValueError(f"Unsupported cache version in {directory}")
+        self.columns = meta["columns"]
+        self.has_cost = meta["cost"]
+        self.rows = meta["rows"]
+        # rows left out because of an invalid cost
+        self.skipped = meta["skipped"]
+        self._strings = None
+
+    @classmethod
+    def load(cls, file_path, cache_dir=CACHE_DIR):
+        """ The columnar copy of the bill, converted first if needed """
+        directory = os.path.join(cache_dir, file_hash(file_path, cache_dir))
+        if os.path.exists(os.path.join(directory, "meta.json")):
+            try:
+                return cls(directory)
+            except (ValueError, KeyError):
+                # written by an older version
+                shutil.rmtree(directory, ignore_errors=True)
+        convert(file_path, directory)
+        return cls(directory)
+
+    @property
+    def strings(self):
+        """ The string table, code: value """
+        if self._strings is None:
+            with open(os.path.join(self.directory, "strings.json"), "r", encoding="utf8") as file:
+                self._strings = json.load(file)
+        return self._strings
+
+    def _map(self, name, typecode):
+        if not self.rows:
+            return memoryview(array(typecode))
+        with open(os.path.join(self.directory, name), "rb") as file:
+            return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
 
+    def column(self, name):
+        """ Dictionary codes of the column NAME """
+        if name not in self.columns:
+            raise ValueError(f"CSV file must contain the following columns: {name}")
+        return self._map(f"{self.columns.index(name)}.col", "I")
+
+    def cost(self):
+        """ The costs """
+        if not self.has_cost:
+            raise ValueError(f"CSV file must contain the following columns: {COST_COLUMN}")
+        return self._map("cost.col", "d")
+
+    def aggregate(self, group_by, where=None, file_label=""):
+        """
+        Return {(group_by values): cost sum} of the rows matching WHERE
+        ({column: {value, ...}}), FILE_COLUMN is replaced by FILE_LABEL
+        """
+        columns = [column for column in group_by if column != FILE_COLUMN]
+        codes = [self.column(column) for column in columns]
+        costs = self.cost()
+
+        mask = None
+        if where:
+            lookup = {value: code for code, value in enumerate(self.strings)}
+            for column, values in where.items():
+                allowed = {lookup[value] for value in values if value in lookup}
+                column_codes = self.column(column)
+                if mask is None:
+                    mask = [code in allowed for code in column_codes]
+                else:
+                    mask = [selected and code in allowed
+                            for selected, code in zip(mask, column_codes)]
+
+        records = zip(zip(*codes) if codes else repeat((), len(costs)), costs)
+        if mask is not None:
+            records = compress(records, mask)
+        totals = {}
+        for key, cost in records:
+            totals[key] = totals.get(key, 0.0) + cost
+
+        strings = self.strings
+        result = {}
+        for key, cost in totals.items():
+            by_column = dict(zip(columns, (strings[code] for code in key)))
+            result[tuple(file_label if column == FILE_COLUMN else by_column[column]
+                         for column in group_by)] = cost
+        return result
+
+def aggregate_file(file_path, group_by, where=None, cache_dir=CACHE_DIR):
+    """
+    Return {(group_by values): cost sum} of one bill, FILE_COLUMN in
+    GROUP_BY is replaced by FILE_PATH.  Without CACHE_DIR the CSV is
+    streamed.
+    """
+    where = where or {}
+    if cache_dir:
+        bill = ColumnarBill.load(file_path, cache_dir)
+        if bill.skipped:
+            print(f"Skipped {bill.skipped} rows with invalid cost value in {file_path}")
+        return bill.aggregate(group_by, where, file_path)
+
+    columns = [column for column in group_by if column != FILE_COLUMN]
+    where_columns = list(where)
+    rows = read_rows(file_path, columns + where_columns + [COST_COLUMN])
+    next(rows)
+    totals = {}
+    for values in rows:
+        if any(value not in where[column]
+               for column, value in zip(where_columns, values[len(columns):-1])):
+            continue
+        try:
+            cost = float(values[-1] or "0")
+        except ValueError:
+            # Handle cases where the "Cost" column cannot be converted to float
+            print(f"Skipping row with invalid cost value in {file_path}: {values}")
+            continue
+        by_column = dict(zip(columns, values))
+        key = tuple(file_path if column == FILE_COLUMN else by_column[column]
+                    for column in group_by)
+        totals[key] = totals.get(key, 0.0) + cost
+    return totals
+
+def calculate_cost_sum(file_path, cache_dir=CACHE_DIR):
+    try:
+        totals = aggregate_file(file_path, ["appcode", "Resource Group Name"], cache_dir=cache_dir)
     except FileNotFoundError:
         print(f"File not found: {file_path}")
+        return None
+    return sum(cost for (appcode, resource_group_name), cost in totals.items()
+               if appcode == APPCODE or resource_group_name == RESOURCE_GROUP_NAME)
+
+def aggregate(file_paths, group_by, where=None, processes=None, cache_dir=CACHE_DIR):
+    """
+    Return {(group_by values): cost sum} of all FILE_PATHS, parsed in
+    parallel processes
+    """
+    totals = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for file_totals in executor.map(partial(aggregate_file, group_by=group_by, where=where,
+                                                cache_dir=cache_dir), file_paths):
+            for key, cost in file_totals.items():
+                totals[key] = totals.get(key, 0.0) + cost
+    return totals
+
+def parse_where(conditions):
+    """
+    Turn ["COLUMN=VALUE", ...] into {column: {value, ...}}
+    """
+    where = {}
+    for condition in conditions or []:
+        column, separator, value = condition.partition("=")
+        if not separator:
+            raise ValueError(f"invalid condition {condition}, use COLUMN=VALUE")
+        where.setdefault(column, set()).add(value)
+    return where
+
+def print_totals(totals, group_by, output_format):
+    """
+    Print TOTALS ordered by the cost, most expensive first
+    """
+    rows = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+    if output_format == "json":
+        json.dump([dict(zip(group_by, key), **{COST_COLUMN: round(cost, 2)}) for key, cost in rows],
+                  sys.stdout, indent=2)
+        print()
+    elif output_format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(list(group_by) + [COST_COLUMN])
+        for key, cost in rows:
+            writer.writerow(list(key) + [f"{cost:.2f}"])
+    elif not group_by:
+        print(f"Total {COST_COLUMN}: {sum(cost for _, cost in rows)}")
+    else:
+        for key, cost in rows:
+            print(", ".join(f"{column}: {value}" for column, value in zip(group_by, key))
+                  + f" - {COST_COLUMN}: {cost:.2f}")
+
+if __name__ == "__main__":
+    # the worker processes import this file
+    parser = argparse.ArgumentParser(description='Sum the costs in IBM Cloud bill CSV files.')
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('--group-by', action='append', default=[], metavar='COLUMN',
+                        help=f'sum all rows per value of COLUMN, can be repeated, "{FILE_COLUMN}"'
+                             ' groups by the bill file (default: only the copr total)')
+    parser.add_argument('--where', action='append', metavar='COLUMN=VALUE',
+                        help='sum only rows with VALUE in COLUMN, can be repeated')
+    parser.add_argument('--format', choices=['text', 'json', 'csv'], default='text',
+                        help='output format of --group-by totals (default: text)')
+    parser.add_argument('--processes', type=int,
+                        help='number of files parsed in parallel (default: number of CPUs)')
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        default=CACHE_DIR,
+                        help=f'stream the CSV files instead of using the columnar cache in {CACHE_DIR}')
+    args = parser.parse_args()
+    try:
+        where = parse_where(args.where)
+    except ValueError as e:
+        parser.error(str(e))
 
-if len(sys.argv) < 2:
-    print("Usage: python script.py <file_path>")
-    sys.exit(1)
+    if not args.group_by and not where:
+        for file_path in args.files:
+            total_cost = calculate_cost_sum(file_path, args.cache_dir)
+            if total_cost is not None:
+                print(f"Total Cost: {total_cost}")
+        sys.exit(0)
 
-file_path = sys.argv[1]
-total_cost = calculate_cost_sum(file_path)
-if total_cost is not None:
-    print(f"Total Cost: {total_cost}")
+    try:
+        totals = aggregate(args.files, args.group_by, where, args.processes, args.cache_dir)
+    except (OSError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+    print_totals(totals, args.group_by, args.format)
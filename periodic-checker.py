@@ -3,30 +3,33 @@
 """
 Script producing data in https://copr-be-dev.cloud.fedoraproject.org/infra-stats/
 """
+import hashlib
 import json
 import logging
 import os
 import shlex
 import sys
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.exceptions import BotoCoreError, ClientError
-import backoff
+
+from aws_paginate import chunks, paginate, retry_decorator
+import infra_stats
 
 LOG = logging.getLogger()
 
-def retry_decorator(max_retries=60, max_time=60):
-    """
-    Retry AWS API query
-    """
-    return backoff.on_exception(
-        backoff.expo,
-        (BotoCoreError, ClientError),
-        max_tries=max_retries,
-        max_time=max_time,
-        jitter=backoff.full_jitter,
-    )
+# number of regions analyzed in parallel
+MAX_WORKERS = 8
+
+# describe_instance_types results kept across runs, in resultdir
+INSTANCE_TYPES_CACHE = "instance-types.json"
+# describe_instance_types accepts at most this many types
+INSTANCE_TYPES_BATCH = 100
+# per-instance fingerprints and summaries from the previous run, in resultdir
+INSTANCES_STATE = "instances-state.json"
 
 @retry_decorator()
 def describe_regions_with_retry():
@@ -52,17 +55,12 @@ def describe_instance_types(region_name, instance_types):
         print(f"An error occurred while describing instances in {region_name}: {err}")
         raise  # Raise the exception to trigger a retry
 
-@retry_decorator()
 def describe_instances_with_retry(region_name):
     """
-    Get list of instances in given region
+    Iterate over reservations in given region, every page is retried
     """
-    try:
-        ec2_region = boto3.client('ec2', region_name=region_name)
-        return ec2_region.describe_instances()
-    except (BotoCoreError, ClientError) as err:
-        print(f"An error occurred while describing instances in {region_name}: {err}")
-        raise  # Raise the exception to trigger a retry
+    ec2_region = boto3.client('ec2', region_name=region_name)
+    return paginate(ec2_region, 'describe_instances', 'Reservations')
 
 
 class Stats:
@@ -80,14 +78,84 @@ class Stats:
             self.data[key] = 0
         self.data[key] += size
 
+    def merge(self, other):
+        """
+        Add counters from OTHER Stats, keeping the order of the keys
+        """
+        for key, value in other.data.items():
+            self.add(key, value)
+
     def _sorted_iterator(self):
         for key, value in sorted(self.data.items(), key=lambda item: -item[1]):
             yield key, value
 
-    def print(self, log):
-        """ self.print() but more compressed """
+    def print(self, log, timeseries=None, timestamp=None):
+        """
+        self.print() but more compressed, also store the values into
+        TIMESERIES if specified
+        """
         log.info(" ".join([f"{shlex.quote(key)}={value}"
                            for key, value in self._sorted_iterator()]))
+        if timeseries is not None:
+            timeseries.append(self.name, timestamp, self.data)
+
+
+def instance_fingerprint(instance):
+    """
+    Hash of the instance metadata analyze_instance() depends on
+    """
+    data = [
+        instance["State"]["Name"],
+        instance["InstanceType"],
+        instance["CpuOptions"]["CoreCount"],
+        sorted((tag["Key"], tag["Value"]) for tag in instance.get("Tags", [])),
+    ]
+    return hashlib.sha1(json.dumps(data).encode("utf8")).hexdigest()
+
+
+class Results:
+    """
+    Stats and per-instance summaries gathered from a set of instances
+    (e.g. one region)
+    """
+    def __init__(self):
+        self.owners = Stats("owners")
+        self.vcpus = Stats("vcpus")
+        self.memory = Stats("memory")
+        self.instance_types = Stats("type")
+        self.instance_types_per_owner = Stats("type-per-owner")
+        self.instances = {}
+
+    def add(self, instance_id, summary):
+        """
+        Account one instance SUMMARY (see Analyzer.analyze_instance)
+        """
+        self.instances[instance_id] = summary
+        if summary["state"] != "terminated":
+            fedora_group = summary["group"]
+            itype = summary["type"]
+            self.owners.add(fedora_group)
+            self.instance_types.add(itype)
+            self.instance_types_per_owner.add(f"{itype}/{fedora_group}")
+            self.vcpus.add(fedora_group, size=summary["vcpus"])
+            self.memory.add(fedora_group, size=summary["memory"])
+
+    def merge(self, other):
+        """
+        Add everything from OTHER Results
+        """
+        self.owners.merge(other.owners)
+        self.vcpus.merge(other.vcpus)
+        self.memory.merge(other.memory)
+        self.instance_types.merge(other.instance_types)
+        self.instance_types_per_owner.merge(other.instance_types_per_owner)
+        self.instances.update(other.instances)
+
+    @property
+    def errored_instances(self):
+        """ Summaries of instances with at least one error """
+        return {instance_id: summary for instance_id, summary in self.instances.items()
+                if summary["errors"]}
 
 
 class Analyzer:
@@ -109,7 +177,7 @@ class Analyzer:
         return logger
 
 
-    def __init__(self, resultdir):
+    def __init__(self, resultdir, max_workers=MAX_WORKERS):
         if os.access(resultdir, os.W_OK):
             self.resultdir = resultdir
         else:
@@ -117,36 +185,49 @@ class Analyzer:
             LOG.warning("Can't write into %s, working with %s",
                         resultdir, self.resultdir)
 
-        self.owners = Stats("owners")
-        self.vcpus = Stats("vcpus")
-        self.memory = Stats("memory")
-        self.instance_types = Stats("type")
-        self.instance_types_per_owner = Stats("type-per-owner")
-        self.errored_instances = {}
+        self.max_workers = max_workers
+        self.results = Results()
         self.log_instance_types = self._get_file_logger("instance-types-in-time.log")
         self.log_instance_types_owners = self._get_file_logger("instance-types-per-owner-in-time.log")
         self.log_owners = self._get_file_logger("owners-in-time.log")
         self.log_cpu_usage = self._get_file_logger("vcpu-usage-in-time.log")
         self.log_mem_usage = self._get_file_logger("memory-usage-in-time.log")
-        self.instance_type_description = {}
-
-
-    def _error(self, instance, message):
-        instance_id = instance["InstanceId"]
-        self.errored_instances.setdefault(instance_id, {
-            "errors": [],
-            "metadata": instance,
-        })
-        errors = self.errored_instances[instance_id]["errors"]
-        errors.append(message)
+        self.timeseries = infra_stats.TimeSeries(os.path.join(self.resultdir, infra_stats.DB_FILE))
+        self.instance_type_description = self._load_instance_types()
+        self._instance_types_changed = False
+        self.previous_instances = self._load_json(INSTANCES_STATE)
+
+
+    def _load_json(self, filename):
+        path = os.path.join(self.resultdir, filename)
+        try:
+            with open(path, "r", encoding="utf8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_json(self, filename, data, indent=4):
+        path = os.path.join(self.resultdir, filename)
+        with open(path + ".tmp", "w", encoding="utf8") as file:
+            file.write(json.dumps(data, indent=indent, sort_keys=True))
+        os.replace(path + ".tmp", path)
+
+    def _load_instance_types(self):
+        return self._load_json(INSTANCE_TYPES_CACHE)
+
+    def _save_instance_types(self):
+        if not self._instance_types_changed:
+            return
+        self._save_json(INSTANCE_TYPES_CACHE, self.instance_type_description)
 
     def analyze_instance(self, instance, region):
         """
-        Check one instance metadata
+        Check one instance metadata, return its summary
         """
         fedora_group = "N/A"
         name_tag = "N/A"
         state = instance["State"]["Name"]
+        errors = []
 
         for tag in instance.get('Tags', []):
             key = tag["Key"]
@@ -164,53 +245,113 @@ class Analyzer:
                     msg = "Tag FedoraGroup specified multiple times"
                     if value != fedora_group:
                         msg += f", changing from {fedora_group} to {value}"
-                    self._error(instance, msg)
+                    errors.append(msg)
                 fedora_group = value
 
         if fedora_group == "N/A":
-            self._error(instance, "Instance has no FedroaGroup owner")
+            errors.append("Instance has no FedroaGroup owner")
 
         # TODO: Name is very useful thing, but not mandatory raising this as
         # error would report too many errors.
         #elif name_tag == "N/A":
-        #    self._error(instance, f"Instance owned by {fedora_group} has no name=")
-
-        # backup for better error reporting
-        instance["script_override_region"] = region
-        instance["script_override_name"] = name_tag
-        instance["script_override_group"] = fedora_group
-        vcpus = instance['CpuOptions']['CoreCount']
-        memory = self.instance_type_description[instance['InstanceType']]["memory"]
-        instance["script_override_vcpus"] = vcpus
-        instance["script_override_memory"] = memory
-
-        if state != "terminated":
-            self.owners.add(fedora_group)
-            itype = instance['InstanceType']
-            self.instance_types.add(itype)
-            self.instance_types_per_owner.add(f"{itype}/{fedora_group}")
-            self.vcpus.add(fedora_group, size=vcpus)
-            self.memory.add(fedora_group, size=memory)
+        #    errors.append(f"Instance owned by {fedora_group} has no name=")
+
+        itype = instance['InstanceType']
+        return {
+            "fingerprint": instance_fingerprint(instance),
+            "region": region,
+            "name": name_tag,
+            "group": fedora_group,
+            "state": state,
+            "type": itype,
+            "vcpus": instance['CpuOptions']['CoreCount'],
+            "memory": self.instance_type_description[itype]["memory"],
+            "errors": errors,
+        }
 
     def get_instance_types_info(self, instances, region):
-        instance_types = set()
-        for instance in instances:
-            itype = instance["InstanceType"]
-            if itype in self.instance_type_description:
-                continue
-            instance_types.add(itype)
-
-        if not instance_types:
-            return
+        """
+        Make sure instance_type_description knows all types of INSTANCES,
+        unknown types are described in batches
+        """
+        instance_types = sorted({
+            instance["InstanceType"] for instance in instances
+            if instance["InstanceType"] not in self.instance_type_description
+        })
 
-        types = list(instance_types)
-        types_info = describe_instance_types(region, types)
+        for types in chunks(instance_types, INSTANCE_TYPES_BATCH):
+            types_info = describe_instance_types(region, types)
 
-        for type_info in types_info["InstanceTypes"]:
-            itype = type_info["InstanceType"]
-            self.instance_type_description[itype] = {
-                "memory": float(type_info["MemoryInfo"]["SizeInMiB"]) / 1024
-            }
+            for type_info in types_info["InstanceTypes"]:
+                itype = type_info["InstanceType"]
+                self.instance_type_description[itype] = {
+                    "memory": float(type_info["MemoryInfo"]["SizeInMiB"]) / 1024,
+                    "vcpus": type_info["VCpuInfo"]["DefaultVCpus"],
+                    "architectures": type_info["ProcessorInfo"]["SupportedArchitectures"],
+                }
+                self._instance_types_changed = True
+
+    def analyze_region(self, region):
+        """
+        List EC2 instances in REGION with retry and return Results of this
+        region.  Only new or changed instances are analyzed, the others
+        reuse their summary from the previous run.
+        """
+        results = Results()
+        summaries = {}
+        changed = []
+        for reservation in describe_instances_with_retry(region):
+            for instance in reservation['Instances']:
+                instance_id = instance["InstanceId"]
+                previous = self.previous_instances.get(instance_id)
+                if previous and previous["fingerprint"] == instance_fingerprint(instance):
+                    summaries[instance_id] = previous
+                else:
+                    summaries[instance_id] = None
+                    changed.append(instance)
+
+        self.get_instance_types_info(changed, region)
+        for instance in changed:
+            summaries[instance["InstanceId"]] = self.analyze_instance(instance, region)
+
+        for instance_id, summary in summaries.items():
+            results.add(instance_id, summary)
+        return results
+
+    def write_delta(self, timestamp):
+        """
+        Compare the instances with the previous run and write the
+        added/removed/changed instances and errors into last-run-delta.json
+        """
+        previous = self.previous_instances
+        current = self.results.instances
+        delta = {
+            "timestamp": timestamp,
+            "added": {},
+            "removed": {},
+            "changed": {},
+            "new_errors": {},
+            "resolved_errors": {},
+        }
+        for instance_id, summary in current.items():
+            old = previous.get(instance_id)
+            if old is None:
+                delta["added"][instance_id] = summary
+            elif old["fingerprint"] != summary["fingerprint"]:
+                delta["changed"][instance_id] = {"old": old, "new": summary}
+            old_errors = old["errors"] if old else []
+            if summary["errors"] and summary["errors"] != old_errors:
+                delta["new_errors"][instance_id] = summary["errors"]
+            elif old_errors and not summary["errors"]:
+                delta["resolved_errors"][instance_id] = old_errors
+
+        for instance_id, old in previous.items():
+            if instance_id not in current:
+                delta["removed"][instance_id] = old
+                if old["errors"]:
+                    delta["resolved_errors"][instance_id] = old["errors"]
+
+        self._save_json("last-run-delta.json", delta)
 
     def run(self):
         """
@@ -222,32 +363,33 @@ class Analyzer:
         # Get a list of all AWS region names
         region_names = [region['RegionName'] for region in regions]
 
-        # Loop through each region and list EC2 instances with retry
-        for region in region_names:
-            instances = describe_instances_with_retry(region)
-            for reservation in instances['Reservations']:
-                self.get_instance_types_info(reservation["Instances"], region)
-                for instance in reservation['Instances']:
-                    self.analyze_instance(instance, region)
-
-        self.owners.print(self.log_owners)
-        self.instance_types.print(self.log_instance_types)
-        self.instance_types_per_owner.print(self.log_instance_types_owners)
-        self.vcpus.print(self.log_cpu_usage)
-        self.memory.print(self.log_mem_usage)
+        # Analyze the regions in parallel, but merge the results in the
+        # region order so the output is the same as from a serial run
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for results in executor.map(self.analyze_region, region_names):
+                self.results.merge(results)
+        self._save_instance_types()
+
+        now = int(time.time())
+        self.write_delta(now)
+        self._save_json(INSTANCES_STATE, self.results.instances, indent=None)
+        self.results.owners.print(self.log_owners, self.timeseries, now)
+        self.results.instance_types.print(self.log_instance_types, self.timeseries, now)
+        self.results.instance_types_per_owner.print(self.log_instance_types_owners, self.timeseries, now)
+        self.results.vcpus.print(self.log_cpu_usage, self.timeseries, now)
+        self.results.memory.print(self.log_mem_usage, self.timeseries, now)
 
         with open(os.path.join(self.resultdir, "last-run-errors.log"), "w", encoding="utf8") as file:
             output = {}
-            for instance_id, data in self.errored_instances.items():
-                metadata = data["metadata"]
+            for instance_id, summary in self.results.errored_instances.items():
                 output_instance = output[instance_id] = {}
-                output_instance["errors"] = data["errors"]
+                output_instance["errors"] = summary["errors"]
                 output_instance["description"] = (
-                    f"Instance owned by '{metadata['script_override_group']}' "
-                    f"group, in region '{metadata['script_override_region']}', "
-                    f"with name '{metadata['script_override_name']}' ("
-                    f"consumes {metadata['script_override_vcpus']} VCPUs and "
-                    f"{metadata['script_override_memory']}GB memory)"
+                    f"Instance owned by '{summary['group']}' "
+                    f"group, in region '{summary['region']}', "
+                    f"with name '{summary['name']}' ("
+                    f"consumes {summary['vcpus']} VCPUs and "
+                    f"{summary['memory']}GB memory)"
                 )
 
             file.write(json.dumps(output, indent=4))
@@ -1,90 +1,169 @@
 #!/usr/bin/python
+"""
+Print packages added to Rawhide in a month, or a range of months, according
+to the compose report mails:
+
+    $ rawhide-changes.py 202602
+    $ rawhide-changes.py 202601 202606
+
+The mails are parsed in parallel processes and the ADDED PACKAGES of every
+mail are cached by its path, mtime and size, so a re-run parses only new or
+changed mails.
+"""
+import argparse
 import glob
+import json
 import os
 import re
 import base64
-import sys
 import email
+from concurrent.futures import ProcessPoolExecutor
 from email import policy
 from email.parser import BytesParser
 
+COMPOSES_DIR = "/home/msuchy/Downloads/composes/"
+CACHE_PATH = os.path.expanduser("~/.cache/fedora-infra-scripts/rawhide-changes.json")
+CACHE_VERSION = 2
 
-def extract_plain_text(file_path):
-    """
-    Reads an EML file and returns the plain text body.
-    """
-    try:
-        with open(file_path, 'rb') as f:
-            # We use policy.default to get a modern EmailMessage object
-            msg = BytesParser(policy=policy.default).parse(f)
+SECTION_START = "===== ADDED PACKAGES ====="
+SECTION_END = "====="
+# Regex to find Package and Summary blocks
+# Looks for 'Package: ...' followed by 'Summary: ...'
+PACKAGE_PATTERN = re.compile(r"Package:\s*(?P<pkg>.*?)\nSummary:\s*(?P<sum>.*?)\n", re.MULTILINE)
 
-        # get_body(preferencelist=('plain',)) finds the plain text part automatically
-        body_part = msg.get_body(preferencelist=('plain',))
 
-        if body_part:
-            return body_part.get_content()
-        else:
-            return "No plain text content found in this email."
+def read_plain_text(file_path):
+    """
+    Reads an EML file and returns the plain text body, None if there is none.
+    """
+    with open(file_path, 'rb') as f:
+        # We use policy.default to get a modern EmailMessage object
+        msg = BytesParser(policy=policy.default).parse(f)
 
-    except FileNotFoundError:
-        return "Error: File not found."
-    except Exception as e:
-        return f"An error occurred: {e}"
+    # get_body(preferencelist=('plain',)) finds the plain text part automatically
+    body_part = msg.get_body(preferencelist=('plain',))
+    if body_part:
+        return body_part.get_content()
+    return None
 
 def parse_email_content(content):
     """
     Finds the ADDED PACKAGES section and extracts Package and Summary.
     """
-    # Look for the section specifically
-    section_match = re.search(r"===== ADDED PACKAGES =====(.*?)(?:=====|$)", content, re.DOTALL)
-    if not section_match:
+    # Look for the section specifically, without running a regex over the whole mail
+    start = content.find(SECTION_START)
+    if start == -1:
         return
+    start += len(SECTION_START)
+    end = content.find(SECTION_END, start)
+    section_text = content[start:] if end == -1 else content[start:end]
 
-    section_text = section_match.group(1)
-    
-    # Regex to find Package and Summary blocks
-    # Looks for 'Package: ...' followed by 'Summary: ...'
-    pattern = re.compile(r"Package:\s*(?P<pkg>.*?)\nSummary:\s*(?P<sum>.*?)\n", re.MULTILINE)
-   
-    RESULT = {} 
-    for match in pattern.finditer(section_text):
+    RESULT = {}
+    for match in PACKAGE_PATTERN.finditer(section_text):
         package = match.group('pkg').strip()
         RESULT[package] = f" {package} - {match.group('sum').strip()}"
     return RESULT
 
-def main():
-    if len(sys.argv) != 2:
-        print("Usage: python script.py YYYYMM")
-        sys.exit(1)
+def parse_file(file_path):
+    """
+    Return (FILE_PATH, added packages, error) of one mail, run in the
+    worker processes
+    """
+    try:
+        content = read_plain_text(file_path)
+    except Exception as e:
+        return file_path, None, str(e)
+    return file_path, parse_email_content(content or "") or {}, None
 
-    yyyymm = sys.argv[1]
 
-    if len(yyyymm) != 6 or not yyyymm.isdigit():
-        print("Error: Parameter must be in YYYYMM format (e.g., 202602)")
-        sys.exit(1)
-   
+def load_cache(path=CACHE_PATH):
+    """ {absolute path: {"mtime":, "size":, "added": {package: line}}} """
+    try:
+        with open(path, "r", encoding="utf8") as file:
+            data = json.load(file)
+        if data["version"] == CACHE_VERSION:
+            return data["files"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+def save_cache(files, path=CACHE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as file:
+        json.dump({"version": CACHE_VERSION, "files": files}, file)
+    os.replace(tmp_path, path)
+
+
+def months(start, end):
+    """
+    Yield (year, month) strings from START to END (YYYYMM) inclusive
+    """
+    year, month = int(start[:4]), int(start[4:])
+    while f"{year:04d}{month:02d}" <= end:
+        yield f"{year:04d}", f"{month:02d}"
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+def yyyymm(value):
+    if len(value) != 6 or not value.isdigit() or not 1 <= int(value[4:]) <= 12:
+        raise argparse.ArgumentTypeError("Parameter must be in YYYYMM format (e.g., 202602)")
+    return value
+
+def main():
+    parser = argparse.ArgumentParser(description="Print packages added to Rawhide.")
+    parser.add_argument("start", type=yyyymm, metavar="YYYYMM")
+    parser.add_argument("end", type=yyyymm, nargs="?", metavar="YYYYMM",
+                        help="last month of the range (default: only the first one)")
+    parser.add_argument("--composes", default=COMPOSES_DIR,
+                        help=f"directory with the compose mails (default: {COMPOSES_DIR})")
+    parser.add_argument("--workers", type=int,
+                        help="number of parallel parsing processes (default: number of CPUs)")
+    args = parser.parse_args()
+    if args.end and args.end < args.start:
+        parser.error(f"the last month {args.end} is before the first one {args.start}")
+
     # 2. Format the search pattern
     # Transforms '202310' into '*2023-10*'
-    year = yyyymm[:4]
-    month = yyyymm[4:]
-    pattern = f"*{year}-{month}*"
-   
-    # 3. Find and process files
-    files = glob.glob("/home/msuchy/Downloads/composes/"+pattern)
-   
+    files = set()
+    for year, month in months(args.start, args.end or args.start):
+        pattern = f"*{year}-{month}*"
+        # 3. Find and process files
+        files.update(os.path.abspath(path)
+                     for path in glob.glob(os.path.join(args.composes, pattern))
+                     if os.path.isfile(path))
+
     if not files:
         print("No matching files found.")
         return
-   
+
+    cache = load_cache()
+    # forget the mails deleted since the last run
+    gone = [path for path in cache if not os.path.isfile(path)]
+    for path in gone:
+        del cache[path]
+    stats = {path: os.stat(path) for path in files}
+    todo = sorted(path for path in files
+                  if path not in cache
+                  or cache[path]["mtime"] != stats[path].st_mtime
+                  or cache[path]["size"] != stats[path].st_size)
+    if todo:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            for file_path, added, error in executor.map(parse_file, todo, chunksize=8):
+                if error is not None:
+                    print(f"Could not read file {file_path}: {error}")
+                    continue
+                cache[file_path] = {"mtime": stats[file_path].st_mtime,
+                                    "size": stats[file_path].st_size,
+                                    "added": added}
+    if todo or gone:
+        save_cache(cache)
+
     RESULT = {}
-    for file_path in files:
-        if os.path.isfile(file_path):
-            #print(f"Processing: {file_path}")
-            try:
-                content = extract_plain_text(file_path)
-                RESULT.update(parse_email_content(content))
-            except Exception as e:
-                print(f"Could not read file {file_path}: {e}")
+    for file_path in sorted(files):
+        if file_path in cache:
+            RESULT.update(cache[file_path]["added"])
     for i in sorted(RESULT.keys()):
         print(RESULT[i])
 
@@ -1,42 +1,98 @@
 #!/usr/bin/python
+"""
+Back volumes up into snapshots and delete them.
 
-import boto3
+    $ snapshot-and-delete-volume.py us-east-1 vol-0123456789abcdef0
+    $ snapshot-and-delete-volume.py --file volumes.txt     # "region volume_id" lines, - for stdin
+    $ snapshot-and-delete-volume.py --older-than 30        # available volumes older than 30 days
+
+The work is done by aws_snapshot_delete.SnapshotAndDelete: the regions are
+processed in parallel, the pending snapshots are polled in batches and every
+volume is deleted only once its snapshot is 'completed'.
+"""
+
+import argparse
+import aws_bulk_delete
+import aws_inventory
+import aws_plan
+import aws_snapshot_delete
 import sys
+from botocore.exceptions import BotoCoreError, ClientError
+from datetime import datetime, timedelta, timezone
+
+
+def read_volumes(file):
+    """
+    Read "region volume_id" lines, return {region: [volume_id, ...]}
+    """
+    volumes = {}
+    for line in file:
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        region, volume_id = line.split()
+        volumes.setdefault(region, []).append(volume_id)
+    return volumes
+
+
+def find_old_volumes(inventory, days):
+    """
+    Return {region: [volume_id, ...]} of unattached volumes older than DAYS
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    volumes = {}
+    for region in inventory.regions():
+        try:
+            region_volumes = inventory.volumes(region)
+        except (BotoCoreError, ClientError) as err:
+            print(f"Skipping region {region}: {err}")
+            continue
+        old = [volume['VolumeId'] for volume in region_volumes
+               if volume['State'] == 'available' and volume['CreateTime'] < cutoff]
+        if old:
+            volumes[region] = old
+    return volumes
+
+
+parser = argparse.ArgumentParser(description='Snapshot volumes and delete them.')
+parser.add_argument('region', nargs='?')
+parser.add_argument('volume_id', nargs='?')
+parser.add_argument('--file', type=argparse.FileType('r'), metavar='FILE',
+                    help='read "region volume_id" lines from FILE, - for stdin')
+parser.add_argument('--older-than', type=int, metavar='DAYS',
+                    help='process all available (unattached) volumes older than DAYS')
+parser.add_argument('--workers', type=int, default=aws_bulk_delete.WORKERS_PER_REGION,
+                    help=f'parallel API calls in one region (default: {aws_bulk_delete.WORKERS_PER_REGION})')
+parser.add_argument('--rate', type=float, default=aws_bulk_delete.DEFAULT_RATE,
+                    help=f'max API calls per second in one region (default: {aws_bulk_delete.DEFAULT_RATE})')
+parser.add_argument('--timeout', type=int, default=aws_snapshot_delete.DEFAULT_TIMEOUT,
+                    help='stop waiting for snapshots after this many seconds'
+                         f' (default: {aws_snapshot_delete.DEFAULT_TIMEOUT})')
+aws_inventory.add_max_age_argument(parser, default=0)
+aws_plan.add_plan_argument(parser)
+args = parser.parse_args()
+
+inventory = aws_inventory.Inventory(max_age=args.max_age)
+if args.file:
+    volumes = read_volumes(args.file)
+elif args.older_than is not None:
+    volumes = find_old_volumes(inventory, args.older_than)
+elif args.volume_id:
+    volumes = {args.region: [args.volume_id]}
+else:
+    parser.error("specify REGION VOLUME_ID, --file or --older-than")
+
+if args.plan:
+    plan = aws_plan.Plan(args.plan, inventory=inventory)
+    for region, volume_ids in volumes.items():
+        for volume_id in volume_ids:
+            plan.add(region, 'snapshot_and_delete_volume', volume_id)
+    plan.write()
+    sys.exit(0)
 
-def create_snapshot_with_tag(region, volume_id):
-    # Initialize the EC2 client
-    ec2_client = boto3.client('ec2', region_name=region)
-    
-    # Create the snapshot
-    response = ec2_client.create_snapshot(
-        VolumeId=volume_id,
-        Description=f'GC - Snapshot of {volume_id}',
-        TagSpecifications=[
-            {
-                'ResourceType': 'snapshot',
-                'Tags': [
-                    {
-                        'Key': 'FedoraGroup',
-                        'Value': 'garbage-collector'
-                    }
-                ]
-            }
-        ]
-    )
-    
-    # Print out snapshot ID
-    snapshot_id = response['SnapshotId']
-    print(f"Created snapshot with ID: {snapshot_id}")
-
-    # Delete the original volume after the snapshot is created
-    ec2_client.delete_volume(VolumeId=volume_id)
-    print(f"Deleted the original volume with ID: {volume_id}")
-
-if len(sys.argv) != 3:
-    print("Usage: python3 snapshot-and-delete-volume.py <region> <volume_id>")
-    sys.exit(1)
-
-region_name = sys.argv[1]
-volume_id = sys.argv[2]
-
-create_snapshot_with_tag(region_name, volume_id)
+stats = aws_snapshot_delete.SnapshotAndDelete(workers=args.workers, rate=args.rate,
+                                              timeout=args.timeout).run(volumes)
+for region in volumes:
+    inventory.invalidate(region, 'volumes')
+    inventory.invalidate(region, 'snapshots')
+sys.exit(1 if stats['failed'] else 0)
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+"""
+Benchmark of the raw-dict scan of aws-resources-without-tag.py against the
+boto3 resource API scan it replaced, on a large moto fleet:
+
+    $ python3 tests/benchmark_aws_resources_without_tag.py --instances 100 --memory
+
+All scans see the same resources and must report the same ones, the
+resource API scan resolves the instance names from its own instances pass
+(like the raw one), so only the resource objects make the difference.  The
+raw scan runs twice, through the inventory cache (--format text) and
+streamed page by page (--format jsonl|csv).
+"""
+
+import argparse
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+import boto3
+import boto3.resources.base
+
+from conftest import load_script
+import aws_inventory
+import moto_fleet
+
+script = load_script("aws-resources-without-tag.py")
+
+REGION = "us-east-1"
+# moto creates everything now, look at the fleet two days later so the
+# 24 hours age filter lets the resources through
+SHIFT = timedelta(days=2)
+
+
+class Later(datetime):
+    """ datetime whose now() is SHIFT in the future """
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(tz) + SHIFT
+
+
+def _tag(tags, key):
+    for tag in tags or []:
+        if tag['Key'] == key:
+            return tag['Value']
+    return 'N/A'
+
+
+def resource_api_scan(region):
+    """
+    The resource API scan, return the set of (type, id, name) of untagged resources
+    """
+    cutoff = datetime.now(timezone.utc) + SHIFT - timedelta(days=1)
+    ec2 = boto3.resource('ec2', region_name=region)
+    client = boto3.client('ec2', region_name=region)
+    found = set()
+    names = {}
+    for instance in ec2.instances.all():
+        names[instance.id] = _tag(instance.tags, 'Name')
+        if instance.launch_time < cutoff and 'FedoraGroup' not in [tag['Key'] for tag in instance.tags or []]:
+            found.add(('instance', instance.id, _tag(instance.tags, 'Name')))
+    for volume in ec2.volumes.all():
+        if volume.create_time < cutoff and 'FedoraGroup' not in [tag['Key'] for tag in volume.tags or []]:
+            attachment = volume.attachments[0] if volume.attachments else {}
+            found.add(('volume', volume.id, names.get(attachment.get('InstanceId'), 'N/A')))
+    for ami in client.describe_images(Owners=['self'])['Images']:
+        if 'FedoraGroup' not in {tag['Key'] for tag in ami.get('Tags', [])}:
+            found.add(('ami', ami['ImageId'], ami.get('Name', '')))
+    for snapshot in ec2.snapshots.filter(OwnerIds=['self']):
+        if snapshot.start_time < cutoff and 'FedoraGroup' not in [tag['Key'] for tag in snapshot.tags or []]:
+            found.add(('snapshot', snapshot.id, _tag(snapshot.tags, 'Name')))
+    return found
+
+
+def new_inventory(region, path):
+    """
+    Empty inventory whose client is created already, loading the EC2
+    service model of its session is not part of the scan
+    """
+    inventory = aws_inventory.Inventory(max_age=0, path=path)
+    inventory._client(region)  # pylint: disable=protected-access
+    return inventory
+
+
+def raw_scan(region, inventory, stream=False):
+    """
+    The current scan, return the set of (type, id, name) of untagged
+    resources, with STREAM like --format jsonl|csv
+    """
+    with mock.patch.object(script, "datetime", Later):
+        records = script.iter_untagged_resources(inventory, region, stream=stream)
+        return {(record['type'], record['id'],
+                 record['instance'] if record['type'] == 'volume'
+                 else record['name']) for record in records}
+
+
+def measure(scan, *args, memory=False):
+    """
+    Return (result, seconds, peak MiB, resource objects created), the peak
+    is traced only with MEMORY, tracing slows everything down
+    """
+    created = 0
+    init = boto3.resources.base.ServiceResource.__init__
+
+    def counting_init(resource, *init_args, **kwargs):
+        nonlocal created
+        created += 1
+        init(resource, *init_args, **kwargs)
+
+    with mock.patch.object(boto3.resources.base.ServiceResource, "__init__", counting_init):
+        if memory:
+            tracemalloc.start()
+        started = time.monotonic()
+        result = scan(*args)
+        seconds = time.monotonic() - started
+        peak = None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+    return result, seconds, peak, created
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the untagged resources scan.")
+    parser.add_argument("--instances", type=int, default=100)
+    parser.add_argument("--volumes-per-instance", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every API call")
+    parser.add_argument("--memory", action="store_true", help="trace the peak memory (slow)")
+    args = parser.parse_args()
+
+    with moto_fleet.fleet([REGION], latency=args.latency, instances=args.instances,
+                          volumes_per_instance=args.volumes_per_instance,
+                          snapshots=args.instances, images=10) as calls, \
+            tempfile.TemporaryDirectory() as cache_dir:
+        print(f"{args.instances} instances, {args.volumes_per_instance} volumes per instance,"
+              f" {args.instances} snapshots in {REGION}")
+        print("scan           untagged  seconds  peak MiB  resource objects  API calls")
+        results = []
+        for label, scan, scan_args in (("resource API", resource_api_scan, (REGION,)),
+                                       ("raw dicts", raw_scan,
+                                        (REGION, new_inventory(REGION, f"{cache_dir}/cached.sqlite"))),
+                                       ("raw streamed", raw_scan,
+                                        (REGION, new_inventory(REGION, f"{cache_dir}/streamed.sqlite"), True))):
+            calls.reset()
+            found, seconds, peak, created = measure(scan, *scan_args, memory=args.memory)
+            results.append(found)
+            peak = "-" if peak is None else f"{peak:.1f}"
+            print(f"{label:<14} {len(found):>8} {seconds:>8.2f} {peak:>9} {created:>17} {calls.total:>10}")
+        assert results[0] == results[1] == results[2], "the scans found different resources"
+
+
+if __name__ == "__main__":
+    main()
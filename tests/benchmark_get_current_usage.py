@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+"""
+Benchmark of the concurrent collection in get_current_usage.py against the
+moto fleet, every API call delayed by --latency like a real round trip:
+
+    $ python3 tests/benchmark_get_current_usage.py --regions 8 --latency 0.2
+"""
+
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+
+import conftest  # pylint: disable=unused-import
+import aws_inventory
+import get_current_usage
+import moto_fleet
+
+REGIONS = ["us-east-1", "us-east-2", "us-west-1", "us-west-2", "eu-west-1", "eu-west-2",
+           "eu-central-1", "ap-south-1", "ap-northeast-1", "ap-southeast-1", "ca-central-1",
+           "sa-east-1"]
+
+
+def measure(workers, regions, cache_dir):
+    """ Return (seconds, usage rows) of one gather_data() run """
+    get_current_usage.INVENTORY = aws_inventory.Inventory(
+        max_age=0, path=f"{cache_dir}/inventory-{workers}.sqlite")
+    get_current_usage.REGIONS = list(regions)
+    started = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        usage = get_current_usage.gather_data(max_workers=workers)
+    return time.monotonic() - started, list(usage.rows())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark get_current_usage.gather_data().")
+    parser.add_argument("--regions", type=int, default=8, help="number of regions (max 12)")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds added to every API call")
+    parser.add_argument("--instances", type=int, default=20, help="instances per region")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, get_current_usage.MAX_WORKERS])
+    args = parser.parse_args()
+
+    regions = REGIONS[:args.regions]
+    with moto_fleet.fleet(regions, latency=args.latency, instances=args.instances,
+                          snapshots=args.instances) as calls, \
+            tempfile.TemporaryDirectory() as cache_dir:
+        print(f"{len(regions)} regions, {args.instances} instances per region,"
+              f" {args.latency}s per API call")
+        print("workers  seconds  API calls  speedup")
+        baseline = None
+        for workers in args.workers:
+            calls.reset()
+            seconds, rows = measure(workers, regions, cache_dir)
+            if baseline is None:
+                baseline = (seconds, rows)
+            assert rows == baseline[1], "the result depends on the number of workers"
+            print(f"{workers:>7} {seconds:>8.2f} {calls.total:>10} {baseline[0] / seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
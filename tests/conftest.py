@@ -0,0 +1,23 @@
+"""
+The scripts are not a package, make the aws_*.py modules and the scripts importable
+"""
+
+import importlib.util
+import os
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(REPO, "tests", "fixtures")
+
+sys.path.insert(0, REPO)
+
+
+def load_script(name):
+    """
+    Import the script NAME (e.g. "aws-resources-without-tag.py") as a module
+    """
+    path = os.path.join(REPO, name)
+    spec = importlib.util.spec_from_file_location(name[:-3].replace("-", "_"), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,108 @@
+"""
+Moto-backed multi-region stand-in of our EC2 fleet, for the tests and the
+benchmark_*.py scripts:
+
+    with moto_fleet.fleet(["us-east-1", "eu-west-1"], latency=0.05) as calls:
+        ...
+        print(calls.total, calls.by_operation)
+
+Every call sent to the fake AWS is counted and, with LATENCY, delayed like a
+real round trip, moto alone answers in microseconds and would hide what the
+concurrency saves.
+"""
+
+import contextlib
+import os
+import threading
+import time
+from unittest import mock
+
+import boto3
+import botocore.client
+from moto import mock_aws
+
+AMI = "ami-12c6146b"
+GROUPS = ("copr", "ci", "infra")
+
+
+class CallCounter:
+    """ API calls sent during the fleet() block """
+    def __init__(self):
+        self.by_operation = {}
+        self.lock = threading.Lock()
+
+    def add(self, operation):
+        with self.lock:
+            self.by_operation[operation] = self.by_operation.get(operation, 0) + 1
+
+    @property
+    def total(self):
+        return sum(self.by_operation.values())
+
+    def reset(self):
+        with self.lock:
+            self.by_operation = {}
+
+
+def _tags(i, name):
+    """ Every fourth resource has no FedoraGroup """
+    tags = [{"Key": "Name", "Value": f"{name}-{i}"}]
+    if i % 4:
+        tags.append({"Key": "FedoraGroup", "Value": GROUPS[i % len(GROUPS)]})
+    return tags
+
+
+def populate(region, instances=10, volumes_per_instance=1, snapshots=10, images=2):
+    """
+    Create INSTANCES with attached volumes, SNAPSHOTS and IMAGES in REGION
+    """
+    client = boto3.client("ec2", region_name=region)
+    zone = f"{region}a"
+    instance_ids = []
+    for i in range(instances):
+        instance = client.run_instances(
+            ImageId=AMI, MinCount=1, MaxCount=1, InstanceType="t3.small",
+            Placement={"AvailabilityZone": zone},
+            TagSpecifications=[{"ResourceType": "instance", "Tags": _tags(i, "worker")}])
+        instance_ids.append(instance["Instances"][0]["InstanceId"])
+    volume_ids = []
+    for i, instance_id in enumerate(instance_ids):
+        for j in range(volumes_per_instance):
+            volume_id = client.create_volume(
+                AvailabilityZone=zone, Size=10 + j, VolumeType="gp3",
+                TagSpecifications=[{"ResourceType": "volume", "Tags": _tags(i, "data")}])["VolumeId"]
+            client.attach_volume(VolumeId=volume_id, InstanceId=instance_id, Device=f"/dev/sd{chr(102 + j)}")
+            volume_ids.append(volume_id)
+    for i in range(snapshots):
+        client.create_snapshot(
+            VolumeId=volume_ids[i % len(volume_ids)],
+            TagSpecifications=[{"ResourceType": "snapshot", "Tags": _tags(i, "backup")}])
+    for i in range(images):
+        image_id = client.create_image(InstanceId=instance_ids[i % len(instance_ids)],
+                                       Name=f"image-{region}-{i}")["ImageId"]
+        client.create_tags(Resources=[image_id], Tags=_tags(i, "image"))
+
+
+@contextlib.contextmanager
+def fleet(regions, latency=0, **sizes):
+    """
+    Fake AWS with the fleet (see populate() for SIZES) in REGIONS, yield the
+    CallCounter of the calls made inside the block
+    """
+    credentials = {"AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+                   "AWS_DEFAULT_REGION": "us-east-1"}
+    with mock.patch.dict(os.environ, credentials), mock_aws():
+        for region in regions:
+            populate(region, **sizes)
+
+        calls = CallCounter()
+        make_api_call = botocore.client.BaseClient._make_api_call
+
+        def counted(client, operation, params):
+            calls.add(operation)
+            if latency:
+                time.sleep(latency)
+            return make_api_call(client, operation, params)
+
+        with mock.patch.object(botocore.client.BaseClient, "_make_api_call", counted):
+            yield calls
@@ -0,0 +1,78 @@
+"""
+aws_bulk_delete.py against moto
+"""
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import aws_bulk_delete
+
+REGION = "us-east-1"
+
+
+class Interrupted(Exception):
+    """ The run was killed """
+
+
+@pytest.fixture(name="client")
+def fixture_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        yield boto3.client("ec2", region_name=REGION)
+
+
+def _snapshot_id(client, image_id):
+    image = client.describe_images(ImageIds=[image_id])["Images"][0]
+    return image["BlockDeviceMappings"][0]["Ebs"]["SnapshotId"]
+
+
+def _snapshot_exists(client, snapshot_id):
+    filters = [{"Name": "snapshot-id", "Values": [snapshot_id]}]
+    return bool(client.describe_snapshots(OwnerIds=["self"], Filters=filters)["Snapshots"])
+
+
+def test_resumed_run_deletes_snapshots_of_earlier_deregistered_amis(client, tmp_path):
+    instance_id = client.run_instances(ImageId="ami-12c6146b", MinCount=1, MaxCount=1)[
+        "Instances"][0]["InstanceId"]
+    doomed = [client.create_image(InstanceId=instance_id, Name=f"doomed-{i}")["ImageId"]
+              for i in range(3)]
+    snapshots = {image_id: _snapshot_id(client, image_id) for image_id in doomed}
+    kept = client.create_image(InstanceId=instance_id, Name="kept")["ImageId"]
+    checkpoint = str(tmp_path / "amis.done")
+
+    def select(index, region):
+        images = client.describe_images(Owners=["self"])["Images"]
+        for image in images:
+            # the snapshot of the first doomed AMI is used by the kept one
+            # too, moto ignores the mappings of register_image
+            if image["ImageId"] == kept:
+                image["BlockDeviceMappings"].append(
+                    {"DeviceName": "/dev/sdb", "Ebs": {"SnapshotId": snapshots[doomed[0]]}})
+        index.add_images(region, images)
+        return sorted((image["ImageId"], image["Name"]) for image in images
+                      if image["Name"].startswith("doomed"))
+
+    # killed right after the second AMI was deregistered, before it was checkpointed
+    def interrupted(ec2, image_id):
+        aws_bulk_delete.deregister_image(ec2, image_id)
+        if image_id == doomed[1]:
+            raise Interrupted()
+
+    index = aws_bulk_delete.SnapshotIndex()
+    deleter = aws_bulk_delete.BulkDeleter(interrupted, checkpoint=checkpoint, rate=100, workers=1,
+                                          cascade=index)
+    with pytest.raises(Interrupted):
+        deleter.run([REGION], lambda region: select(index, region))
+    assert all(_snapshot_exists(client, snapshot_id) for snapshot_id in snapshots.values())
+
+    index = aws_bulk_delete.SnapshotIndex()
+    deleter = aws_bulk_delete.BulkDeleter(aws_bulk_delete.deregister_image, checkpoint=checkpoint,
+                                          rate=100, cascade=index)
+    deleter.run([REGION], lambda region: select(index, region))
+
+    assert [image["ImageId"] for image in client.describe_images(Owners=["self"])["Images"]] == [kept]
+    assert _snapshot_exists(client, snapshots[doomed[0]])
+    assert not _snapshot_exists(client, snapshots[doomed[1]])
+    assert not _snapshot_exists(client, snapshots[doomed[2]])
@@ -0,0 +1,62 @@
+"""
+aws_gp3_migration.py and the modify_volume plans against moto
+"""
+
+import argparse
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import aws_gp3_migration
+import aws_plan
+
+REGION = "us-east-1"
+
+
+@pytest.fixture(name="client")
+def fixture_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(aws_gp3_migration, "POLL_INTERVAL", 0)
+    with mock_aws():
+        yield boto3.client("ec2", region_name=REGION)
+
+
+def _gp2_volumes(client, count):
+    return [client.create_volume(AvailabilityZone=f"{REGION}a", Size=10 * (i + 1),
+                                 VolumeType="gp2")["VolumeId"]
+            for i in range(count)]
+
+
+def _volume_types(client, volume_ids):
+    volumes = client.describe_volumes(VolumeIds=volume_ids)["Volumes"]
+    return {volume["VolumeId"]: volume["VolumeType"] for volume in volumes}
+
+
+def test_poll_drops_deleted_volume(client):
+    volume_ids = _gp2_volumes(client, 3)
+    for volume_id in volume_ids:
+        client.modify_volume(VolumeId=volume_id, VolumeType="gp3")
+    client.delete_volume(VolumeId=volume_ids[1])
+
+    migration = aws_gp3_migration.Migration()
+    assert migration._poll(client, REGION, volume_ids) == set(volume_ids)
+    assert migration.stats["migrated"] == 2 and migration.stats["failed"] == 1
+
+
+def test_apply_modify_volume_plan(client, tmp_path):
+    volume_ids = _gp2_volumes(client, 3)
+    plan = aws_plan.Plan(str(tmp_path / "gp3.plan"), script="test")
+    for volume_id in volume_ids:
+        plan.add(REGION, "modify_volume", volume_id, args={"VolumeType": "gp3"},
+                 description="10 GiB gp2 -> gp3", savings=0)
+    args = argparse.Namespace(checkpoint=str(tmp_path / "gp3.done"), rate=100, workers=4,
+                              dry_run=False)
+
+    stats = aws_plan.apply(plan, args)
+
+    assert stats["migrated"] == 3 and stats["failed"] == 0 and stats["unfinished"] == 0
+    assert set(_volume_types(client, volume_ids).values()) == {"gp3"}
+    # resumed, the migrated volumes are in the checkpoint
+    assert aws_plan.apply(plan, args)["skipped"] == 3
@@ -0,0 +1,86 @@
+"""
+aws_plan.py apply against moto
+"""
+
+import argparse
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+from moto import mock_aws
+
+import aws_bulk_delete
+import aws_plan
+
+REGION = "us-east-1"
+TAGS = [{"Key": "FedoraGroup", "Value": "ci"}]
+
+
+@pytest.fixture(name="client")
+def fixture_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        yield boto3.client("ec2", region_name=REGION)
+
+
+def _args(tmp_path):
+    return argparse.Namespace(checkpoint=str(tmp_path / "plan.done"), rate=100, workers=4,
+                              dry_run=False)
+
+
+def _group(client, resource_id):
+    tags = client.describe_tags(Filters=[{"Name": "resource-id", "Values": [resource_id]},
+                                         {"Name": "key", "Values": ["FedoraGroup"]}])["Tags"]
+    return [tag["Value"] for tag in tags]
+
+
+def _plan(tmp_path, resource_ids):
+    plan = aws_plan.Plan(str(tmp_path / "tags.plan"), script="test")
+    for resource_id in resource_ids:
+        plan.add(REGION, "create_tags", resource_id, args={"Tags": TAGS}, savings=0)
+    return plan
+
+
+def test_apply_tags_with_vanished_volume(client, tmp_path):
+    volume_ids = [client.create_volume(AvailabilityZone=f"{REGION}a", Size=1)["VolumeId"]
+                  for _ in range(3)]
+    plan = _plan(tmp_path, volume_ids)
+    client.delete_volume(VolumeId=volume_ids[1])
+
+    stats = aws_plan.apply(plan, _args(tmp_path))
+
+    assert stats["deleted"] == 1 and stats["failed"] == 0
+    assert _group(client, volume_ids[0]) == ["ci"]
+    assert _group(client, volume_ids[2]) == ["ci"]
+
+
+def test_apply_tags_error_without_ids(client, tmp_path):
+    """ moto names no snapshot in InvalidSnapshot.NotFound, the chunk is split """
+    volume_id = client.create_volume(AvailabilityZone=f"{REGION}a", Size=1)["VolumeId"]
+    snapshot_ids = [client.create_snapshot(VolumeId=volume_id)["SnapshotId"] for _ in range(4)]
+    plan = _plan(tmp_path, snapshot_ids)
+    client.delete_snapshot(SnapshotId=snapshot_ids[2])
+
+    stats = aws_plan.apply(plan, _args(tmp_path))
+
+    assert stats["deleted"] == 1 and stats["failed"] == 0
+    assert [_group(client, snapshot_id) for snapshot_id in snapshot_ids] == [
+        ["ci"], ["ci"], [], ["ci"]]
+    # resumed, the batch is in the checkpoint
+    assert aws_plan.apply(plan, _args(tmp_path))["skipped"] == 1
+
+
+def test_create_tags_drops_terminated_instances():
+    client = boto3.client("ec2", region_name=REGION,
+                          aws_access_key_id="testing", aws_secret_access_key="testing")
+    instance_ids = ["i-0aaa", "i-0bbb", "i-0ccc", "i-0ddd"]
+    with Stubber(client) as stubber:
+        stubber.add_client_error("create_tags", "InvalidInstanceID.NotFound",
+                                 "The instance IDs 'i-0aaa, i-0ccc' do not exist",
+                                 expected_params={"Resources": instance_ids, "Tags": TAGS})
+        stubber.add_response("create_tags", {},
+                             expected_params={"Resources": ["i-0bbb", "i-0ddd"], "Tags": TAGS})
+        gone = aws_plan.create_tags(client, aws_bulk_delete.TokenBucket(100), instance_ids, TAGS)
+        stubber.assert_no_pending_responses()
+    assert gone == ["i-0aaa", "i-0ccc"]
@@ -0,0 +1,33 @@
+"""
+aws_prices.SpotPrices against moto
+"""
+
+import boto3
+from moto import mock_aws
+
+import aws_prices
+
+REGIONS = ["us-east-1", "eu-west-1"]
+
+
+def test_spot_prices_one_session(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    sessions = []
+    session_class = boto3.session.Session
+
+    def counted_session(*args, **kwargs):
+        sessions.append(None)
+        return session_class(*args, **kwargs)
+
+    monkeypatch.setattr(aws_prices.boto3.session, "Session", counted_session)
+    with mock_aws():
+        spot_prices = aws_prices.SpotPrices()
+        spot_prices.prefetch(REGIONS)
+        for instance_type in ("t3.small", "t3.medium", "m5.large"):
+            for region in REGIONS:
+                assert spot_prices.hourly(region, instance_type) > 0
+
+    # the history lookups reuse the clients of the prefetch
+    assert len(sessions) == 1
+    assert sorted(spot_prices._clients) == sorted(REGIONS)
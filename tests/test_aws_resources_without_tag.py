@@ -0,0 +1,61 @@
+"""
+aws-resources-without-tag.py against a stubbed EC2 client
+"""
+
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import aws_inventory
+from conftest import load_script
+
+script = load_script("aws-resources-without-tag.py")
+
+OLD = datetime.now(timezone.utc) - timedelta(days=30)
+INSTANCES = 20
+VOLUMES_PER_INSTANCE = 5
+
+
+class StubbedSession:
+    """ boto3.session.Session() handing out the one stubbed client """
+    client_instance = None
+
+    def client(self, *_args, **_kwargs):
+        return self.client_instance
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_instance_names_one_describe_instances_per_region(tmp_path, monkeypatch, stream):
+    client = boto3.client("ec2", region_name="us-east-1",
+                          aws_access_key_id="testing", aws_secret_access_key="testing")
+    instances = [{"InstanceId": f"i-{i:04d}", "LaunchTime": OLD,
+                  "Tags": [{"Key": "Name", "Value": f"worker-{i}"},
+                           {"Key": "FedoraGroup", "Value": "ci"}]}
+                 for i in range(INSTANCES)]
+    volumes = [{"VolumeId": f"vol-{i:04d}-{j}", "Size": 10, "CreateTime": OLD,
+                "Attachments": [{"InstanceId": f"i-{i:04d}"}]}
+               for i in range(INSTANCES) for j in range(VOLUMES_PER_INSTANCE)]
+    with Stubber(client) as stubber:
+        # exactly these four calls: any other one, e.g. a describe_instances
+        # per volume, raises, and a missing one fails the pending check
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": instances}]})
+        stubber.add_response("describe_volumes", {"Volumes": volumes})
+        stubber.add_response("describe_images", {"Images": []})
+        stubber.add_response("describe_snapshots", {"Snapshots": []})
+        StubbedSession.client_instance = client
+        monkeypatch.setattr(aws_inventory.boto3.session, "Session", StubbedSession)
+
+        inventory = aws_inventory.Inventory(max_age=0, path=str(tmp_path / "inventory.sqlite"))
+        records = list(script.iter_untagged_resources(inventory, "us-east-1", stream=stream))
+        stubber.assert_no_pending_responses()
+
+    with sqlite3.connect(inventory.path) as conn:
+        cached = conn.execute("SELECT COUNT(*) FROM crawl").fetchone()[0]
+    # the streamed pages are not cached
+    assert cached == (0 if stream else 4)
+
+    assert len(records) == INSTANCES * VOLUMES_PER_INSTANCE
+    assert {record["instance"] for record in records} == {f"worker-{i}" for i in range(INSTANCES)}
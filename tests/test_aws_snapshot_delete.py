@@ -0,0 +1,47 @@
+"""
+aws_snapshot_delete.py against moto
+"""
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import aws_snapshot_delete
+
+REGION = "us-east-1"
+
+
+@pytest.fixture(name="client")
+def fixture_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setattr(aws_snapshot_delete, "POLL_INTERVAL", 0)
+    with mock_aws():
+        yield boto3.client("ec2", region_name=REGION)
+
+
+def _volumes(client, count):
+    return [client.create_volume(AvailabilityZone=f"{REGION}a", Size=1)["VolumeId"]
+            for _ in range(count)]
+
+
+def test_poll_reports_deleted_snapshot_missing(client):
+    volume_id = _volumes(client, 1)[0]
+    snapshot_ids = [client.create_snapshot(VolumeId=volume_id)["SnapshotId"] for _ in range(3)]
+    client.delete_snapshot(SnapshotId=snapshot_ids[1])
+
+    finished = aws_snapshot_delete.SnapshotAndDelete()._poll(client, REGION, snapshot_ids)
+    assert finished == {snapshot_ids[0]: "completed", snapshot_ids[1]: "missing",
+                        snapshot_ids[2]: "completed"}
+
+
+def test_run_snapshots_and_deletes(client, tmp_path):
+    volume_ids = _volumes(client, 3)
+    runner = aws_snapshot_delete.SnapshotAndDelete(rate=100, checkpoint=str(tmp_path / "done"))
+    stats = runner.run({REGION: volume_ids})
+
+    assert stats["deleted"] == 3 and stats["failed"] == 0 and stats["unfinished"] == 0
+    assert client.describe_volumes(Filters=[{"Name": "volume-id", "Values": volume_ids}])["Volumes"] == []
+    snapshots = client.describe_snapshots(
+        OwnerIds=["self"], Filters=[{"Name": "tag:FedoraGroup", "Values": ["garbage-collector"]}])["Snapshots"]
+    assert sorted(snapshot["VolumeId"] for snapshot in snapshots) == sorted(volume_ids)
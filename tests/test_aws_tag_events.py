@@ -0,0 +1,152 @@
+"""
+aws_tag_events.py replayed from the recorded events in fixtures/events
+"""
+
+import copy
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import boto3
+from botocore.stub import ANY, Stubber
+from moto import mock_aws
+
+import aws_tag_events
+from conftest import FIXTURES
+
+EVENTS = os.path.join(FIXTURES, "events")
+
+
+def _records(name):
+    return list(aws_tag_events.read_events(os.path.join(EVENTS, name)))
+
+
+def test_read_events_unwraps_cloudtrail_and_eventbridge():
+    assert [record["eventName"] for record in _records("cloudtrail-log.json")] == [
+        "RunInstances", "CreateVolume", "AttachVolume", "DescribeInstances", "RunInstances"]
+    assert [record["eventName"] for record in _records("eventbridge.jsonl")] == [
+        "RunInstances", "CreateVolume", "AttachVolume", "AttachVolume"]
+    assert len(list(aws_tag_events.read_events(EVENTS))) == 9
+
+
+def test_collect_cloudtrail_log():
+    regions = aws_tag_events.collect(_records("cloudtrail-log.json"))
+    assert list(regions) == ["us-east-1"]
+    events = regions["us-east-1"]
+    # the failed RunInstances and DescribeInstances are ignored
+    assert set(events.instances) == {"i-0aaa"}
+    tags, volumes = events.instances["i-0aaa"]
+    assert tags["k8s.io/cluster-autoscaler/enabled"] == "true"
+    assert volumes == {"vol-0bbb"}
+    assert events.volumes["vol-0bbb"] == ({}, {"i-0aaa"})
+
+
+def test_collect_eventbridge():
+    events = aws_tag_events.collect(_records("eventbridge.jsonl"))["eu-west-1"]
+    assert events.instances["i-0ccc"] == ({"FedoraGroup": "copr"}, {"vol-0ddd", "vol-0eee"})
+    assert events.volumes["vol-0ddd"] == ({"FedoraGroup": "infra"}, {"i-0ccc"})
+    assert events.volumes["vol-0eee"] == ({}, {"i-0ccc"})
+
+
+def test_decide():
+    regions = aws_tag_events.collect(aws_tag_events.read_events(EVENTS))
+    # autoscaler instance gets CI and so does its volume
+    assert aws_tag_events.decide(regions["us-east-1"]) == {"CI": ["i-0aaa", "vol-0bbb"]}
+    # the tagged volume keeps its own value, the untagged one inherits the instance's
+    assert aws_tag_events.decide(regions["eu-west-1"]) == {"copr": ["vol-0eee"]}
+
+
+def test_decide_nothing_to_do():
+    records = _records("cloudtrail-log.json")
+    tagged = copy.deepcopy(records[0])
+    tagged["responseElements"]["instancesSet"]["items"][0]["tagSet"]["items"].append(
+        {"key": "FedoraGroup", "value": "CI"})
+    events = aws_tag_events.collect([tagged])["us-east-1"]
+    assert aws_tag_events.decide(events) == {}
+
+
+def test_process_offline(capsys):
+    assert aws_tag_events.process(aws_tag_events.read_events(EVENTS), offline=True) == 0
+    output = capsys.readouterr().out
+    assert "Would tag i-0aaa vol-0bbb in us-east-1 with FedoraGroup=CI" in output
+    assert "Would tag vol-0eee in eu-west-1 with FedoraGroup=copr" in output
+
+
+def test_batches_size():
+    assert list(aws_tag_events._batches(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_batches_flush_slow_stream():
+    def slow():
+        yield 1
+        time.sleep(0.5)
+        yield 2
+
+    started = time.monotonic()
+    batches = aws_tag_events._batches(slow(), 100, flush=0.1)
+    assert next(batches) == [1]
+    assert time.monotonic() - started < 0.4
+    assert list(batches) == [[2]]
+
+
+def test_batches_retry_deferred(monkeypatch):
+    monkeypatch.setattr(aws_tag_events, "PENDING_RETRY", 0.1)
+    deferred = []
+    batches = aws_tag_events._batches(iter([1]), 100, flush=0.05, deferred=deferred)
+    assert next(batches) == [1]
+    deferred.append(1)
+    started = time.monotonic()
+    assert next(batches) == [1]
+    assert time.monotonic() - started >= 0.1
+    assert not list(batches)
+
+
+def test_process_defers_pending_instance(monkeypatch):
+    """ A pending instance has no root volume yet, it is tagged only once it runs """
+    client = boto3.client("ec2", region_name="us-east-1",
+                          aws_access_key_id="testing", aws_secret_access_key="testing")
+    monkeypatch.setattr(boto3.session.Session, "client", lambda *args, **kwargs: client)
+    records = _records("cloudtrail-log.json")
+    pending = {"InstanceId": "i-0aaa", "State": {"Code": 0, "Name": "pending"},
+               "LaunchTime": datetime.now(timezone.utc), "BlockDeviceMappings": [],
+               "Tags": [{"Key": "k8s.io/cluster-autoscaler/enabled", "Value": "true"}]}
+    volume = {"VolumeId": "vol-0bbb", "Attachments": [{"InstanceId": "i-0aaa"}], "Tags": []}
+    deferred = []
+    with Stubber(client) as stubber:
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": [pending]}]},
+                             {"Filters": ANY, "MaxResults": ANY})
+        stubber.add_response("describe_volumes", {"Volumes": [volume]},
+                             {"Filters": ANY, "MaxResults": ANY})
+        # nothing is tagged, a create_tags call would fail the stubber
+        assert aws_tag_events.process(records, deferred=deferred) == 0
+        stubber.assert_no_pending_responses()
+    # the RunInstances and AttachVolume of i-0aaa come again
+    assert [record["eventName"] for record in deferred] == ["RunInstances", "AttachVolume"]
+
+
+def test_process_looks_resources_up(monkeypatch):
+    """ The events only name the resources, the tags come from EC2 (moto) """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        client = boto3.client("ec2", region_name="us-east-1")
+        instance = client.run_instances(
+            ImageId="ami-12c6146b", MinCount=1, MaxCount=1,
+            TagSpecifications=[{"ResourceType": "instance", "Tags": [
+                {"Key": "k8s.io/cluster-autoscaler/enabled", "Value": "true"}]}])["Instances"][0]
+        volume_id = client.create_volume(AvailabilityZone="us-east-1a", Size=10)["VolumeId"]
+        client.attach_volume(VolumeId=volume_id, InstanceId=instance["InstanceId"], Device="/dev/sdf")
+
+        with open(os.path.join(EVENTS, "cloudtrail-log.json"), encoding="utf8") as file:
+            text = file.read()
+        text = text.replace("i-0aaa", instance["InstanceId"]).replace("vol-0bbb", volume_id)
+        records = list(aws_tag_events._records(json.loads(text)))
+        # the root volume is not in the events, the lookup finds it
+        assert aws_tag_events.process(records) == 3
+
+        root_volume_id = instance["BlockDeviceMappings"][0]["Ebs"]["VolumeId"]
+        for resource_id in (instance["InstanceId"], volume_id, root_volume_id):
+            tags = client.describe_tags(Filters=[{"Name": "resource-id", "Values": [resource_id]},
+                                                 {"Name": "key", "Values": ["FedoraGroup"]}])["Tags"]
+            assert [tag["Value"] for tag in tags] == ["CI"]
@@ -0,0 +1,33 @@
+"""
+get_current_usage.py collection against the moto fleet
+"""
+
+import aws_inventory
+import get_current_usage
+import moto_fleet
+
+REGIONS = ["us-east-1", "eu-west-1", "ap-south-1"]
+
+
+def _gather(tmp_path, workers):
+    get_current_usage.INVENTORY = aws_inventory.Inventory(
+        max_age=0, path=str(tmp_path / f"inventory-{workers}.sqlite"))
+    get_current_usage.REGIONS = list(REGIONS)
+    return get_current_usage.gather_data(max_workers=workers)
+
+
+def test_concurrent_gather_matches_sequential(tmp_path):
+    with moto_fleet.fleet(REGIONS, instances=4, snapshots=4) as calls:
+        sequential = list(_gather(tmp_path, 1).rows())
+        assert calls.total == 4 * len(REGIONS)
+        calls.reset()
+        concurrent = list(_gather(tmp_path, 8).rows())
+        # one describe call per (region, kind), regardless of the workers
+        assert calls.by_operation == {operation: len(REGIONS) for operation in (
+            "DescribeInstances", "DescribeVolumes", "DescribeImages", "DescribeSnapshots")}
+
+    assert concurrent == sequential
+    groups = {key[0] for key, *_ in concurrent}
+    assert groups == {"copr", "ci", "infra", get_current_usage.NOT_TAGGED}
+    instances = sum(count for key, count, _, _ in concurrent if key[3] == "instance")
+    assert instances == 4 * len(REGIONS)